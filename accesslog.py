@@ -0,0 +1,151 @@
+"""Structured, sampled access and performance logging.
+
+Each logged request becomes one JSON line: route, status, duration, time
+spent in the database and the user id. Lines are handed to a background OS
+thread that does all the file I/O, so a request (or, under gevent, the
+hub) never waits on the disk. If the writer falls behind, the oldest
+pending lines are dropped rather than blocking requests.
+"""
+from flask import request, session, g
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from collections import deque
+import json
+import random
+import time
+
+
+def unpatched(module, name):
+    """Return module.name as it was before any gevent monkey patching, so
+    that a real OS thread can be started from a patched process."""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return getattr(__import__(module), name)
+    return monkey.saved.get(module, {}).get(
+        name, getattr(__import__(module), name))
+
+
+class LogWriter(object):
+    """Appends lines to a file from a background OS thread.
+
+    Lines are passed through a bounded deque, whose appends and pops are
+    atomic, so producers never take a lock or block.
+    """
+    def __init__(self, path, maxlen=10000, interval=0.5):
+        self.path = path
+        self.interval = interval
+        self.lines = deque(maxlen=maxlen)
+        self.lock = unpatched('thread', 'allocate_lock')()
+        self.sleep = unpatched('time', 'sleep')
+        self.running = True
+        unpatched('thread', 'start_new_thread')(self.run, ())
+
+    def write(self, line):
+        self.lines.append(line)
+
+    def run(self):
+        while self.running:
+            self.flush()
+            self.sleep(self.interval)
+        self.flush()
+
+    def flush(self):
+        """Write out every pending line."""
+        with self.lock:
+            if not self.lines:
+                return
+            with open(self.path, 'a') as f:
+                while self.lines:
+                    f.write(self.lines.popleft())
+                    f.write('\n')
+
+    def close(self):
+        self.running = False
+        self.flush()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_start', []).append(time.time())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    elapsed = time.time() - conn.info['query_start'].pop()
+    try:
+        g.db_time += elapsed
+    except (AttributeError, RuntimeError):
+        #Outside a request, or in one that started before logging did.
+        pass
+
+
+class AccessLogger(object):
+    """Logs a sample of the app's requests as JSON lines.
+
+    ACCESS_LOG_SAMPLE_RATE of the requests are logged, plus every server
+    error and every request slower than ACCESS_LOG_SLOW_MS. Each line
+    records the rate it was sampled at (1.0 for errors and slow requests),
+    so that counts can be scaled back up offline.
+    """
+    def __init__(self, app):
+        self.app = app
+        self.writer = None
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.teardown_request(self.teardown_request)
+        if app.config['ACCESS_LOG_PATH']:
+            self.start(app.config['ACCESS_LOG_PATH'])
+
+    def start(self, path):
+        self.writer = LogWriter(
+            path, maxlen=self.app.config['ACCESS_LOG_QUEUE_SIZE'])
+        if not event.contains(Engine, 'before_cursor_execute',
+                              _before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute',
+                         _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute',
+                         _after_cursor_execute)
+
+    def stop(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def before_request(self):
+        if self.writer is not None:
+            g.request_start = time.time()
+            g.db_time = 0.0
+
+    def after_request(self, response):
+        if self.writer is not None and \
+                getattr(g, 'request_start', None) is not None:
+            self.log(response.status_code)
+        return response
+
+    def teardown_request(self, exc):
+        #after_request doesn't run for unhandled exceptions.
+        if exc is not None and self.writer is not None and \
+                getattr(g, 'request_start', None) is not None:
+            self.log(500)
+
+    def log(self, status):
+        duration = time.time() - g.request_start
+        g.request_start = None
+        rate = self.app.config['ACCESS_LOG_SAMPLE_RATE']
+        if status >= 500 or \
+                duration * 1000 >= self.app.config['ACCESS_LOG_SLOW_MS']:
+            rate = 1.0
+        elif random.random() >= rate:
+            return
+        self.writer.write(json.dumps({
+            'time': round(time.time(), 3),
+            'method': request.method,
+            'route': request.url_rule.rule if request.url_rule else None,
+            'endpoint': request.endpoint,
+            'status': status,
+            'duration_ms': round(duration * 1000, 3),
+            'db_ms': round(g.db_time * 1000, 3),
+            'user_id': session.get('user_id'),
+            'sample_rate': rate,
+        }, separators=(',', ':')))
@@ -0,0 +1,107 @@
+"""Static asset pipeline: minify, fingerprint and precompress the files
+under static/ so nginx can serve them with far-future cache headers.
+
+build_assets() writes each asset to static/build/ under a name that
+includes a hash of its contents, along with .gz (and, when the brotli
+module is installed, .br) variants, and records the mapping from source
+name to built name in static/build/manifest.json.
+"""
+import gzip
+import hashlib
+import json
+import os
+import re
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+BUILD_DIR = 'build'
+MANIFEST = 'manifest.json'
+COMPRESSIBLE = ('.css', '.js', '.svg', '.txt')
+
+
+def minify_css(css):
+    """Strip comments and insignificant whitespace from a stylesheet."""
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.DOTALL)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+    css = re.sub(r':\s+', ':', css)
+    css = css.replace(';}', '}')
+    return css.strip()
+
+
+MINIFIERS = {
+    '.css': minify_css,
+}
+
+
+def fingerprint(name, content):
+    """Return name with a short hash of content inserted before its
+    extension: base.css -> base.0123456789.css
+    """
+    root, ext = os.path.splitext(name)
+    return '%s.%s%s' % (root, hashlib.md5(content).hexdigest()[:10], ext)
+
+
+def _write(path, content):
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def _precompress(path, content):
+    gz = gzip.GzipFile(path + '.gz', 'wb', 9, mtime=0)
+    try:
+        gz.write(content)
+    finally:
+        gz.close()
+    if brotli is not None:
+        _write(path + '.br', brotli.compress(content))
+
+
+def build_assets(static_folder):
+    """Build every asset under static_folder into static_folder/build and
+    return the manifest that maps source names to built names.
+    """
+    build_folder = os.path.join(static_folder, BUILD_DIR)
+    if not os.path.isdir(build_folder):
+        os.makedirs(build_folder)
+
+    manifest = {}
+    for dirpath, dirnames, filenames in os.walk(static_folder):
+        if dirpath == static_folder and BUILD_DIR in dirnames:
+            dirnames.remove(BUILD_DIR)
+        for filename in filenames:
+            source = os.path.join(dirpath, filename)
+            name = os.path.relpath(source, static_folder).replace(os.sep, '/')
+            ext = os.path.splitext(filename)[1]
+            with open(source, 'rb') as f:
+                content = f.read()
+            if ext in MINIFIERS:
+                content = MINIFIERS[ext](content)
+
+            built = fingerprint(name, content)
+            target = os.path.join(build_folder, built)
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            if not os.path.exists(target):
+                _write(target, content)
+                if ext in COMPRESSIBLE:
+                    _precompress(target, content)
+            manifest[name] = '%s/%s' % (BUILD_DIR, built)
+
+    with open(os.path.join(build_folder, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+    return manifest
+
+
+def load_manifest(static_folder):
+    """Return the manifest written by the last build, or an empty dict if
+    assets have never been built.
+    """
+    try:
+        with open(os.path.join(static_folder, BUILD_DIR, MANIFEST)) as f:
+            return json.load(f)
+    except IOError:
+        return {}
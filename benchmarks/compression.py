@@ -0,0 +1,71 @@
+"""Measure the bytes-on-wire and latency effect of GzipMiddleware on a
+list_view page of 1000 posts.
+
+The transfer estimate assumes the given link bandwidth; compression time
+is measured for real.
+
+    python benchmarks/compression.py --posts 1000 --bandwidth-mbps 10
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+from compression import GzipMiddleware
+import microblog
+
+
+def timed_get(client, requests, headers):
+    timings = []
+    for i in range(requests):
+        start = time.time()
+        response = client.get(
+            '/', base_url='http://%s/' % microblog.app.config['SERVER_NAME'],
+            headers=headers)
+        timings.append(time.time() - start)
+    return len(response.data), sorted(timings)[requests // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--posts', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--bandwidth-mbps', type=float, default=10.0)
+    parser.add_argument('--level', type=int, default=6)
+    args = parser.parse_args()
+
+    microblog.db.create_all()
+    try:
+        microblog.add_user(
+            'bench', 'password', 'bench@example.com', confirm=False)
+        user = microblog.User.query.filter_by(username='bench').first()
+        for i in range(args.posts):
+            microblog.db.session.add(microblog.Post(
+                'Post %d' % i, 'Line one\r\nLine two of post %d' % i, user.id))
+        microblog.db.session.commit()
+
+        app = microblog.app.wsgi_app
+        plain = Client(app, BaseResponse)
+        gzipped = Client(GzipMiddleware(app, level=args.level), BaseResponse)
+        bytes_per_second = args.bandwidth_mbps * 1000 * 1000 / 8
+
+        print "%d posts, %.1f Mbit/s link" % (args.posts, args.bandwidth_mbps)
+        for label, client, headers in [
+                ('identity', plain, {}),
+                ('gzip', gzipped, {'Accept-Encoding': 'gzip'})]:
+            size, server = timed_get(client, args.requests, headers)
+            wire = size / bytes_per_second
+            print "%-9s %9d bytes   server %7.2f ms   wire %7.2f ms   " \
+                "total %7.2f ms" % (label, size, server * 1000, wire * 1000,
+                                    (server + wire) * 1000)
+    finally:
+        microblog.db.session.remove()
+        microblog.db.drop_all()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""Load a running server with many concurrent keep-alive clients.
+
+Each client holds one HTTP/1.1 connection open and issues its requests
+over it back to back. To compare the cooperative and blocking database
+paths, run the same load against each:
+
+    python gevent_wrapper.py --port 5000 &
+    python gevent_wrapper.py --port 5001 --blocking-db &
+    python benchmarks/concurrency.py --port 5000 --clients 1000
+    python benchmarks/concurrency.py --port 5001 --clients 1000
+
+The server's SQLALCHEMY_POOL_SIZE caps how many requests can be in the
+database at once, so size it for the concurrency being tested.
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+import gevent
+import socket
+import time
+
+
+def read_response(f):
+    """Read one HTTP response from f and return its status code."""
+    status = int(f.readline().split()[1])
+    length = None
+    chunked = False
+    while True:
+        line = f.readline().strip()
+        if not line:
+            break
+        name, value = line.split(':', 1)
+        if name.lower() == 'content-length':
+            length = int(value)
+        elif name.lower() == 'transfer-encoding' and 'chunked' in value:
+            chunked = True
+    if chunked:
+        while True:
+            size = int(f.readline().strip(), 16)
+            f.read(size + 2)
+            if not size:
+                break
+    elif length:
+        f.read(length)
+    return status
+
+
+def client(args, latencies, errors):
+    try:
+        sock = socket.create_connection((args.host, args.port))
+    except socket.error:
+        errors.append(1)
+        return
+    f = sock.makefile('rb')
+    host = args.host_header or '%s:%d' % (args.host, args.port)
+    request = 'GET %s HTTP/1.1\r\nHost: %s\r\n\r\n' % (args.path, host)
+    try:
+        for i in range(args.requests):
+            start = time.time()
+            sock.sendall(request)
+            if read_response(f) != 200:
+                errors.append(1)
+            latencies.append(time.time() - start)
+    except (socket.error, ValueError, IndexError):
+        errors.append(1)
+    finally:
+        sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--host-header', default=None,
+                        help="Host header to send, if it must match the "
+                             "app's SERVER_NAME")
+    parser.add_argument('--path', default='/posts/1')
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=10,
+                        help='requests per client')
+    args = parser.parse_args()
+
+    latencies = []
+    errors = []
+    start = time.time()
+    gevent.joinall([gevent.spawn(client, args, latencies, errors)
+                    for i in range(args.clients)])
+    elapsed = time.time() - start
+
+    latencies.sort()
+    if not latencies:
+        print "No successful requests (%d errors)." % len(errors)
+        return
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+    print "%d clients x %d requests to %s:%d%s" % (
+        args.clients, args.requests, args.host, args.port, args.path)
+    print "%.0f requests/s, %d errors" % (len(latencies) / elapsed, len(errors))
+    print "latency p50 %.1f ms  p90 %.1f ms  p99 %.1f ms  max %.1f ms" % (
+        percentile(0.5) * 1000, percentile(0.9) * 1000,
+        percentile(0.99) * 1000, latencies[-1] * 1000)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""Compare a plain posts table with one partitioned by month.
+
+Builds both tables in a scratch PostgreSQL 11+ database, filled with the
+same generated rows spread over the last five years, then times the
+queries the app runs most and the archiving of the oldest month: a
+batched DELETE from the plain table against a DETACH PARTITION.
+
+    python benchmarks/partitioning.py --dsn dbname=scratch --rows 50000000
+
+Building the tables takes a while at the default size; the timings are
+only meaningful once the data no longer fits in shared_buffers.
+"""
+from datetime import datetime
+import argparse
+import os
+import sys
+import time
+
+import psycopg2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from partitioning import add_months, month_start, partition_name
+
+YEARS = 5
+
+CREATE = """
+CREATE TABLE {table} (
+    id integer NOT NULL,
+    title varchar(255) NOT NULL,
+    slug varchar(255) NOT NULL,
+    body text NOT NULL,
+    timestamp timestamp NOT NULL,
+    auth_id integer NOT NULL,
+    views integer NOT NULL DEFAULT 0
+) {partition_by}
+"""
+
+FILL = """
+INSERT INTO {table}
+SELECT n, 'Post ' || n, 'post-' || n, repeat('x', 500),
+       now() - interval '{years} years' * (1 - n::float / %(rows)s),
+       n %% 10000, 0
+FROM generate_series(1, %(rows)s) n
+"""
+
+QUERIES = [
+    ('recent page',
+     "SELECT * FROM {table} ORDER BY timestamp DESC LIMIT 20", {}),
+    ('author page',
+     "SELECT * FROM {table} WHERE auth_id = %(author)s "
+     "ORDER BY timestamp DESC LIMIT 20", {'author': 42}),
+    ('lookup by id',
+     "SELECT * FROM {table} WHERE id = %(id)s", {'id': 12345}),
+]
+
+
+def build(cursor, rows):
+    first = month_start(datetime.utcnow().replace(
+        year=datetime.utcnow().year - YEARS))
+    cursor.execute("DROP TABLE IF EXISTS bench_plain, bench_partitioned")
+    cursor.execute(CREATE.format(table='bench_plain', partition_by=''))
+    cursor.execute(CREATE.format(
+        table='bench_partitioned',
+        partition_by='PARTITION BY RANGE (timestamp)'))
+    month = first
+    while month <= datetime.utcnow():
+        cursor.execute(
+            "CREATE TABLE %s PARTITION OF bench_partitioned "
+            "FOR VALUES FROM ('%s') TO ('%s')" % (
+                partition_name('bench_partitioned', month), month,
+                add_months(month, 1)))
+        month = add_months(month, 1)
+    for table in ('bench_plain', 'bench_partitioned'):
+        cursor.execute(FILL.format(table=table, years=YEARS), {'rows': rows})
+        cursor.execute(
+            "CREATE INDEX ON %s (auth_id, timestamp)" % table)
+        cursor.execute("CREATE INDEX ON %s (timestamp)" % table)
+        cursor.execute("CREATE INDEX ON %s (id)" % table)
+        cursor.execute("ANALYZE %s" % table)
+    return first
+
+
+def timed(cursor, statement, params, runs):
+    samples = []
+    for i in range(runs):
+        start = time.time()
+        cursor.execute(statement, params)
+        if cursor.description:
+            cursor.fetchall()
+        samples.append(time.time() - start)
+    samples.sort()
+    return samples[len(samples) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--dsn', required=True)
+    parser.add_argument('--rows', type=int, default=50000000)
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--batch-size', type=int, default=10000,
+                        help='rows per DELETE when archiving the plain table')
+    parser.add_argument('--skip-build', action='store_true',
+                        help='reuse the tables from an earlier run')
+    args = parser.parse_args()
+
+    connection = psycopg2.connect(args.dsn)
+    connection.autocommit = True
+    cursor = connection.cursor()
+    if args.skip_build:
+        cursor.execute("SELECT min(timestamp) FROM bench_plain")
+        first = month_start(cursor.fetchone()[0])
+    else:
+        first = build(cursor, args.rows)
+
+    print "%-16s %14s %14s" % ('', 'plain', 'partitioned')
+    for label, statement, params in QUERIES:
+        print "%-16s %11.2f ms %11.2f ms" % ((label,) + tuple(
+            timed(cursor, statement.format(table=table), params, args.runs)
+            * 1000 for table in ('bench_plain', 'bench_partitioned')))
+
+    end = add_months(first, 1)
+    start = time.time()
+    deleted = 0
+    while True:
+        cursor.execute(
+            "DELETE FROM bench_plain WHERE id IN (SELECT id FROM bench_plain "
+            "WHERE timestamp < %s LIMIT %s)", (end, args.batch_size))
+        if not cursor.rowcount:
+            break
+        deleted += cursor.rowcount
+    plain = time.time() - start
+    start = time.time()
+    cursor.execute("ALTER TABLE bench_partitioned DETACH PARTITION %s" %
+                   partition_name('bench_partitioned', first))
+    partitioned = time.time() - start
+    print "%-16s %11.2f ms %11.2f ms  (%d rows)" % (
+        'archive a month', plain * 1000, partitioned * 1000, deleted)
+
+
+if __name__ == '__main__':
+    main()
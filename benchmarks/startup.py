@@ -0,0 +1,78 @@
+"""Measure process startup time and first-request latency.
+
+Each sample runs in a fresh interpreter, so the numbers include module
+imports, extension setup and (for the first request) template
+compilation. Run it twice against the same cache directory to compare a
+cold Jinja bytecode cache with a warm one:
+
+    python benchmarks/startup.py --runs 10 --cache-dir /tmp/jinja-cache
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SAMPLE = """
+import time
+start = time.time()
+import microblog
+imported = time.time()
+microblog.db.create_all()
+with microblog.app.test_client() as c:
+    before = time.time()
+    c.get('/')
+    first = time.time()
+    c.get('/')
+    second = time.time()
+microblog.db.session.remove()
+microblog.db.drop_all()
+print '%f %f %f' % (imported - start, first - before, second - first)
+"""
+
+
+def sample(env):
+    output = subprocess.check_output(
+        [sys.executable, '-c', SAMPLE], cwd=ROOT, env=env)
+    return [float(field) for field in output.split()]
+
+
+def report(label, samples):
+    samples = sorted(samples)
+    print "%-24s min %8.2f ms   median %8.2f ms" % (
+        label, samples[0] * 1000, samples[len(samples) // 2] * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--cache-dir', default=None,
+                        help='JINJA_BYTECODE_CACHE_DIR to benchmark with')
+    parser.add_argument('--cold', action='store_true',
+                        help='empty the cache directory before every run')
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    if args.cache_dir:
+        config = args.cache_dir.rstrip('/') + '.cfg'
+        with open(config, 'w') as f:
+            if os.environ.get('MICROBLOG_CONFIG'):
+                f.write(open(os.environ['MICROBLOG_CONFIG']).read())
+            f.write('\nJINJA_BYTECODE_CACHE_DIR = %r\n' % args.cache_dir)
+        env['MICROBLOG_CONFIG'] = config
+
+    results = []
+    for i in range(args.runs):
+        if args.cold and args.cache_dir and os.path.isdir(args.cache_dir):
+            shutil.rmtree(args.cache_dir)
+        results.append(sample(env))
+
+    report('import microblog', [r[0] for r in results])
+    report('first request', [r[1] for r in results])
+    report('second request', [r[2] for r in results])
+
+
+if __name__ == '__main__':
+    main()
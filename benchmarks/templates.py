@@ -0,0 +1,62 @@
+"""Measure the per-render CPU cost of list.html with and without the
+fragment cache and memoized url_for.
+
+Posts are plain objects rather than rows, so only template work is timed.
+
+    python benchmarks/templates.py --posts 20 --renders 2000
+"""
+import argparse
+import os
+import sys
+import timeit
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import render_template, session
+import microblog
+
+
+class Author(object):
+    username = 'bench'
+
+
+class FakePost(object):
+    author = Author()
+
+    def __init__(self, id):
+        self.id = id
+        self.title = 'Post %d' % id
+        self.slug = 'post-%d' % id
+        self.body = 'Line one\r\nLine two'
+        self.timestamp = datetime.utcnow()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--posts', type=int, default=20)
+    parser.add_argument('--renders', type=int, default=2000)
+    args = parser.parse_args()
+
+    posts = [FakePost(i) for i in range(args.posts)]
+    for logged_in in (False, True):
+        for cached in (False, True):
+            microblog.app.config['CACHE_TEMPLATE_FRAGMENTS'] = cached
+            microblog.fragment_cache.clear()
+            microblog._static_urls.clear()
+            with microblog.app.test_request_context('/'):
+                if logged_in:
+                    session['logged_in'] = True
+                    session['username'] = 'bench'
+                render = lambda: render_template(
+                    'list.html', posts=posts, post_total=len(posts))
+                render()
+                seconds = timeit.timeit(render, number=args.renders)
+            print "%-10s %-9s %8.1f us per render" % (
+                'logged in' if logged_in else 'anonymous',
+                'cached' if cached else 'uncached',
+                seconds / args.renders * 1000000)
+
+
+if __name__ == '__main__':
+    main()
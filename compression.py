@@ -0,0 +1,96 @@
+"""WSGI middleware that gzips responses on the way out of the app."""
+import zlib
+
+COMPRESSIBLE_TYPES = (
+    'text/html', 'text/css', 'text/plain', 'text/xml',
+    'application/json', 'application/javascript', 'application/xml',
+    'text/event-stream',
+)
+
+
+class GzipMiddleware(object):
+    """Gzip responses for clients that accept it.
+
+    Responses with a Content-Length below minimum_size are passed through
+    untouched, since compressing them costs more than it saves. Responses
+    without a Content-Length (streamed responses) are compressed chunk by
+    chunk, with a sync flush after each chunk so that nothing the app has
+    already yielded is held back from the client.
+    """
+    def __init__(self, app, minimum_size=1024, level=6,
+                 mime_types=COMPRESSIBLE_TYPES):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.level = level
+        self.mime_types = mime_types
+
+    def __call__(self, environ, start_response):
+        if 'gzip' not in environ.get('HTTP_ACCEPT_ENCODING', ''):
+            return self.app(environ, start_response)
+
+        captured = []
+
+        def capture(status, headers, exc_info=None):
+            captured[:] = [status, headers, exc_info]
+            return lambda data: None
+
+        app_iter = self.app(environ, capture)
+        status, headers, exc_info = captured
+        if not self.should_compress(headers):
+            start_response(status, headers, exc_info)
+            return app_iter
+
+        streaming = not any(
+            name.lower() == 'content-length' for name, value in headers)
+        vary = [value.strip() for name, values in headers
+                if name.lower() == 'vary' for value in values.split(',')]
+        if 'accept-encoding' not in [value.lower() for value in vary]:
+            vary.append('Accept-Encoding')
+        headers = [(name, value) for name, value in headers
+                   if name.lower() not in ('content-length', 'vary')]
+        headers.append(('Content-Encoding', 'gzip'))
+        headers.append(('Vary', ', '.join(vary)))
+        if streaming:
+            start_response(status, headers, exc_info)
+            return self.compress_stream(app_iter)
+
+        compressor = self.compressor()
+        try:
+            body = ''.join(compressor.compress(chunk) for chunk in app_iter)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+        body += compressor.flush()
+        headers.append(('Content-Length', str(len(body))))
+        start_response(status, headers, exc_info)
+        return [body]
+
+    def should_compress(self, headers):
+        """Decide from the response headers whether to gzip the body."""
+        content_type = ''
+        for name, value in headers:
+            name = name.lower()
+            if name == 'content-encoding':
+                return False
+            elif name == 'content-length' and int(value) < self.minimum_size:
+                return False
+            elif name == 'content-type':
+                content_type = value.split(';')[0].strip()
+        return content_type in self.mime_types
+
+    def compressor(self):
+        return zlib.compressobj(
+            self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress_stream(self, app_iter):
+        """Yield the gzipped body of a streamed response chunk by chunk."""
+        compressor = self.compressor()
+        try:
+            for chunk in app_iter:
+                if chunk:
+                    yield compressor.compress(chunk) + \
+                        compressor.flush(zlib.Z_SYNC_FLUSH)
+            yield compressor.flush()
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
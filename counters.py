@@ -0,0 +1,127 @@
+"""Buffered counters for high-frequency increments, such as post views.
+
+Increments are added up in memory and written in one batched UPDATE every
+few seconds or every so many increments, instead of one UPDATE per event.
+Alongside, the most frequently counted ids are tracked approximately, so
+a "most viewed" list never needs a sort over the table.
+"""
+from sqlalchemy import case
+from sqlalchemy.exc import SQLAlchemyError
+from threading import Lock
+import time
+
+
+class TopCounter(object):
+    """The Space-Saving algorithm: an approximate count of the most
+    frequent ids in a stream, using at most size entries. An id that is
+    not tracked replaces the least counted one and inherits its count, so
+    counts may be overestimated, but any id counted more than 1/size of
+    the time is always tracked.
+    """
+    def __init__(self, size=100):
+        self.size = size
+        self.counts = {}
+        self.lock = Lock()
+
+    def add(self, id, amount=1):
+        with self.lock:
+            if id in self.counts or len(self.counts) < self.size:
+                self.counts[id] = self.counts.get(id, 0) + amount
+            else:
+                least = min(self.counts, key=self.counts.get)
+                self.counts[id] = self.counts.pop(least) + amount
+
+    def top(self, count):
+        """Return the count most frequent ids, most frequent first."""
+        with self.lock:
+            counts = self.counts.items()
+        counts.sort(key=lambda item: item[1], reverse=True)
+        return [id for id, n in counts[:count]]
+
+
+class BufferedCounter(object):
+    """Adds increments to column of the rows of table, by primary key id.
+
+    Pending increments are flushed by add() once flush_interval seconds
+    have passed since the last flush or flush_size increments are pending,
+    and should be flushed at exit. A failed flush keeps its increments
+    pending for the next one, which add() doesn't attempt for another
+    flush_interval seconds, so that while the database is unavailable not
+    every increment waits on it. get_engine is called for the engine each
+    time, so that it can be created lazily.
+
+    Rows that may have moved to other tables with the same primary key and
+    column, such as posts_archive, are looked for in other_tables when a
+    batch doesn't match as many rows as it has ids.
+    """
+    batch_size = 500
+
+    def __init__(self, get_engine, table, column, flush_interval=5,
+                 flush_size=1000, top_size=100, other_tables=()):
+        self.get_engine = get_engine
+        self.table = table
+        self.other_tables = other_tables
+        self.column = column
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.pending = {}
+        self.pending_total = 0
+        self.last_flush = time.time()
+        self.retry_at = 0
+        self.lock = Lock()
+        self.top = TopCounter(top_size)
+
+    def add(self, id, amount=1):
+        with self.lock:
+            self.pending[id] = self.pending.get(id, 0) + amount
+            self.pending_total += amount
+            now = time.time()
+            due = now >= self.retry_at and (
+                self.pending_total >= self.flush_size or
+                now - self.last_flush >= self.flush_interval)
+        self.top.add(id, amount)
+        if due:
+            try:
+                self.flush()
+            except SQLAlchemyError:
+                pass
+
+    def get_pending(self, id):
+        """Return the increments to id not yet written to the table."""
+        return self.pending.get(id, 0)
+
+    def flush(self):
+        """Write every pending increment to the table."""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.pending_total = 0
+            self.last_flush = time.time()
+        if not pending:
+            return
+        items = pending.items()
+        try:
+            with self.get_engine().begin() as connection:
+                for i in range(0, len(items), self.batch_size):
+                    batch = dict(items[i:i + self.batch_size])
+                    matched = self._update(connection, self.table, batch)
+                    for table in self.other_tables:
+                        if matched == len(batch):
+                            break
+                        matched += self._update(connection, table, batch)
+        except Exception:
+            with self.lock:
+                for id, amount in items:
+                    self.pending[id] = self.pending.get(id, 0) + amount
+                    self.pending_total += amount
+                self.retry_at = time.time() + self.flush_interval
+            raise
+        self.retry_at = 0
+
+    def _update(self, connection, table, batch):
+        id_column = table.primary_key.columns.values()[0]
+        column = table.c[self.column]
+        return connection.execute(
+            table.update().
+            where(id_column.in_(batch.keys())).
+            values({column: column + case(
+                value=id_column, whens=batch)})).rowcount
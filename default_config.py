@@ -2,3 +2,65 @@ SECRET_KEY = 'notaparticularlysecurekey'
 SQLALCHEMY_DATABASE_URI = 'postgresql:///microblog_test'
 SERVER_NAME = 'localhost:5000'
 TESTING = True
+SQLALCHEMY_BINDS = {}
+SQLALCHEMY_READ_REPLICAS = []
+READ_REPLICA_STICKY_SECONDS = 5
+JINJA_BYTECODE_CACHE_DIR = None
+NGINX_SERVER_NAME = 'ec2-54-186-44-238.us-west-2.compute.amazonaws.com/'
+NGINX_STATIC_ROOT = '/home/ubuntu/FlaskMicroblog/static'
+NGINX_BROTLI_STATIC = False
+NGINX_GZIP = True
+NGINX_UPSTREAM_KEEPALIVE = 16
+NGINX_LISTEN = 80
+NGINX_UPSTREAM = '127.0.0.1:5000'
+NGINX_ACCESS_LOG = '/var/log/nginx/test.log'
+NGINX_PROXY_CACHE = False
+NGINX_PROXY_CACHE_PATH = '/var/cache/nginx/microblog'
+NGINX_PROXY_CACHE_SIZE = '1g'
+NGINX_PURGE_PORT = 8081
+GZIP_RESPONSES = False
+GZIP_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+STREAM_LIST_VIEW = False
+STREAM_BATCH_SIZE = 100
+STREAM_BUFFER_SIZE = 5
+POSTS_PER_PAGE = 20
+SESSION_BACKEND = None
+SESSION_STORE_TTL = 86400
+SESSION_MEMORY_SIZE = 10000
+SESSION_SWEEP_INTERVAL = 60
+CACHE_TEMPLATE_FRAGMENTS = True
+SITEMAP_CHUNK_SIZE = 50000
+SITEMAP_CACHE_DIR = None
+SLUG_INDEX_SIZE = 100000
+MAX_POST_ID_TTL = 1
+ACCESS_LOG_PATH = None
+ACCESS_LOG_SAMPLE_RATE = 1.0
+ACCESS_LOG_SLOW_MS = 500
+ACCESS_LOG_QUEUE_SIZE = 10000
+METRICS_ALLOWED_IPS = ['127.0.0.1']
+METRICS_DIR = None
+METRICS_DUMP_INTERVAL = 5
+TIMELINE_FAN_OUT_LIMIT = 10000
+TIMELINE_BACKFILL = 100
+TIMELINE_POPULAR_TTL = 60
+EVENT_STREAM_HEARTBEAT = 15
+EVENT_STREAM_QUEUE_SIZE = 32
+EVENT_STREAM_MAX_SUBSCRIBERS = 5000
+EVENT_STREAM_REPLAY = 100
+EVENT_STREAM_POLL_INTERVAL = 1
+VIEW_COUNT_FLUSH_INTERVAL = 5
+VIEW_COUNT_FLUSH_SIZE = 1000
+VIEW_COUNT_TOP_SIZE = 100
+DEBUG_TOKEN = None
+PROFILER_INTERVAL = 0.01
+PROFILER_MAX_SECONDS = 60
+POSTS_PARTITION_MONTHS_AHEAD = 3
+ARCHIVE_BATCH_SIZE = 1000
+HTTP_CACHE_MAX_AGE = 60
+HTTP_CACHE_PURGE_URL = None
+SNAPSHOT_DIR = None
+SNAPSHOT_BATCH_SIZE = 500
+IDEMPOTENCY_TTL = 86400
+IDEMPOTENCY_LOCK_TIMEOUT = 60
+IDEMPOTENCY_SWEEP_INTERVAL = 60
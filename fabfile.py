@@ -1,4 +1,5 @@
 from fabric.api import run
+from fabric.api import local
 from fabric.api import env
 from fabric.api import prompt
 from fabric.api import execute
@@ -6,13 +7,23 @@ from fabric.api import sudo
 from fabric.contrib.project import rsync_project
 from fabric.contrib.files import append
 from fabric.context_managers import cd
+from fabric.context_managers import shell_env
+from contextlib import contextmanager
 import boto.ec2
+import hashlib
 import time
 import os
 import re
 
 env.hosts = ['localhost', ]
 env.aws_region = 'us-west-2'
+env.wheelhouse = 'wheelhouse'
+env.remote_wheelhouse = '~/wheelhouse'
+
+#Left out of the rsync of the project tree; wheels are shipped separately.
+DEPLOY_EXCLUDES = (
+    '.git', '*.pyc', 'wheelhouse', 'instance', 'static/build', 'nginx_config',
+)
 
 
 def host_type():
@@ -128,14 +139,55 @@ def update():
 
 def _python_setup():
     sudo('apt-get install python-all-dev python-setuptools python-pip libpq-dev')
+    #Wheels need a newer pip than the distribution's.
+    sudo('pip install -U "pip>=1.5"')
 
 
 def python_setup():
     run_command_on_selected_server(_python_setup)
 
 
+def _requirements_hash():
+    with open('requirements.txt') as f:
+        return hashlib.sha1(f.read()).hexdigest()[:12]
+
+
+def build_wheelhouse(image=None):
+    """Build wheels for every requirement into wheelhouse/<hash>, where
+    hash is that of requirements.txt, unless that has already been done.
+    The wheels must match the servers' platform and Python, so when
+    building anywhere else, give a Docker image of the server's OS to
+    build in."""
+    path = os.path.join(env.wheelhouse, _requirements_hash())
+    if os.path.exists(os.path.join(path, '.complete')):
+        print "Wheelhouse %s is up to date." % path
+        return path
+    command = 'pip wheel --wheel-dir=%s -r requirements.txt' % path
+    if image:
+        command = 'docker run --rm -v "$PWD":/src -w /src %s %s' % (
+            image, command)
+    local(command)
+    local('touch %s' % os.path.join(path, '.complete'))
+    return path
+
+
+def _ship_wheelhouse(path):
+    run('mkdir -p %s' % env.remote_wheelhouse)
+    #rsync skips the wheels the server already has.
+    rsync_project(env.remote_wheelhouse, path)
+
+
 def _install_python_reqs():
-    sudo('pip install -r requirements.txt')
+    """Install the requirements from the shipped wheelhouse, without
+    reaching PyPI or compiling anything. Skipped when the same
+    requirements were installed by a previous deploy."""
+    wheels = '%s/%s' % (env.remote_wheelhouse, _requirements_hash())
+    if run('test -e %s/.installed' % wheels, warn_only=True).succeeded:
+        print "Requirements are already installed."
+        return
+    sudo('pip install --no-index --find-links=%s -r requirements.txt' %
+         wheels)
+    run('touch %s/.installed' % wheels)
 
 
 def _install_postgres():
@@ -218,24 +270,58 @@ def start_selected_server():
     conn.start_instances(instance_ids=selected_servers)
 
 
-def deploy():
+def deploy(image=None):
+    env.wheelhouse_path = build_wheelhouse(image)
     run_command_on_selected_server(_deploy)
 
 
+def deploy_to(host, image=None):
+    """Deploy to any host reachable over SSH, such as a local VM or
+    container: fab deploy_to:ubuntu@localhost:2222"""
+    env.wheelhouse_path = build_wheelhouse(image)
+    execute(_deploy, hosts=[host])
+
+
+@contextmanager
+def _timed(step):
+    start = time.time()
+    try:
+        yield
+    finally:
+        env.deploy_timings.append((step, time.time() - start))
+
+
 def _deploy():
-    rsync_project('~')
+    env.deploy_timings = []
+    start = time.time()
+    with _timed('rsync project'):
+        rsync_project('~', exclude=DEPLOY_EXCLUDES)
+    with _timed('rsync wheelhouse'):
+        _ship_wheelhouse(env.wheelhouse_path)
 
     #sudo('createdb microblog')
 
     with cd('FlaskMicroblog'):
-        _install_python_reqs()
-        sudo('export MICROBLOG_CONFIG=`pwd`/config.py')
-        #sudo('python microblog.py db upgrade')
+        with _timed('install requirements'):
+            _install_python_reqs()
+        #Each sudo() runs in a shell of its own, so the config has to be
+        #set for every command.
+        config = run('pwd') + '/config.py'
+        with shell_env(MICROBLOG_CONFIG=config):
+            #sudo('python microblog.py db upgrade')
+            with _timed('build'):
+                sudo('python microblog.py precompile_templates')
+                sudo('python microblog.py build_assets')
+                sudo('python microblog.py write_nginx_config')
         sudo('mv nginx_config /etc/nginx/sites-available/default')
         sudo('cp microblog.conf /etc/supervisor/conf.d')
 
-    _restart_nginx()
-    _restart_supervisor()
+    with _timed('restart'):
+        _restart_nginx()
+        _restart_supervisor()
+    for step, seconds in env.deploy_timings:
+        print "%-24s %7.1fs" % (step, seconds)
+    print "%-24s %7.1fs" % ('deploy', time.time() - start)
 
 
 def setup():
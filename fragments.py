@@ -0,0 +1,53 @@
+"""A cache of rendered template fragments.
+
+Parts of a page that depend on only a few values, such as the login
+header, are rendered once per distinct set of values and then reused,
+instead of being rendered again on every page view.
+"""
+from collections import OrderedDict
+from threading import Lock
+from jinja2 import Markup
+
+
+class FragmentCache(object):
+    """A bounded LRU cache of rendered fragments, keyed by template name
+    and a key that must capture everything the fragment depends on.
+    """
+    def __init__(self, app, maxsize=1024):
+        self.app = app
+        self.maxsize = maxsize
+        self.fragments = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, template_name, key, **context):
+        """Return the cached rendering of template_name for key, rendering
+        it with context if it isn't cached yet.
+        """
+        if not self.app.config['CACHE_TEMPLATE_FRAGMENTS']:
+            return self._render(template_name, context)
+
+        key = (template_name, key)
+        with self.lock:
+            fragment = self.fragments.pop(key, None)
+            if fragment is not None:
+                self.fragments[key] = fragment
+                self.hits += 1
+                return fragment
+
+        fragment = self._render(template_name, context)
+        with self.lock:
+            self.misses += 1
+            self.fragments[key] = fragment
+            while len(self.fragments) > self.maxsize:
+                self.fragments.popitem(last=False)
+        return fragment
+
+    def _render(self, template_name, context):
+        template = self.app.jinja_env.get_template(template_name)
+        return Markup(template.render(context))
+
+    def clear(self):
+        with self.lock:
+            self.fragments.clear()
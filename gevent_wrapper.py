@@ -1,6 +1,68 @@
+"""Serve the microblog with gevent.
+
+Everything that would block a worker is made cooperative before the app is
+imported: the standard library through gevent's monkey patching, and
+psycopg2 through a wait callback. A greenlet waiting on PostgreSQL then
+yields to the others instead of stalling every request in the process.
+"""
+from gevent import monkey
+monkey.patch_all()
+
+from gevent.socket import wait_read, wait_write
 from gevent.wsgi import WSGIServer
-from microblog import app
+import argparse
+import gevent
+import os
+import signal
+import socket
+
+try:
+    import psycopg2
+    from psycopg2 import extensions
+except ImportError:
+    psycopg2 = None
+
+
+def gevent_wait_callback(conn, timeout=None):
+    """A psycopg2 wait callback that waits on the connection's socket
+    through the gevent hub."""
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError(
+                "Bad result from poll: %r" % state)
+
 
 if __name__ == '__main__':
-    http_server = WSGIServer(('', 5000), app)
+    parser = argparse.ArgumentParser(description="Serve the microblog.")
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--blocking-db', action='store_true',
+                        help="leave psycopg2 blocking (for comparison)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="processes to fork, all sharing one socket")
+    args = parser.parse_args()
+
+    if psycopg2 is not None and not args.blocking_db:
+        extensions.set_wait_callback(gevent_wait_callback)
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('', args.port))
+    listener.listen(1024)
+    #Each worker imports the app itself, after forking, so that no database
+    #connection or access log thread is inherited across the fork.
+    for i in range(args.workers - 1):
+        if os.fork() == 0:
+            break
+    from microblog import app
+    http_server = WSGIServer(listener, app)
+    #Stop cleanly on SIGTERM (supervisor's stop signal), so that atexit
+    #handlers, such as the flush of buffered view counts, get to run.
+    gevent.signal(signal.SIGTERM, http_server.stop)
     http_server.serve_forever()
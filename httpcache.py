@@ -0,0 +1,122 @@
+"""Shared caching of anonymous pages by the reverse proxy in front of the
+app, and refreshing them when their content changes.
+
+A view tags its response with one or more surrogate keys, such as 'home' or
+'author/alice'. Tagged responses to anonymous GET requests are sent with a
+Cache-Control header that lets shared caches keep them for
+HTTP_CACHE_MAX_AGE seconds (browsers must revalidate), and with the keys in
+a Surrogate-Key header. Responses to requests with a session are marked
+private.
+
+nginx caches by URL rather than by key, so each kind of key has a resolver
+returning the paths it covers. purge() resolves the keys and has the cache
+fetch those paths again through HTTP_CACHE_PURGE_URL, an nginx server that
+always bypasses the cache and stores what it gets. Paths the keys don't
+cover, such as older pages of a listing, expire after HTTP_CACHE_MAX_AGE.
+
+Refreshes carry an X-Cache-Refresh header, so that the app can serve them
+from the primary database rather than a replica that may not have the
+change yet. The header is only trusted from the app's own host, and nginx
+removes it from every other request.
+"""
+from flask import g, request, session, url_for, has_request_context
+from threading import Thread
+import urllib
+import urllib2
+
+REFRESH_HEADER = 'X-Cache-Refresh'
+
+
+def surrogate_key(name, arg=None):
+    """Build a surrogate key from a resolver name and its argument."""
+    if arg is None:
+        return name
+    return '%s/%s' % (name, urllib.quote(unicode(arg).encode('utf-8'), ''))
+
+
+class HttpCache(object):
+    """Adds caching headers to tagged responses and refreshes the cached
+    copies of keys on request."""
+    def __init__(self, app):
+        self.app = app
+        self.resolvers = {}
+        app.after_request(self.add_headers)
+
+    def resolver(self, name):
+        """Register a function returning the paths covered by the keys
+        named name. It is passed the key's argument, if it has one."""
+        def register(f):
+            self.resolvers[name] = f
+            return f
+        return register
+
+    def tag(self, *keys):
+        """Tag the current request's response with keys."""
+        g.surrogate_keys = getattr(g, 'surrogate_keys', ()) + keys
+
+    def add_headers(self, response):
+        keys = getattr(g, 'surrogate_keys', None)
+        if not keys or request.method not in ('GET', 'HEAD') or \
+                response.status_code != 200:
+            return response
+        #A page rendered for a request with a session may show that user's
+        #own state, such as their login or flashed messages, which have
+        #already been taken out of the session if they were shown.
+        if session or self.app.session_cookie_name in request.cookies:
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        response.headers['Cache-Control'] = \
+            'public, max-age=0, s-maxage=%d' % \
+            self.app.config['HTTP_CACHE_MAX_AGE']
+        response.headers['Surrogate-Key'] = ' '.join(keys)
+        return response
+
+    def url_for(self, endpoint, **values):
+        """Build the path to endpoint, for resolvers. Unlike flask.url_for,
+        this also works outside of a request."""
+        if has_request_context():
+            return url_for(endpoint, **values)
+        adapter = self.app.url_map.bind(
+            '', script_name=self.app.config['APPLICATION_ROOT'] or '/')
+        return adapter.build(endpoint, values)
+
+    def is_refresh(self):
+        """Return True if the current request was sent by refresh()."""
+        return request.headers.get(REFRESH_HEADER) == '1' and \
+            request.remote_addr == '127.0.0.1'
+
+    def paths(self, keys):
+        paths = []
+        for key in keys:
+            name, _, arg = key.partition('/')
+            args = (urllib.unquote(arg).decode('utf-8'),) if arg else ()
+            for path in self.resolvers[name](*args):
+                if path not in paths:
+                    paths.append(path)
+        return paths
+
+    def purge(self, *keys):
+        """Refresh the cached copies of the paths covered by keys, in the
+        background. Returns the paths."""
+        paths = self.paths(keys)
+        if self.app.config['HTTP_CACHE_PURGE_URL'] and paths:
+            thread = Thread(target=self.refresh, args=(paths,))
+            thread.daemon = True
+            thread.start()
+        return paths
+
+    def refresh(self, paths):
+        """Fetch paths through HTTP_CACHE_PURGE_URL, once for each variant
+        the cache keeps: gzipped and not."""
+        base = self.app.config['HTTP_CACHE_PURGE_URL'].rstrip('/')
+        for path in paths:
+            for encoding in ({'Accept-Encoding': 'gzip'}, {}):
+                headers = dict(encoding)
+                headers[REFRESH_HEADER] = '1'
+                try:
+                    urllib2.urlopen(
+                        urllib2.Request(base + path, headers=headers),
+                        timeout=10).read()
+                except Exception as e:
+                    self.app.logger.warning(
+                        "Could not refresh %s in the HTTP cache: %s", path, e)
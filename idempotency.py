@@ -0,0 +1,142 @@
+"""Idempotency keys for requests that must not run twice, such as form
+submissions that a user double-clicks or a client retries after a slow
+response.
+
+The client generates a key for each logical request and sends it in an
+Idempotency-Key header or an idempotency_key form field. The first request
+with a key claims it and runs the view; its response is recorded for ttl
+seconds. A repeat of the request gets the recorded response back without
+the view running again. A repeat that arrives while the first is still
+running gets 409 Conflict, and reusing a key for a different request gets
+422. Requests without a key run as usual.
+
+Keys are scoped to the endpoint and the logged in user, and claimed with a
+single INSERT ... ON CONFLICT DO NOTHING, so two workers can never both run
+the view for the same key.
+"""
+from flask import request, session, abort, make_response
+from sqlalchemy import text
+from datetime import datetime, timedelta
+from functools import wraps
+import hashlib
+import json
+import time
+
+#Fields left out of a request's fingerprint. Passwords are left out so
+#that no hash of one is stored.
+IGNORED_FIELDS = ('_csrf_token', 'idempotency_key', 'password')
+
+#Only the headers a form response needs are replayed.
+REPLAYED_HEADERS = ('Content-Type', 'Location')
+
+#Returned by claim() when the key kept changing hands under it.
+CONTENDED = object()
+
+
+class IdempotencyStore(object):
+    """Records the responses of idempotent views in a table with key,
+    fingerprint, status, headers, body and expires columns (see
+    IdempotencyKey in microblog.py). A claimed key that never gets a
+    response, because its worker died, is released after lock_timeout
+    seconds. get_engine is called for the engine each time, so that it can
+    be created lazily."""
+    def __init__(self, get_engine, table, ttl, lock_timeout=60,
+                 sweep_interval=60):
+        self.get_engine = get_engine
+        self.table = table
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self.sweep_interval = sweep_interval
+        self.last_sweep = time.time()
+
+    def claim(self, key, fingerprint, attempts=3):
+        """Claim key for a request. Returns None if it was claimed, the
+        row of the request that already holds it, or CONTENDED if neither
+        happened within attempts tries, because the key was released or
+        expired again each time between the INSERT and the SELECT."""
+        c = self.table.c
+        engine = self.get_engine()
+        for attempt in range(attempts):
+            claimed = engine.execute(text(
+                "INSERT INTO %s (key, fingerprint, expires) "
+                "VALUES (:key, :fingerprint, :expires) "
+                "ON CONFLICT DO NOTHING" % self.table.name),
+                key=key, fingerprint=fingerprint,
+                expires=datetime.utcnow() + timedelta(
+                    seconds=self.lock_timeout)).rowcount
+            if claimed:
+                return None
+            row = engine.execute(
+                self.table.select().where(c.key == key)).first()
+            if row is None:
+                continue
+            if row.expires >= datetime.utcnow():
+                return row
+            engine.execute(self.table.delete().where(
+                (c.key == key) & (c.expires < datetime.utcnow())))
+        return CONTENDED
+
+    def record(self, key, response):
+        headers = [(name, value) for name, value in response.headers
+                   if name in REPLAYED_HEADERS]
+        self.get_engine().execute(
+            self.table.update().where(self.table.c.key == key),
+            status=response.status_code,
+            headers=json.dumps(headers),
+            body=response.get_data(),
+            expires=datetime.utcnow() + timedelta(seconds=self.ttl))
+        self.sweep()
+
+    def release(self, key):
+        self.get_engine().execute(
+            self.table.delete().where(self.table.c.key == key))
+
+    def replay(self, row):
+        return make_response(
+            row.body, row.status, json.loads(row.headers))
+
+    def sweep(self, force=False):
+        """Delete expired keys in one statement, at most once every
+        sweep_interval seconds."""
+        now = time.time()
+        if not force and now - self.last_sweep < self.sweep_interval:
+            return
+        self.last_sweep = now
+        self.get_engine().execute(self.table.delete().where(
+            self.table.c.expires < datetime.utcnow()))
+
+    def idempotent(self, view):
+        """Decorate a view so that POSTs carrying an idempotency key run
+        at most once."""
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            client_key = request.headers.get('Idempotency-Key') or \
+                request.form.get('idempotency_key')
+            if request.method != 'POST' or not client_key:
+                return view(*args, **kwargs)
+            if len(client_key) > 128:
+                abort(400)
+            key = '%s:%s:%s' % (
+                request.endpoint, session.get('user_id', ''), client_key)
+            fingerprint = hashlib.sha1(json.dumps(sorted(
+                (name, value) for name, value in request.form.items(True)
+                if name not in IGNORED_FIELDS))).hexdigest()
+
+            row = self.claim(key, fingerprint)
+            if row is not None:
+                if row is CONTENDED or row.status is None:
+                    abort(409)
+                if row.fingerprint != fingerprint:
+                    abort(422)
+                return self.replay(row)
+            try:
+                response = make_response(view(*args, **kwargs))
+            except Exception:
+                self.release(key)
+                raise
+            if response.status_code >= 500:
+                self.release(key)
+            else:
+                self.record(key, response)
+            return response
+        return wrapper
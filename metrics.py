@@ -0,0 +1,313 @@
+"""Prometheus-style metrics for the app process.
+
+Metrics are plain in-process counters and histograms. Recording one takes a
+single uncontended lock for a dict update, so it is cheap enough to do on
+every request. /metrics renders them in the Prometheus text format.
+
+When the app runs as several pre-forked workers, a scrape only reaches one
+of them. With METRICS_DIR set, a background thread (a greenlet under
+gevent) in every worker writes its samples to
+METRICS_DIR/<pid>-<start>.json every METRICS_DUMP_INTERVAL seconds, and
+/metrics merges the files of all workers: counters and histograms are
+summed (including those of workers that have exited, so totals never go
+backwards), while gauges are reported per live worker with a pid label.
+The start time in the name keeps a worker that reuses the pid of an
+exited one from overwriting its totals. The directory should be emptied
+whenever the whole service is restarted.
+"""
+from flask import request, abort, Response
+from collections import defaultdict, OrderedDict
+from threading import Lock, Thread, current_thread
+from contextlib import contextmanager
+from bisect import bisect_left
+import atexit
+import json
+import os
+import time
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', r'\\')
+                     .replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in labels)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter(object):
+    """A count that only goes up, kept separately for each combination of
+    label values."""
+    kind = 'counter'
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.values = defaultdict(float)
+        self.lock = Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self.lock:
+            self.values[tuple(labels)] += amount
+
+    def samples(self):
+        with self.lock:
+            values = self.values.items()
+        for key, value in values:
+            yield self.name, zip(self.labels, key), value
+
+
+class Histogram(object):
+    """Observations counted into buckets, along with their sum, kept
+    separately for each combination of label values."""
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        #label values -> [count in each bucket..., sum]
+        self.values = {}
+        self.lock = Lock()
+
+    def observe(self, value, labels=()):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(tuple(labels))
+            if counts is None:
+                counts = self.values[tuple(labels)] = \
+                    [0] * len(self.buckets) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, labels=()):
+        """Observe the time taken by the block, in seconds."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, labels)
+
+    def samples(self):
+        with self.lock:
+            values = [(key, list(counts))
+                      for key, counts in self.values.items()]
+        for key, counts in values:
+            labels = zip(self.labels, key)
+            total = 0
+            for bound, count in zip(self.buckets, counts):
+                total += count
+                yield self.name + '_bucket', \
+                    labels + [('le', _format_value(bound))], total
+            yield self.name + '_count', labels, total
+            yield self.name + '_sum', labels, counts[-1]
+
+
+class Callback(object):
+    """A metric whose samples are read from the app when it is collected,
+    for values the app already keeps. func returns a list of (label values,
+    value) pairs."""
+    def __init__(self, name, doc, kind, func, labels=()):
+        self.name = name
+        self.doc = doc
+        self.kind = kind
+        self.func = func
+        self.labels = tuple(labels)
+
+    def samples(self):
+        for key, value in self.func():
+            yield self.name, zip(self.labels, key), value
+
+
+class Metrics(object):
+    """The app's metric registry. Counts requests and their latency per
+    view function, and serves every registered metric at /metrics to the
+    addresses in METRICS_ALLOWED_IPS.
+    """
+    def __init__(self, app, prefix='microblog_'):
+        self.app = app
+        self.prefix = prefix
+        self.metrics = []
+        self.dumper = None
+        self.dumper_pid = None
+        self.started_pid = None
+        self.started = None
+        self.requests = self.counter(
+            'requests_total', "Requests handled, by view function.",
+            ('endpoint', 'method', 'status'))
+        self.request_seconds = self.histogram(
+            'request_duration_seconds', "Request latency, by view function.",
+            ('endpoint',))
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.teardown_request(self.teardown_request)
+        app.add_url_rule('/metrics', 'metrics_view', self.view)
+        if app.config['METRICS_DIR']:
+            atexit.register(self.dump)
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, doc, labels=()):
+        return self.register(Counter(self.prefix + name, doc, labels))
+
+    def histogram(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(
+            Histogram(self.prefix + name, doc, labels, buckets))
+
+    def callback(self, name, doc, kind, func, labels=()):
+        return self.register(
+            Callback(self.prefix + name, doc, kind, func, labels))
+
+    def before_request(self):
+        request.environ['microblog.metrics_start'] = time.time()
+
+    def after_request(self, response):
+        self.record(response.status_code)
+        return response
+
+    def teardown_request(self, exc):
+        #after_request doesn't run for unhandled exceptions.
+        if exc is not None:
+            self.record(500)
+
+    def record(self, status):
+        start = request.environ.pop('microblog.metrics_start', None)
+        if start is None:
+            return
+        endpoint = request.endpoint or 'none'
+        self.requests.inc((endpoint, request.method, status))
+        self.request_seconds.observe(time.time() - start, (endpoint,))
+        if self.app.config['METRICS_DIR'] and \
+                self.dumper_pid != os.getpid():
+            self.start_dumper()
+
+    def start_dumper(self):
+        """Start dumping this process's samples in the background. Workers
+        are forked after the app is created, so this is done by each
+        worker on its first request."""
+        self.dumper_pid = os.getpid()
+        self.dumper = Thread(target=self.run_dumper)
+        self.dumper.daemon = True
+        self.dumper.start()
+
+    def stop_dumper(self):
+        self.dumper = self.dumper_pid = None
+
+    def run_dumper(self):
+        while self.dumper is current_thread():
+            time.sleep(self.app.config['METRICS_DUMP_INTERVAL'])
+            if self.dumper is not current_thread():
+                return
+            try:
+                self.dump()
+            except (IOError, OSError) as e:
+                self.app.logger.warning("Could not dump metrics: %s", e)
+
+    def collect(self):
+        """Return this process's metrics as a list of (name, kind, doc,
+        samples), where each sample is (name, labels, value)."""
+        return [(metric.name, metric.kind, metric.doc,
+                 [[name, list(labels), value]
+                  for name, labels, value in metric.samples()])
+                for metric in self.metrics]
+
+    def dump_path(self):
+        if self.started_pid != os.getpid():
+            self.started_pid = os.getpid()
+            self.started = int(time.time() * 1000)
+        return os.path.join(self.app.config['METRICS_DIR'], '%d-%d.json' % (
+            self.started_pid, self.started))
+
+    def dump(self):
+        """Write this process's samples to METRICS_DIR for the other
+        workers to merge."""
+        directory = self.app.config['METRICS_DIR']
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = self.dump_path()
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'pid': os.getpid(), 'started': self.started,
+                       'metrics': self.collect()}, f)
+        os.rename(path + '.tmp', path)
+
+    def collect_all(self):
+        """Merge this process's samples with those of every other worker
+        that has dumped them."""
+        directory = self.app.config['METRICS_DIR']
+        if not directory:
+            return self.collect()
+        own = os.path.basename(self.dump_path())
+        dumps = [{'pid': os.getpid(), 'started': self.started,
+                  'metrics': self.collect()}]
+        if os.path.isdir(directory):
+            for filename in sorted(os.listdir(directory)):
+                if not filename.endswith('.json') or filename == own:
+                    continue
+                try:
+                    with open(os.path.join(directory, filename)) as f:
+                        dumps.append(json.load(f))
+                except (IOError, ValueError):
+                    continue
+        #A pid may have been reused; only its latest start is alive.
+        latest = {}
+        for dumped in dumps:
+            latest[dumped['pid']] = max(
+                latest.get(dumped['pid'], 0), dumped.get('started', 0))
+        merged = {}
+        order = []
+        for dumped in dumps:
+            alive = dumped.get('started', 0) == latest[dumped['pid']] and \
+                _pid_alive(dumped['pid'])
+            for name, kind, doc, samples in dumped['metrics']:
+                if name not in merged:
+                    merged[name] = (kind, doc, OrderedDict())
+                    order.append(name)
+                values = merged[name][2]
+                for sample, labels, value in samples:
+                    if kind == 'gauge':
+                        if not alive:
+                            continue
+                        labels = labels + [['pid', dumped['pid']]]
+                    key = (sample, tuple(map(tuple, labels)))
+                    values[key] = values.get(key, 0) + value
+        return [(name, merged[name][0], merged[name][1],
+                 [[sample, labels, value]
+                  for (sample, labels), value in merged[name][2].items()])
+                for name in order]
+
+    def render(self):
+        lines = []
+        for name, kind, doc, samples in self.collect_all():
+            lines.append('# HELP %s %s' % (name, doc))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for sample, labels, value in samples:
+                lines.append('%s%s %s' % (
+                    sample, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def view(self):
+        if request.remote_addr not in self.app.config['METRICS_ALLOWED_IPS']:
+            abort(404)
+        return Response(
+            self.render(), content_type='text/plain; version=0.0.4')
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
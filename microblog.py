@@ -1,45 +1,152 @@
 from flask import Flask, render_template, request, \
-    redirect, url_for, flash, session
-from flask.ext.sqlalchemy import SQLAlchemy
-from flask.ext.script import Manager
-from flask.ext.migrate import Migrate, MigrateCommand
+    redirect, url_for, flash, session, get_flashed_messages, \
+    stream_with_context, Response, abort, send_file
 from flask.ext.seasurf import SeaSurf
 from flask.ext.mail import Mail, Message
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from passlib.hash import bcrypt
-from sqlalchemy import desc
+from sqlalchemy import desc, func, select, text, tuple_
+from sqlalchemy.orm import joinedload
+from jinja2 import FileSystemBytecodeCache, Template
+from werkzeug.wsgi import wrap_file
 from datetime import datetime
+from xml.sax.saxutils import escape
+import time
 from random import choice
 import string
-from gevent.wsgi import WSGIServer
+import sys
+import os
+import json
+import atexit
+import uuid
+from threading import Thread
+from routing import RoutingSQLAlchemy
+from compression import GzipMiddleware
+from sessions import ServerSideSessionInterface, MemoryBackend, \
+    DatabaseBackend, regenerate_session
+from fragments import FragmentCache
+from slugs import slugify, disambiguate, SlugIndex
+from accesslog import AccessLogger
+from metrics import Metrics
+from pubsub import Hub
+from counters import BufferedCounter
+from profiler import Diagnostics
+from httpcache import HttpCache, surrogate_key
+from idempotency import IdempotencyStore
+import assets
 
 app = Flask(__name__)
 app.config.from_pyfile('default_config.py')
 app.config.from_envvar('MICROBLOG_CONFIG', silent=True)
 
-db = SQLAlchemy(app)
+if app.config.get('JINJA_BYTECODE_CACHE_DIR'):
+    if not os.path.isdir(app.config['JINJA_BYTECODE_CACHE_DIR']):
+        os.makedirs(app.config['JINJA_BYTECODE_CACHE_DIR'])
+    app.jinja_options = dict(
+        app.jinja_options,
+        bytecode_cache=FileSystemBytecodeCache(
+            app.config['JINJA_BYTECODE_CACHE_DIR'])
+    )
 
-csrf = SeaSurf(app)
+db = RoutingSQLAlchemy(app)
 
-migrate = Migrate(app, db)
+csrf = SeaSurf(app)
 
 mail = Mail(app)
 
-manager = Manager(app)
-manager.add_command('db', MigrateCommand)
+asset_manifest = assets.load_manifest(app.static_folder)
+
+fragment_cache = FragmentCache(app)
+
+slug_index = SlugIndex(app.config['SLUG_INDEX_SIZE'])
+
+access_logger = AccessLogger(app)
+
+post_events = Hub(
+    maxlen=app.config['EVENT_STREAM_QUEUE_SIZE'],
+    max_subscribers=app.config['EVENT_STREAM_MAX_SUBSCRIBERS'],
+)
+
+metrics = Metrics(app)
+
+diagnostics = Diagnostics(app)
+
+http_cache = HttpCache(app)
+
+bcrypt_seconds = metrics.histogram(
+    'bcrypt_seconds', "Time spent hashing and verifying passwords.",
+    ('operation',), buckets=(.05, .1, .2, .3, .5, .75, 1, 2))
+
+mail_sent = metrics.counter(
+    'mail_sent_total', "Confirmation emails, by outcome.", ('outcome',))
+
+
+def _cache_stats():
+    return [(('fragment', 'hit'), fragment_cache.hits),
+            (('fragment', 'miss'), fragment_cache.misses),
+            (('slug', 'hit'), slug_index.hits),
+            (('slug', 'miss'), slug_index.misses)]
+
+metrics.callback(
+    'cache_requests_total', "In-process cache lookups, by result.",
+    'counter', _cache_stats, ('cache', 'result'))
+
+
+def _pool_stats():
+    stats = []
+    binds = [None] + sorted(app.config['SQLALCHEMY_BINDS'])
+    for bind in binds:
+        pool = db.get_engine(app, bind=bind).pool
+        for state in ('checkedout', 'checkedin', 'overflow'):
+            if hasattr(pool, state):
+                stats.append(((bind or 'primary', state),
+                              getattr(pool, state)()))
+    return stats
+
+metrics.callback(
+    'db_pool_connections', "Database connections, by bind and state.",
+    'gauge', _pool_stats, ('bind', 'state'))
+
+
+def _greenlet_stats():
+    #Only on a scrape, so walking the heap is an acceptable cost.
+    if 'greenlet' not in sys.modules:
+        return []
+    from greenlet import greenlet
+    import gc
+    return [((), sum(1 for obj in gc.get_objects()
+                     if isinstance(obj, greenlet)))]
+
+metrics.callback(
+    'greenlets', "Greenlets alive in the worker.", 'gauge', _greenlet_stats)
+
+if app.config['GZIP_RESPONSES']:
+    app.wsgi_app = GzipMiddleware(
+        app.wsgi_app,
+        minimum_size=app.config['GZIP_MIN_SIZE'],
+        level=app.config['GZIP_LEVEL'],
+    )
 
 
 class Post(db.Model):
     """A blog post."""
     __tablename__ = 'posts'
+    __table_args__ = (
+        db.Index(
+            'ix_posts_auth_id_timestamp_id', 'auth_id', 'timestamp', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(255), unique=True, nullable=False)
+    slug = db.Column(db.String(255), unique=True, nullable=False)
     body = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, nullable=False)
     auth_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    views = db.Column(
+        db.Integer, nullable=False, default=0, server_default='0')
 
     def __init__(self, title=None, body=None, auth_id=None):
         self.title = title
+        self.slug = slugify(title) if title else None
         self.body = body
         self.auth_id = auth_id
         self.timestamp = datetime.utcnow()
@@ -53,7 +160,12 @@ class User(db.Model):
     password = db.Column(db.String(255), nullable=False)
     email = db.Column(db.String(255), unique=True, nullable=False)
     timestamp = db.Column(db.DateTime, nullable=False)
-    posts = db.relationship('Post', backref="author")
+    post_count = db.Column(
+        db.Integer, nullable=False, default=0, server_default='0')
+    follower_count = db.Column(
+        db.Integer, nullable=False, default=0, server_default='0',
+        index=True)
+    posts = db.relationship('Post', backref="author", lazy='dynamic')
 
     def __init__(self, username=None, password=None, email=None):
         self.username = username
@@ -62,6 +174,72 @@ class User(db.Model):
         self.timestamp = datetime.utcnow()
 
 
+class SiteStat(db.Model):
+    """A sitewide counter, such as the total number of posts. Counters are
+    kept up to date by the functions that change what they count, so that
+    reading one is a primary key lookup rather than an aggregate."""
+    __tablename__ = 'site_stats'
+    name = db.Column(db.String(32), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+    def __init__(self, name=None, value=0):
+        self.name = name
+        self.value = value
+
+
+class PostKey(db.Model):
+    """A post's title and slug, kept unique here rather than on posts: a
+    partitioned posts table can't have unique constraints that leave out
+    its partition key, and archived posts must keep theirs."""
+    __tablename__ = 'post_keys'
+    slug = db.Column(db.String(255), primary_key=True)
+    title = db.Column(db.String(255), unique=True, nullable=False)
+    post_id = db.Column(db.Integer)
+
+
+class ArchivedPost(db.Model):
+    """A post moved out of posts by archive_posts. Archived posts are no
+    longer listed, but their permalinks still work."""
+    __tablename__ = 'posts_archive'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    title = db.Column(db.String(255), nullable=False)
+    slug = db.Column(db.String(255), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False)
+    auth_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    views = db.Column(
+        db.Integer, nullable=False, default=0, server_default='0')
+    author = db.relationship('User')
+
+
+class Follow(db.Model):
+    """One user following another."""
+    __tablename__ = 'follows'
+    __table_args__ = (
+        db.Index('ix_follows_followed_id', 'followed_id'),
+    )
+    follower_id = db.Column(
+        db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    followed_id = db.Column(
+        db.Integer, db.ForeignKey('users.id'), primary_key=True)
+
+    def __init__(self, follower_id=None, followed_id=None):
+        self.follower_id = follower_id
+        self.followed_id = followed_id
+
+
+class TimelineEntry(db.Model):
+    """A post in one follower's home timeline. Entries are written along
+    with the post, so reading a page of a timeline is a single range scan
+    of the primary key however many users the reader follows."""
+    __tablename__ = 'timelines'
+    user_id = db.Column(
+        db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    timestamp = db.Column(db.DateTime, primary_key=True)
+    post_id = db.Column(
+        db.Integer, db.ForeignKey('posts.id'), primary_key=True)
+
+
 class TempUser(db.Model):
     """A temporary user. These are created when a new user registers, but
     hasn't yet confirmed their registration.
@@ -83,22 +261,303 @@ class TempUser(db.Model):
             ''.join(choice(string.letters + string.digits) for i in range(32))
 
 
+class NotFoundError(SQLAlchemyError):
+    """Exception raised when the expected item is not present in a table
+    query response.
+    """
+    pass
+
+
+class StoredSession(db.Model):
+    """A server-side session, used when SESSION_BACKEND is 'database'."""
+    __tablename__ = 'sessions'
+    sid = db.Column(db.String(40), primary_key=True)
+    data = db.Column(db.Text, nullable=False)
+    expires = db.Column(db.DateTime, nullable=False, index=True)
+
+
+if app.config['SESSION_BACKEND'] == 'memory':
+    app.session_interface = ServerSideSessionInterface(MemoryBackend(
+        app.config['SESSION_STORE_TTL'],
+        maxsize=app.config['SESSION_MEMORY_SIZE'],
+        sweep_interval=app.config['SESSION_SWEEP_INTERVAL'],
+    ))
+elif app.config['SESSION_BACKEND'] == 'database':
+    app.session_interface = ServerSideSessionInterface(DatabaseBackend(
+        lambda: db.engine, StoredSession.__table__,
+        app.config['SESSION_STORE_TTL'],
+        sweep_interval=app.config['SESSION_SWEEP_INTERVAL'],
+    ))
+
+
+class IdempotencyKey(db.Model):
+    """The recorded response to a request made with an idempotency key.
+    status is null while the first request with the key is running."""
+    __tablename__ = 'idempotency_keys'
+    key = db.Column(db.String(255), primary_key=True)
+    fingerprint = db.Column(db.String(40), nullable=False)
+    status = db.Column(db.Integer)
+    headers = db.Column(db.Text)
+    body = db.Column(db.LargeBinary)
+    expires = db.Column(db.DateTime, nullable=False, index=True)
+
+
+idempotency_store = IdempotencyStore(
+    lambda: db.engine, IdempotencyKey.__table__,
+    app.config['IDEMPOTENCY_TTL'],
+    lock_timeout=app.config['IDEMPOTENCY_LOCK_TIMEOUT'],
+    sweep_interval=app.config['IDEMPOTENCY_SWEEP_INTERVAL'],
+)
+
+#Page views are counted in memory and written to posts.views in batches.
+view_counter = BufferedCounter(
+    lambda: db.engine, Post.__table__, 'views',
+    flush_interval=app.config['VIEW_COUNT_FLUSH_INTERVAL'],
+    flush_size=app.config['VIEW_COUNT_FLUSH_SIZE'],
+    top_size=app.config['VIEW_COUNT_TOP_SIZE'],
+    other_tables=(ArchivedPost.__table__,),
+)
+atexit.register(view_counter.flush)
+
+
+@app.template_global()
+def idempotency_key():
+    """A fresh key for a form, so that submitting it twice only acts once.
+    """
+    return uuid.uuid4().hex
+
+
+@app.template_global()
+def asset_url(filename):
+    """Return the URL of a static file, fingerprinted if build_assets has
+    been run, so that it can be cached indefinitely."""
+    return url_for(
+        'static', filename=asset_manifest.get(filename, filename))
+
+
+def stream_template(template_name, **context):
+    """Like render_template, but sends the page to the client as it is
+    rendered instead of building the whole string first."""
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    stream = template.stream(context)
+    stream.enable_buffering(app.config['STREAM_BUFFER_SIZE'])
+    stream = stream_with_context(stream)
+    #The session cookie is written before a streamed body is sent, so
+    #flashed messages have to be popped now rather than mid-render. This
+    #must come after stream_with_context, which reopens the session.
+    get_flashed_messages()
+    return Response(stream, mimetype='text/html')
+
+
+_static_urls = {}
+
+
+@app.template_global()
+def cached_url_for(endpoint):
+    """url_for for routes that take no arguments, memoized. The result
+    only depends on the endpoint and the script root it is served under.
+    """
+    key = (endpoint, request.script_root)
+    url = _static_urls.get(key)
+    if url is None:
+        url = _static_urls[key] = url_for(endpoint)
+    return url
+
+
+@app.template_global()
+def login_header():
+    """The "Logged in as..." header, rendered once per login state."""
+    logged_in = session.get('logged_in', False)
+    username = session.get('username') if logged_in else None
+    return fragment_cache.render(
+        '_login_header.html', (logged_in, username, request.script_root),
+        logged_in=logged_in, username=username
+    )
+
+
+@app.template_global()
+def flash_block():
+    """The list of flashed messages; empty when there are none, which is
+    the case for almost every page view."""
+    messages = tuple(get_flashed_messages())
+    if not messages:
+        return u''
+    return fragment_cache.render(
+        '_flashes.html', messages, messages=messages)
+
+
+@app.template_global()
+def most_viewed(count=5):
+    """Links to the most viewed posts, as approximately counted by this
+    process. Rendered once per distinct list of posts."""
+    ids = tuple(view_counter.top.top(count))
+    if not ids:
+        return u''
+    return fragment_cache.render(
+        '_most_viewed.html', (ids, request.script_root),
+        posts=_posts_in_order(ids))
+
+
+def _posts_in_order(ids):
+    #A generator, so that the posts are only read when the fragment isn't
+    #already cached.
+    with db.replica():
+        posts = dict((post.id, post) for post in
+                     Post.query.filter(Post.id.in_(ids)))
+    for id in ids:
+        if id in posts:
+            yield posts[id]
+
+
+@app.before_request
+def read_refreshes_from_primary():
+    #A page refreshed in the HTTP cache right after a commit would stay
+    #stale there if it were read from a lagging replica.
+    if http_cache.is_refresh():
+        db.session().primary_only = True
+
+
+@http_cache.resolver('home')
+def _home_paths():
+    return [http_cache.url_for('list_view')]
+
+
+@http_cache.resolver('author')
+def _author_paths(username):
+    return [http_cache.url_for('author_view', username=username)]
+
+
+@http_cache.resolver('post')
+def _post_paths(id):
+    post = read_post(int(id))
+    return [http_cache.url_for('permalink_view', id=post.id),
+            http_cache.url_for('permalink_view', slug=post.slug)]
+
+
 @app.route("/")
+@csrf.exempt
 def list_view():
     """The home page: a list of all posts in reverse chronological order.
     """
+    http_cache.tag(surrogate_key('home'))
+    post_total = read_stat('posts')
+    if app.config['STREAM_LIST_VIEW']:
+        posts = read_posts(yield_per=app.config['STREAM_BATCH_SIZE'])
+        return stream_template(
+            'list.html', posts=posts, post_total=post_total)
     posts = read_posts()
-    return render_template('list.html', posts=posts)
+    return render_template('list.html', posts=posts, post_total=post_total)
+
+
+@app.route("/posts/<int:id>")
+@app.route("/posts/<slug>")
+@csrf.exempt
+def permalink_view(id=None, slug=None):
+    """Fetch and render a single blog post, by its id or its slug."""
+    if slug is not None:
+        post = read_post_by_slug(slug)
+    else:
+        post = read_post(id)
+    http_cache.tag(surrogate_key('post', post.id))
+    #Behind nginx's cache, views are counted by viewed_view instead.
+    if not request.headers.get('X-View-Counted'):
+        view_counter.add(post.id)
+    return render_template(
+        'permalink.html', post=post,
+        views=post.views + view_counter.get_pending(post.id))
+
+
+@app.route("/viewed/posts/<int:id>")
+@app.route("/viewed/posts/<slug>")
+@csrf.exempt
+def viewed_view(id=None, slug=None):
+    """Count a view of a post without rendering it. nginx mirrors every
+    request for a post here, including those it answers from its cache."""
+    if slug is not None:
+        post_id = read_post_by_slug(slug).id
+    elif _post_may_exist(id):
+        post_id = id
+    else:
+        abort(404)
+    view_counter.add(post_id)
+    return '', 204
 
 
-@app.route("/posts/<id>")
-def permalink_view(id):
-    """Fetch and render a single blog post."""
-    post = read_post(id)
-    return render_template('permalink.html', post=post)
+@app.route("/users/<username>")
+@csrf.exempt
+def author_view(username):
+    """A single author's posts in reverse chronological order, a page at
+    a time. The 'before' query argument is the cursor of the last post on
+    the previous page."""
+    with db.replica():
+        author = User.query.filter_by(username=username).first()
+    if author is None:
+        abort(404)
+    try:
+        before = decode_cursor(request.args.get('before'))
+    except ValueError:
+        abort(404)
+    http_cache.tag(surrogate_key('author', author.username))
+
+    count = app.config['POSTS_PER_PAGE']
+    posts = read_posts_by_author(author.id, before=before, count=count + 1)
+    next_cursor = None
+    if len(posts) > count:
+        posts = posts[:count]
+        next_cursor = encode_cursor(posts[-1])
+    following = session.get('logged_in', False) and Follow.query.get(
+        (session['user_id'], author.id)) is not None
+    return render_template(
+        'author.html', author=author, posts=posts, next_cursor=next_cursor,
+        following=following)
+
+
+@app.route("/users/<username>/follow", methods=['POST'])
+def follow_view(username):
+    """Follow a user, or stop following them if the form's 'unfollow'
+    field is set."""
+    if not session.get('logged_in', False):
+        return redirect(url_for('login_view'))
+    author = User.query.filter_by(username=username).first()
+    if author is None:
+        abort(404)
+    if request.form.get('unfollow'):
+        unfollow(session['user_id'], author.id)
+    else:
+        try:
+            follow(session['user_id'], author.id)
+        except ValueError as e:
+            for message in e.message:
+                flash(message)
+    #The author page shows the follower count.
+    http_cache.purge(surrogate_key('author', username))
+    return redirect(url_for('author_view', username=username))
+
+
+@app.route("/timeline")
+def timeline_view():
+    """The logged in user's home timeline: posts by the users they follow,
+    newest first, a page at a time."""
+    if not session.get('logged_in', False):
+        return redirect(url_for('login_view'))
+    try:
+        before = decode_cursor(request.args.get('before'))
+    except ValueError:
+        abort(404)
+
+    count = app.config['POSTS_PER_PAGE']
+    posts = read_timeline(session['user_id'], before=before, count=count + 1)
+    next_cursor = None
+    if len(posts) > count:
+        posts = posts[:count]
+        next_cursor = encode_cursor(posts[-1])
+    return render_template(
+        'timeline.html', posts=posts, next_cursor=next_cursor)
 
 
 @app.route("/add", methods=['GET', 'POST'])
+@idempotency_store.idempotent
 def add_view():
     """Add a new post. If the request method is GET, returns a form that
     allows the user to add a new post. If the request method is POST,
@@ -112,11 +571,14 @@ def add_view():
                     request.form['body'],
                     session.get('user_id', None),
                 )
+            except ValueError as e:
+                for message in e.message:
+                    flash(message, category="error")
+                return redirect(url_for('add_view'))
             except IntegrityError:
-                flash(
-                    "Posts must have a title and a body.",
-                    category="error"
-                )
+                #The session's user may have been deleted since logging in.
+                db.session.rollback()
+                flash("Posts must have an existing author.", category="error")
                 return redirect(url_for('add_view'))
             return redirect(url_for('list_view'))
         else:
@@ -129,11 +591,15 @@ def add_view():
 def login_view():
     """Allows a user to log in."""
     if request.method == 'POST':
-        user = User.query.filter_by(username=request.form['username']).first()
-        if not user:
-            user = TempUser.query.filter_by(
+        with db.replica():
+            user = User.query.filter_by(
                 username=request.form['username']).first()
+            temp_user = None
             if not user:
+                temp_user = TempUser.query.filter_by(
+                    username=request.form['username']).first()
+        if not user:
+            if not temp_user:
                 flash("This user does not exist.", category="error")
             else:
                 message = "This username is registered, but not confirmed. "
@@ -142,7 +608,8 @@ def login_view():
                 message += "registration before you can use your account."
                 flash(message, category='error')
             return redirect(url_for('login_view'))
-        elif bcrypt.verify(request.form['password'], user.password):
+        elif verify_password(request.form['password'], user.password):
+            regenerate_session(session)
             session['logged_in'] = True
             session['username'] = user.username
             session['user_id'] = user.id
@@ -157,14 +624,14 @@ def login_view():
 @app.route("/logout")
 def logout_view():
     """Logs a user out."""
-    session.pop('logged_in', None)
-    session.pop('username', None)
-    session.pop('user_id', None)
+    session.clear()
+    regenerate_session(session)
 
     return redirect(url_for('list_view'))
 
 
 @app.route("/register", methods=['GET', 'POST'])
+@idempotency_store.idempotent
 def register_view():
     """Allows a user to register for membership."""
     if request.method == 'POST':
@@ -198,7 +665,12 @@ If you did not register for a Flask Microblog account, you can safely ignore thi
     regkey=TempUser.query.filter_by(username=request.form['username']).
                                     first().regkey,
     _external=True)
-            mail.send(msg)
+            try:
+                mail.send(msg)
+            except Exception:
+                mail_sent.inc(('failed',))
+                raise
+            mail_sent.inc(('sent',))
             return render_template(
                 'confirmation_instructions.html',
                 email=request.form['email']
@@ -228,40 +700,671 @@ def confirm_view(regkey):
     return render_template('confirm.html', user=temp_user)
 
 
+@app.route("/stream")
+def stream_view():
+    """A Server-Sent Events stream of new posts, pushed as they are
+    written; posts written by other workers arrive within
+    EVENT_STREAM_POLL_INTERVAL seconds. A reconnecting client's Last-Event-ID header is used to replay
+    the posts it missed. While no post arrives, a comment is sent every
+    EVENT_STREAM_HEARTBEAT seconds; that keeps proxies from timing the
+    connection out, and writing it to a dead socket ends the stream."""
+    subscription = post_events.subscribe()
+    if subscription is None:
+        abort(503)
+    start_event_poller()
+    try:
+        last_id = int(request.headers.get('Last-Event-ID', ''))
+    except ValueError:
+        last_id = None
+    try:
+        missed = read_posts_since(last_id) if last_id is not None else []
+    except Exception:
+        subscription.close()
+        raise
+    heartbeat = app.config['EVENT_STREAM_HEARTBEAT']
+
+    def stream():
+        try:
+            yield 'retry: %d\n\n' % (heartbeat * 1000)
+            seen = last_id or 0
+            for post in missed:
+                seen = post.id
+                yield post_event(post.id, post.title, post.slug,
+                                 post.author.username, post.timestamp)
+            while True:
+                messages = subscription.get(heartbeat)
+                if not messages:
+                    yield ': heartbeat\n\n'
+                for id, event in messages:
+                    if id > seen:
+                        yield event
+        finally:
+            subscription.close()
+
+    response = Response(stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@app.route("/sitemap.xml")
+def sitemap_index_view():
+    """A sitemap index pointing at one sitemap per SITEMAP_CHUNK_SIZE post
+    ids."""
+    lines = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">',
+    ]
+    for chunk in range(count_sitemap_chunks()):
+        lines.append('<sitemap><loc>%s</loc></sitemap>' % escape(
+            url_for('sitemap_view', chunk=chunk, _external=True)))
+    lines.append('</sitemapindex>')
+    return Response('\n'.join(lines), mimetype='application/xml')
+
+
+@app.route("/sitemap-<int:chunk>.xml")
+def sitemap_view(chunk):
+    """One chunk of the sitemap, served from the sitemap cache and written
+    to it first if it isn't there."""
+    if chunk >= count_sitemap_chunks():
+        abort(404)
+    path = sitemap_chunk_path(chunk)
+    if not os.path.exists(path):
+        return Response(
+            wrap_file(request.environ, write_sitemap_chunk(chunk, path)),
+            mimetype='application/xml', direct_passthrough=True)
+    return send_file(path, mimetype='application/xml')
+
+
 @app.errorhandler(404)
 def page_not_found(error):
     return 'Attempted to access %s' % format(request.url), 404
 
 
+@app.errorhandler(NotFoundError)
+def item_not_found(error):
+    return page_not_found(error)
+
+
+INSERT_POST_KEY = "INSERT INTO post_keys (slug, title) " \
+    "VALUES (:slug, :title) ON CONFLICT DO NOTHING"
+
+INSERT_POST = "INSERT INTO posts (title, slug, body, timestamp, auth_id) " \
+    "VALUES (:title, :slug, :body, :timestamp, :auth_id)"
+
+#Creates the counter on first use without racing another writer doing the
+#same.
+INCREMENT_STAT = "INSERT INTO site_stats (name, value) " \
+    "VALUES (:name, :amount) ON CONFLICT (name) " \
+    "DO UPDATE SET value = site_stats.value + excluded.value"
+
+#Copies a new post into its author's followers' timelines, unless the
+#author has too many followers to make that worthwhile (see read_timeline).
+FAN_OUT_POST = "INSERT INTO timelines (user_id, timestamp, post_id) " \
+    "SELECT follower_id, :timestamp, :post_id FROM follows " \
+    "WHERE followed_id = :auth_id AND " \
+    "(SELECT follower_count FROM users WHERE id = :auth_id) <= :fan_out_limit"
+
+#Copies an author's most recent posts into a new follower's timeline.
+BACKFILL_TIMELINE = "INSERT INTO timelines (user_id, timestamp, post_id) " \
+    "SELECT :user_id, timestamp, id FROM posts " \
+    "WHERE auth_id = :auth_id AND " \
+    "(SELECT follower_count FROM users WHERE id = :auth_id) " \
+    "<= :fan_out_limit ORDER BY timestamp DESC LIMIT :limit"
+
+#Copies an author's most recent posts into the timelines of all of their
+#followers that don't have them yet, for when the author falls back under
+#the fan out limit and read_timeline stops pulling their posts in.
+BACKFILL_FOLLOWERS = "INSERT INTO timelines (user_id, timestamp, post_id) " \
+    "SELECT follows.follower_id, posts.timestamp, posts.id " \
+    "FROM follows JOIN posts ON posts.auth_id = follows.followed_id " \
+    "WHERE follows.followed_id = :auth_id AND posts.id IN " \
+    "(SELECT id FROM posts WHERE auth_id = :auth_id " \
+    "ORDER BY timestamp DESC LIMIT :limit) AND NOT EXISTS " \
+    "(SELECT 1 FROM timelines WHERE timelines.user_id = follows.follower_id " \
+    "AND timelines.post_id = posts.id)"
+
+
 def write_post(title=None, body=None, auth_id=None):
-    """Create a new blog post."""
+    """Create a new blog post and return its id. Raises ValueError with a
+    list of messages if a required field is missing or the title is
+    already taken."""
+    messages = []
     if not title:
-        title = None
+        messages.append("Posts must have a title.")
     if not body:
-        body = None
+        messages.append("Posts must have a body.")
     if not auth_id:
-        auth_id = None
+        messages.append("Posts must have an author.")
+    if messages:
+        raise ValueError(messages)
+
+    #The title and slug are claimed in post_keys before the post is
+    #inserted. A duplicate is detected by that insert itself rather than by
+    #an IntegrityError, so it costs neither a failed transaction nor a
+    #rollback.
+    params = {
+        'title': title,
+        'slug': slugify(title),
+        'body': body,
+        'timestamp': datetime.utcnow(),
+        'auth_id': auth_id,
+    }
+    if not _claim_post_key(params):
+        if PostKey.query.filter_by(title=title).first() is not None:
+            raise ValueError(["A post with this title already exists."])
+        #Two different titles can share a slug ("Hello!" and "Hello?"); the
+        #later one gets a suffix derived from its title.
+        params['slug'] = disambiguate(params['slug'], title)
+        if not _claim_post_key(params):
+            raise ValueError(["A post with this title already exists."])
+    post_id = _insert_post(params)
+    PostKey.query.filter_by(slug=params['slug']).update(
+        {PostKey.post_id: post_id}, synchronize_session=False)
+
+    #The counters are bumped in the same transaction as the insert, so they
+    #can never disagree with the posts table.
+    User.query.filter_by(id=auth_id).update(
+        {User.post_count: User.post_count + 1}, synchronize_session=False)
+    _increment_stat('posts')
+    db.session.execute(text(FAN_OUT_POST), {
+        'timestamp': params['timestamp'],
+        'post_id': post_id,
+        'auth_id': auth_id,
+        'fan_out_limit': app.config['TIMELINE_FAN_OUT_LIMIT'],
+    })
+    db.session.commit()
+    slug_index.add(params['slug'], post_id)
+    _note_post_id(post_id)
+    invalidate_sitemap(post_id)
+    username = db.session.query(User.username).filter_by(id=auth_id).scalar()
+    if username is not None:
+        http_cache.purge(
+            surrogate_key('home'), surrogate_key('author', username))
+    if app.config['SNAPSHOT_DIR']:
+        import snapshot
+        thread = Thread(target=snapshot.refresh, args=(
+            app.config['SNAPSHOT_DIR'], post_id, auth_id))
+        thread.daemon = True
+        thread.start()
+    if post_events.subscriptions:
+        publish_post(
+            post_id, title, params['slug'], username, params['timestamp'])
+    return post_id
+
+
+#The highest post id polled for, and the ids above it this process has
+#already published itself.
+_published = {'last_id': None, 'ids': set(), 'poller_pid': None}
+
+
+def publish_post(id, title, slug, username, timestamp):
+    """Push a new post to this process's /stream clients, unless it has
+    already been."""
+    if id in _published['ids']:
+        return
+    _published['ids'].add(id)
+    post_events.publish(
+        (id, post_event(id, title, slug, username, timestamp)))
+
+
+def poll_post_events():
+    """Publish the posts written since the last poll that this process
+    hasn't published itself, which are those written by other workers.
+    Every worker has its own hub, so without this a /stream client would
+    only see the posts written by the worker it is connected to."""
+    if not post_events.subscriptions:
+        _published['last_id'] = None
+        return
+    if _published['last_id'] is None:
+        _published['last_id'] = \
+            db.session.query(func.max(Post.id)).scalar() or 0
+        return
+    db.session().primary_only = True
+    posts = read_posts_since(_published['last_id'])
+    for post in posts:
+        publish_post(post.id, post.title, post.slug, post.author.username,
+                     post.timestamp)
+    if posts:
+        _published['last_id'] = posts[-1].id
+    for id in [id for id in _published['ids']
+               if id <= _published['last_id']]:
+        _published['ids'].discard(id)
+
+
+def start_event_poller():
+    """Run poll_post_events every EVENT_STREAM_POLL_INTERVAL seconds in
+    the background. Workers are forked after the app is created, so this
+    is done by each worker when its first client subscribes."""
+    if not app.config['EVENT_STREAM_POLL_INTERVAL'] or \
+            _published['poller_pid'] == os.getpid():
+        return
+    _published['poller_pid'] = os.getpid()
+    thread = Thread(target=_run_event_poller)
+    thread.daemon = True
+    thread.start()
+
+
+def _run_event_poller():
+    pid = os.getpid()
+    while _published['poller_pid'] == pid:
+        time.sleep(app.config['EVENT_STREAM_POLL_INTERVAL'])
+        try:
+            with app.app_context():
+                poll_post_events()
+        except Exception:
+            app.logger.exception("Could not poll for new posts")
+
+
+def post_event(id, title, slug, username, timestamp):
+    """Format a post as a Server-Sent Event. A new post's event is
+    formatted once, when it is published, and shared by every subscriber.
+    """
+    data = {
+        'id': id,
+        'title': title,
+        'slug': slug,
+        'author': username,
+        'timestamp': timestamp.isoformat(),
+    }
+    return 'id: %d\nevent: post\ndata: %s\n\n' % (
+        id, json.dumps(data, separators=(',', ':')))
+
+
+def read_posts_since(id):
+    """Retrieve up to EVENT_STREAM_REPLAY of the posts written after the
+    post with the given id, oldest first."""
+    with db.replica():
+        return Post.query.options(joinedload(Post.author)).\
+            filter(Post.id > id).order_by(Post.id).\
+            limit(app.config['EVENT_STREAM_REPLAY']).all()
 
-    new_post = Post(title, body, auth_id)
 
-    db.session.add(new_post)
+def _claim_post_key(params):
+    """Record a post's title and slug, returning False if either is taken.
+    """
+    return db.session.execute(text(INSERT_POST_KEY), params).rowcount == 1
+
+
+def _insert_post(params):
+    """Insert a post and return its id."""
+    if db.engine.dialect.name == 'postgresql':
+        return db.session.execute(
+            text(INSERT_POST + " RETURNING id"), params).scalar()
+    return db.session.execute(text(INSERT_POST), params).lastrowid
+
+
+def _increment_stat(name, amount=1):
+    db.session.execute(
+        text(INCREMENT_STAT), {'name': name, 'amount': amount})
+
+
+def read_stat(name):
+    """Retrieve the value of a sitewide counter."""
+    with db.replica():
+        stat = SiteStat.query.get(name)
+    return stat.value if stat else 0
+
+
+def rebuild_counters():
+    """Recompute every user's post_count and follower_count, and the
+    sitewide post total, from the posts and follows tables. Archived posts
+    are still counted."""
+    limit = app.config['TIMELINE_FAN_OUT_LIMIT']
+    popular = [row.id for row in db.session.query(User.id).filter(
+        User.follower_count > limit)]
+    User.query.update(
+        {User.post_count: select([func.count(Post.id)]).
+            where(Post.auth_id == User.id).as_scalar() +
+            select([func.count(ArchivedPost.id)]).
+            where(ArchivedPost.auth_id == User.id).as_scalar(),
+         User.follower_count: select([func.count(Follow.follower_id)]).
+            where(Follow.followed_id == User.id).as_scalar()},
+        synchronize_session=False
+    )
+    #See unfollow.
+    if popular:
+        for row in db.session.query(User.id).filter(
+                User.id.in_(popular), User.follower_count <= limit):
+            db.session.execute(text(BACKFILL_FOLLOWERS), {
+                'auth_id': row.id,
+                'limit': app.config['TIMELINE_BACKFILL'],
+            })
+    total = db.session.query(func.count(Post.id)).scalar() + \
+        db.session.query(func.count(ArchivedPost.id)).scalar()
+    stat = SiteStat.query.get('posts')
+    if stat:
+        stat.value = total
+    else:
+        db.session.add(SiteStat('posts', total))
     db.session.commit()
+    print "Counted %d posts." % total
 
 
-def read_posts():
-    """Retrieve all blog posts in reverse chronological order."""
-    posts = Post.query.order_by(desc(Post.timestamp)).all()
+def read_posts(yield_per=None):
+    """Retrieve all blog posts in reverse chronological order. If yield_per
+    is given, return a generator that fetches the posts from a server-side
+    cursor that many at a time, rather than a list."""
+    if yield_per:
+        return _stream_posts(yield_per)
+    with db.replica():
+        posts = Post.query.order_by(desc(Post.timestamp)).all()
     return posts
 
 
+def _stream_posts(yield_per):
+    with db.replica():
+        query = Post.query.options(joinedload(Post.author)).\
+            order_by(desc(Post.timestamp)).\
+            execution_options(stream_results=True).\
+            yield_per(yield_per)
+        for post in query:
+            yield post
+
+
+def read_posts_page(before=None, count=None):
+    """Retrieve up to count posts in reverse chronological order, paginated
+    like read_posts_by_author."""
+    query = _page(Post.query.options(joinedload(Post.author)),
+                  Post.timestamp, Post.id, before, count)
+    with db.replica():
+        return query.all()
+
+
+def read_posts_by_author(auth_id, before=None, count=None):
+    """Retrieve up to count of an author's posts in reverse chronological
+    order. If before is given, as a (timestamp, id) pair, only posts that
+    come after that position are returned, so that each page is a single
+    range scan of the (auth_id, timestamp) index however deep it is."""
+    query = _page(Post.query.filter_by(auth_id=auth_id),
+                  Post.timestamp, Post.id, before, count)
+    with db.replica():
+        return query.all()
+
+
+def _page(query, timestamp_column, id_column, before, count):
+    """Limit query to the count rows that follow the (timestamp, id)
+    position before, newest first. The position is compared as a row
+    value, which an index ending in (timestamp, id) answers with a single
+    range scan."""
+    if before is not None:
+        query = query.filter(
+            tuple_(timestamp_column, id_column) < tuple_(*before))
+    query = query.order_by(desc(timestamp_column), desc(id_column))
+    if count is not None:
+        query = query.limit(count)
+    return query
+
+
+def read_timeline(user_id, before=None, count=None):
+    """Retrieve up to count posts from a user's home timeline, newest
+    first, paginated like read_posts_by_author.
+
+    Most posts were copied into the timelines table when they were written.
+    Authors with more than TIMELINE_FAN_OUT_LIMIT followers are not fanned
+    out; their posts are pulled from the posts table here instead and
+    merged in. Both are bounded by count, so a page costs the same however
+    many users are followed."""
+    with db.replica():
+        query = Post.query.options(joinedload(Post.author)).join(
+            TimelineEntry, TimelineEntry.post_id == Post.id).\
+            filter(TimelineEntry.user_id == user_id)
+        posts = _page(query, TimelineEntry.timestamp,
+                      TimelineEntry.post_id, before, count).all()
+
+        popular = _popular_authors()
+        if popular:
+            followed = [row.followed_id for row in db.session.query(
+                Follow.followed_id).filter(
+                    Follow.follower_id == user_id,
+                    Follow.followed_id.in_(popular))]
+            if followed:
+                query = Post.query.options(joinedload(Post.author)).\
+                    filter(Post.auth_id.in_(followed))
+                posts.extend(_page(
+                    query, Post.timestamp, Post.id, before, count))
+
+    #An author who has become popular may have older posts in both.
+    posts = dict((post.id, post) for post in posts).values()
+    posts.sort(key=lambda post: (post.timestamp, post.id), reverse=True)
+    return posts[:count]
+
+
+_popular = {'ids': (), 'checked': 0}
+
+
+def _popular_authors():
+    """Return the ids of the users whose posts are not fanned out, as of at
+    most TIMELINE_POPULAR_TTL seconds ago."""
+    now = time.time()
+    if now - _popular['checked'] >= app.config['TIMELINE_POPULAR_TTL']:
+        _popular['checked'] = now
+        query = db.session.query(User.id).filter(
+            User.follower_count > app.config['TIMELINE_FAN_OUT_LIMIT'])
+        _popular['ids'] = tuple(row.id for row in query)
+    return _popular['ids']
+
+
+def follow(follower_id, followed_id):
+    """Make one user follow another, copying the followed user's most
+    recent posts into the follower's timeline. Following a user twice does
+    nothing."""
+    if follower_id == followed_id:
+        raise ValueError(["You can't follow yourself."])
+    if Follow.query.get((follower_id, followed_id)) is not None:
+        return
+    db.session.add(Follow(follower_id, followed_id))
+    User.query.filter_by(id=followed_id).update(
+        {User.follower_count: User.follower_count + 1},
+        synchronize_session=False)
+    db.session.execute(text(BACKFILL_TIMELINE), {
+        'user_id': follower_id,
+        'auth_id': followed_id,
+        'fan_out_limit': app.config['TIMELINE_FAN_OUT_LIMIT'],
+        'limit': app.config['TIMELINE_BACKFILL'],
+    })
+    db.session.commit()
+
+
+def unfollow(follower_id, followed_id):
+    """Stop one user following another, removing the followed user's posts
+    from the follower's timeline. If that takes the followed user back down
+    to TIMELINE_FAN_OUT_LIMIT followers, the posts they wrote while above
+    it are copied into their remaining followers' timelines, as far back
+    as a new follower's would be."""
+    deleted = Follow.query.filter_by(
+        follower_id=follower_id, followed_id=followed_id).delete(
+            synchronize_session=False)
+    if not deleted:
+        return
+    User.query.filter_by(id=followed_id).update(
+        {User.follower_count: User.follower_count - 1},
+        synchronize_session=False)
+    TimelineEntry.query.filter(
+        TimelineEntry.user_id == follower_id,
+        TimelineEntry.post_id.in_(
+            select([Post.id]).where(Post.auth_id == followed_id))
+    ).delete(synchronize_session=False)
+    follower_count = db.session.query(User.follower_count).\
+        filter_by(id=followed_id).scalar()
+    if follower_count == app.config['TIMELINE_FAN_OUT_LIMIT']:
+        db.session.execute(text(BACKFILL_FOLLOWERS), {
+            'auth_id': followed_id,
+            'limit': app.config['TIMELINE_BACKFILL'],
+        })
+    db.session.commit()
+
+
+CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+def encode_cursor(post):
+    """Encode a post's position in a listing as a pagination cursor."""
+    return '%s-%d' % (post.timestamp.strftime(CURSOR_FORMAT), post.id)
+
+
+def decode_cursor(cursor):
+    """Decode a cursor made by encode_cursor into a (timestamp, id) pair.
+    Returns None for an empty cursor; raises ValueError for a bad one."""
+    if not cursor:
+        return None
+    timestamp, id = cursor.split('-')
+    return datetime.strptime(timestamp, CURSOR_FORMAT), int(id)
+
+
 def read_post(id):
     """Retrieve a single post by its id."""
-    post = Post.query.filter_by(id=str(id)).first()
+    if not _post_may_exist(id):
+        raise NotFoundError("There exists no post with the specified id.")
+    with db.replica():
+        post = Post.query.get(int(id))
+        if post is None:
+            post = ArchivedPost.query.get(int(id))
     if post is None:
         raise NotFoundError("There exists no post with the specified id.")
     return post
 
 
+def read_post_by_slug(slug):
+    """Retrieve a single post by its slug. Slugs that have been seen before
+    are resolved to an id in memory, so only the primary key lookup goes
+    to the database."""
+    id = slug_index.get(slug)
+    if id is None:
+        with db.replica():
+            row = db.session.query(PostKey.post_id).\
+                filter_by(slug=slug).first()
+        if row is None or row.post_id is None:
+            raise NotFoundError("There exists no post with the specified slug.")
+        id = row.post_id
+        slug_index.add(slug, id)
+    return read_post(id)
+
+
+_max_post_id = {'id': None, 'checked': 0}
+
+
+def _note_post_id(id):
+    if _max_post_id['id'] is None or id > _max_post_id['id']:
+        _max_post_id['id'] = id
+
+
+def _post_may_exist(id):
+    """Return False if id is certainly not a post's id: ids start at 1, and
+    ids above the highest one this process knows of are only checked
+    against the database once every MAX_POST_ID_TTL seconds, so scanning
+    for unknown ids never reaches the database."""
+    if id < 1:
+        return False
+    if _max_post_id['id'] is not None and id <= _max_post_id['id']:
+        return True
+    now = time.time()
+    if now - _max_post_id['checked'] >= app.config['MAX_POST_ID_TTL']:
+        _max_post_id['checked'] = now
+        #Archived posts keep their ids, which may be above any live one.
+        with db.replica():
+            _note_post_id(max(
+                db.session.query(func.max(Post.id)).scalar(),
+                db.session.query(func.max(ArchivedPost.id)).scalar()) or 0)
+    return id <= _max_post_id['id']
+
+
+def count_sitemap_chunks():
+    """Return the number of sitemap chunks needed to cover every post."""
+    with db.replica():
+        max_id = max(db.session.query(func.max(Post.id)).scalar(),
+                     db.session.query(func.max(ArchivedPost.id)).scalar())
+    max_id = max_id or 0
+    size = app.config['SITEMAP_CHUNK_SIZE']
+    return (max_id + size - 1) // size
+
+
+def sitemap_chunk_path(chunk):
+    """Return the path a sitemap chunk is cached at."""
+    cache_dir = app.config['SITEMAP_CACHE_DIR'] or \
+        os.path.join(app.instance_path, 'sitemaps')
+    return os.path.join(cache_dir, 'sitemap-%d.xml' % chunk)
+
+
+def write_sitemap_chunk(chunk, path):
+    """Write the sitemap for the posts, archived or not, whose ids fall in
+    the given chunk, in id order, and return it as an open file. Posts are
+    streamed from a server-side cursor, so memory use doesn't grow with the
+    chunk size. The file is written under a temporary name and renamed
+    into place, so readers never see a partial sitemap. If the chunk is
+    invalidated while it is written, the file may be missing the new post,
+    so it isn't left in the cache."""
+    size = app.config['SITEMAP_CHUNK_SIZE']
+    #Every permalink differs only in its slug; building one URL and reusing
+    #its prefix is far cheaper than a url_for call per post.
+    prefix = url_for('permalink_view', slug='-', _external=True)[:-1]
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    generation = _sitemap_generation(path)
+    with db.replica():
+        rows = db.session.query(Post.id, Post.slug, Post.timestamp).\
+            filter(Post.id > chunk * size, Post.id <= (chunk + 1) * size).\
+            union_all(db.session.query(
+                ArchivedPost.id, ArchivedPost.slug,
+                ArchivedPost.timestamp).filter(
+                    ArchivedPost.id > chunk * size,
+                    ArchivedPost.id <= (chunk + 1) * size)).\
+            order_by(Post.id).\
+            execution_options(stream_results=True).\
+            yield_per(1000)
+        with open(temp_path, 'w') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n<urlset '
+                    'xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+            for id, slug, timestamp in rows:
+                f.write('<url><loc>%s%s</loc><lastmod>%s</lastmod></url>\n'
+                        % (escape(prefix), slug, timestamp.strftime('%Y-%m-%d')))
+            f.write('</urlset>\n')
+    f = open(temp_path, 'rb')
+    if _sitemap_generation(path) == generation:
+        os.rename(temp_path, path)
+        #invalidate_sitemap may have run between the check and the rename,
+        #finding nothing to remove.
+        if _sitemap_generation(path) == generation:
+            return f
+    for stale_path in (temp_path, path):
+        try:
+            os.remove(stale_path)
+        except OSError:
+            pass
+    return f
+
+
+def _sitemap_generation(path):
+    #A token replaced whenever the chunk is invalidated. File times are
+    #too coarse to tell whether that happened during a write.
+    try:
+        with open(path + '.generation') as f:
+            return f.read()
+    except IOError:
+        return ''
+
+
+def invalidate_sitemap(post_id):
+    """Drop the cached sitemap chunk that holds the given post, and start a
+    new generation of it, so that a worker writing it at the time doesn't
+    cache what it wrote."""
+    chunk = (post_id - 1) // app.config['SITEMAP_CHUNK_SIZE']
+    path = sitemap_chunk_path(chunk)
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+    temp_path = '%s.generation.%d.tmp' % (path, os.getpid())
+    try:
+        with open(temp_path, 'w') as f:
+            f.write(uuid.uuid4().hex)
+        os.rename(temp_path, path + '.generation')
+    except (IOError, OSError):
+        #Nothing has been cached yet.
+        pass
+
+
 def add_user(username=None, password=None, email=None, confirm=True, key=None):
     """Add a new user to the database's 'user' table. If confirm is
     specified as false, we skip the confirmation step for this user and
@@ -282,7 +1385,9 @@ def add_user(username=None, password=None, email=None, confirm=True, key=None):
     if messages:
         raise ValueError(messages)
 
-    #If form input was good, assure that the necessary fields are unique
+    #If form input was good, assure that the necessary fields are unique.
+    #These checks deliberately stay on the primary: a lagging replica would
+    #let a duplicate through to the regkey retry loop below.
     #Check the users table...
     for user in [User.query.filter_by(username=username).first(),
                  TempUser.query.filter_by(username=username).first()]:
@@ -301,7 +1406,7 @@ def add_user(username=None, password=None, email=None, confirm=True, key=None):
         raise ValueError(messages)
 
     if confirm:
-        new_user = TempUser(username, bcrypt.encrypt(password), email)
+        new_user = TempUser(username, hash_password(password), email)
         if key:
             new_user.regkey = key
         #The only field left unvalidated is the reg_key field. We'll attempt
@@ -312,27 +1417,173 @@ def add_user(username=None, password=None, email=None, confirm=True, key=None):
                 db.session.commit()
             except IntegrityError:
                 db.session.rollback()
-                new_user = TempUser(username, bcrypt.encrypt(password), email)
+                new_user = TempUser(username, hash_password(password), email)
                 #new_user.generate_reg_key()
                 continue
             else:
                 break
     else:
         if not bcrypt.identify(password):
-            password = bcrypt.encrypt(password)
+            password = hash_password(password)
         new_user = User(username, password, email)
         db.session.add(new_user)
         db.session.commit()
 
 
-class NotFoundError(SQLAlchemyError):
-    """Exception raised when the expected item is not present in a table
-    query response.
-    """
-    pass
+def hash_password(password):
+    """Hash a password with bcrypt, timing it for /metrics."""
+    with bcrypt_seconds.time(('hash',)):
+        return bcrypt.encrypt(password)
+
+
+def verify_password(password, hashed):
+    """Check a password against its bcrypt hash, timing it for /metrics."""
+    with bcrypt_seconds.time(('verify',)):
+        return bcrypt.verify(password, hashed)
+
+
+def precompile_templates():
+    """Compile every template into the Jinja bytecode cache, so that no
+    worker has to compile one on its first request."""
+    if app.jinja_env.bytecode_cache is None:
+        print "JINJA_BYTECODE_CACHE_DIR is not set; nothing to precompile."
+        return
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    print "Compiled %d templates into %s." % (
+        len(names), app.config['JINJA_BYTECODE_CACHE_DIR'])
+
+
+def build_assets():
+    """Minify, fingerprint and precompress everything under static/."""
+    asset_manifest.clear()
+    asset_manifest.update(assets.build_assets(app.static_folder))
+    print "Built %d assets." % len(asset_manifest)
+
+
+def write_nginx_config(path='nginx_config'):
+    """Render nginx_config.in with this app's settings."""
+    with open(os.path.join(app.root_path, 'nginx_config.in')) as f:
+        template = Template(f.read(), trim_blocks=True, lstrip_blocks=True)
+    with open(path, 'w') as f:
+        f.write(template.render(
+            server_name=app.config['NGINX_SERVER_NAME'],
+            static_root=app.config['NGINX_STATIC_ROOT'],
+            brotli_static=app.config['NGINX_BROTLI_STATIC'],
+            gzip=app.config['NGINX_GZIP'],
+            upstream_keepalive=app.config['NGINX_UPSTREAM_KEEPALIVE'],
+            listen=app.config['NGINX_LISTEN'],
+            upstream=app.config['NGINX_UPSTREAM'],
+            access_log=app.config['NGINX_ACCESS_LOG'],
+            proxy_cache=app.config['NGINX_PROXY_CACHE'],
+            proxy_cache_path=app.config['NGINX_PROXY_CACHE_PATH'],
+            proxy_cache_size=app.config['NGINX_PROXY_CACHE_SIZE'],
+            purge_port=app.config['NGINX_PURGE_PORT'],
+            session_cookie=app.session_cookie_name,
+            snapshot_root=app.config['SNAPSHOT_DIR'],
+        ))
+
+
+def migration_progress():
+    """Show the progress of the batched backfills run by migrations."""
+    import online_migrations
+    rows = online_migrations.read_progress(db.engine)
+    if not rows:
+        print "No backfills have run."
+    for row in rows:
+        print "%-40s %-8s up to %d (%s)" % (
+            row.name, 'done' if row.finished else 'running',
+            row.position, row.updated)
+
+
+def partition_posts():
+    """Convert the posts table into one partitioned by month. PostgreSQL
+    11 or later only."""
+    import partitioning
+    with db.engine.connect() as connection:
+        partitioning.partition_posts(
+            connection, app.config['POSTS_PARTITION_MONTHS_AHEAD'])
+    print "Partitioned posts; posts_unpartitioned can be dropped."
+
+
+def maintain_partitions():
+    """Create the partitions of posts for the coming months. Run at least
+    monthly once posts is partitioned."""
+    import partitioning
+    with db.engine.connect() as connection:
+        if not partitioning.is_partitioned(connection):
+            print "posts is not partitioned."
+            return
+        created = partitioning.maintain_partitions(
+            connection, app.config['POSTS_PARTITION_MONTHS_AHEAD'])
+    print "Created %d partitions." % len(created)
+
+
+def archive_posts(before):
+    """Move the posts written before a date, given as YYYY-MM-DD, to
+    posts_archive."""
+    import partitioning
+    try:
+        before = datetime.strptime(before, '%Y-%m-%d')
+    except ValueError:
+        print "The date must be given as YYYY-MM-DD."
+        return
+    with db.engine.connect() as connection:
+        partitioned = partitioning.is_partitioned(connection)
+        archived = partitioning.archive_posts(
+            connection, before, app.config['ARCHIVE_BATCH_SIZE'])
+    print "Archived %d %s." % (
+        archived, 'partitions' if partitioned else 'posts')
+
+
+def export_snapshot(path=None, processes=None):
+    """Render the public pages to static HTML in path, SNAPSHOT_DIR by
+    default, for nginx to serve. Only changed files are rewritten. New
+    posts are added to the first pages as they are written, but the rest
+    of the snapshot is only as fresh as this export, so run it regularly,
+    e.g. every few minutes from cron."""
+    import snapshot
+    path = path or app.config['SNAPSHOT_DIR']
+    if not path:
+        print "Give a path or set SNAPSHOT_DIR."
+        return
+    rendered, written, removed = snapshot.export(
+        path, int(processes) if processes else None,
+        app.config['SNAPSHOT_BATCH_SIZE'])
+    print "Rendered %d pages into %s: %d written, %d removed." % (
+        rendered, path, written, removed)
+
+
+def create_manager():
+    """Build the Flask-Script manager. Flask-Script and Flask-Migrate are
+    only needed on the command line, so they are imported and registered
+    here rather than when the app is imported to serve HTTP."""
+    from flask.ext.script import Manager
+    from flask.ext.migrate import Migrate, MigrateCommand
+
+    Migrate(app, db)
+    manager = Manager(app)
+    manager.add_command('db', MigrateCommand)
+    manager.command(precompile_templates)
+    manager.command(build_assets)
+    manager.command(write_nginx_config)
+    manager.command(rebuild_counters)
+    manager.command(migration_progress)
+    manager.command(partition_posts)
+    manager.command(maintain_partitions)
+    manager.command(archive_posts)
+    manager.command(export_snapshot)
+    return manager
 
 
 if __name__ == '__main__':
-    #manager.run()
-    http_server = WSGIServer(('', 5000), app)
-    http_server.serve_forever()
+    if len(sys.argv) > 1:
+        create_manager().run()
+    else:
+        #Serve through gevent_wrapper.py, which monkey patches the standard
+        #library before importing the app. Without that, a /stream client
+        #waiting for a post would block the whole process.
+        wrapper = os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), 'gevent_wrapper.py')
+        os.execv(sys.executable, [sys.executable, wrapper])
@@ -0,0 +1,25 @@
+"""index posts by author and timestamp
+
+Revision ID: 4a1f3c2b9d10
+Revises: 2cd044c3654d
+Create Date: 2026-10-19 10:00:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4a1f3c2b9d10'
+down_revision = '2cd044c3654d'
+
+from alembic import op
+import sqlalchemy as sa
+from online_migrations import create_index_concurrently, \
+    drop_index_concurrently
+
+
+def upgrade():
+    create_index_concurrently(
+        'ix_posts_auth_id_timestamp', 'posts', ['auth_id', 'timestamp'])
+
+
+def downgrade():
+    drop_index_concurrently('ix_posts_auth_id_timestamp')
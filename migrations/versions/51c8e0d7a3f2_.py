@@ -0,0 +1,37 @@
+"""post counters on users and the site_stats table
+
+Revision ID: 51c8e0d7a3f2
+Revises: 4a1f3c2b9d10
+Create Date: 2026-10-19 10:30:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '51c8e0d7a3f2'
+down_revision = '4a1f3c2b9d10'
+
+from alembic import op
+import sqlalchemy as sa
+from online_migrations import backfill
+
+
+def upgrade():
+    op.add_column('users', sa.Column(
+        'post_count', sa.Integer(), nullable=False, server_default='0'))
+    op.create_table('site_stats',
+        sa.Column('name', sa.String(length=32), nullable=False),
+        sa.Column('value', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('name')
+    )
+    backfill('users_post_count', 'users',
+             "post_count = "
+             "(SELECT count(*) FROM posts WHERE posts.auth_id = users.id)")
+    op.execute(
+        "INSERT INTO site_stats (name, value) "
+        "SELECT 'posts', count(*) FROM posts"
+    )
+
+
+def downgrade():
+    op.drop_table('site_stats')
+    op.drop_column('users', 'post_count')
@@ -0,0 +1,29 @@
+"""server-side sessions table
+
+Revision ID: 5e2b7a9c1d43
+Revises: 51c8e0d7a3f2
+Create Date: 2026-10-19 11:00:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5e2b7a9c1d43'
+down_revision = '51c8e0d7a3f2'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('sessions',
+        sa.Column('sid', sa.String(length=40), nullable=False),
+        sa.Column('data', sa.Text(), nullable=False),
+        sa.Column('expires', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('sid')
+    )
+    op.create_index('ix_sessions_expires', 'sessions', ['expires'])
+
+
+def downgrade():
+    op.drop_index('ix_sessions_expires', table_name='sessions')
+    op.drop_table('sessions')
@@ -0,0 +1,52 @@
+"""slugs for posts
+
+Revision ID: 62d4f8a0b7e5
+Revises: 5e2b7a9c1d43
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '62d4f8a0b7e5'
+down_revision = '5e2b7a9c1d43'
+
+from alembic import op
+import sqlalchemy as sa
+from slugs import slugify, disambiguate
+from online_migrations import backfill, create_index_concurrently, \
+    drop_index_concurrently, set_not_null
+
+posts = sa.sql.table('posts',
+    sa.sql.column('id', sa.Integer),
+    sa.sql.column('title', sa.String),
+    sa.sql.column('slug', sa.String),
+)
+
+
+def write_slugs(connection, lower, upper):
+    #The unique index already exists, so checking whether a slug is taken
+    #is a lookup. A slug shared by two titles goes to whichever post gets
+    #it first; the other is disambiguated, as write_post does.
+    claim = sa.text("UPDATE posts SET slug = :slug WHERE id = :id "
+                    "AND NOT EXISTS (SELECT 1 FROM posts WHERE slug = :slug)")
+    for id, title in connection.execute(
+            sa.select([posts.c.id, posts.c.title]).where(
+                (posts.c.id > lower) & (posts.c.id <= upper) &
+                (posts.c.slug == None))):
+        slug = slugify(title)
+        if not connection.execute(claim, slug=slug, id=id).rowcount:
+            connection.execute(posts.update().where(posts.c.id == id).values(
+                slug=disambiguate(slug, title)))
+
+
+def upgrade():
+    op.add_column('posts', sa.Column('slug', sa.String(length=255)))
+    create_index_concurrently('posts_slug_key', 'posts', ['slug'],
+                              unique=True)
+    backfill('posts_slug', 'posts', write_slugs)
+    set_not_null('posts', 'slug', existing_type=sa.String(length=255))
+
+
+def downgrade():
+    drop_index_concurrently('posts_slug_key')
+    op.drop_column('posts', 'slug')
@@ -0,0 +1,45 @@
+"""follows, home timelines and follower counts
+
+Revision ID: 6a3c9e1f2b84
+Revises: 62d4f8a0b7e5
+Create Date: 2026-10-19 14:00:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6a3c9e1f2b84'
+down_revision = '62d4f8a0b7e5'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('users', sa.Column(
+        'follower_count', sa.Integer(), nullable=False, server_default='0'))
+    op.create_index(
+        'ix_users_follower_count', 'users', ['follower_count'])
+    op.create_table('follows',
+        sa.Column('follower_id', sa.Integer(), nullable=False),
+        sa.Column('followed_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['follower_id'], ['users.id'], ),
+        sa.ForeignKeyConstraint(['followed_id'], ['users.id'], ),
+        sa.PrimaryKeyConstraint('follower_id', 'followed_id')
+    )
+    op.create_index('ix_follows_followed_id', 'follows', ['followed_id'])
+    op.create_table('timelines',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('timestamp', sa.DateTime(), nullable=False),
+        sa.Column('post_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+        sa.ForeignKeyConstraint(['post_id'], ['posts.id'], ),
+        sa.PrimaryKeyConstraint('user_id', 'timestamp', 'post_id')
+    )
+
+
+def downgrade():
+    op.drop_table('timelines')
+    op.drop_index('ix_follows_followed_id', 'follows')
+    op.drop_table('follows')
+    op.drop_index('ix_users_follower_count', 'users')
+    op.drop_column('users', 'follower_count')
@@ -0,0 +1,23 @@
+"""view counts on posts
+
+Revision ID: 70b5d2e4c9a1
+Revises: 6a3c9e1f2b84
+Create Date: 2026-10-19 16:00:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '70b5d2e4c9a1'
+down_revision = '6a3c9e1f2b84'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('posts', sa.Column(
+        'views', sa.Integer(), nullable=False, server_default='0'))
+
+
+def downgrade():
+    op.drop_column('posts', 'views')
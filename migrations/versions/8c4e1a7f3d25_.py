@@ -0,0 +1,42 @@
+"""post keys and the posts archive
+
+Revision ID: 8c4e1a7f3d25
+Revises: 70b5d2e4c9a1
+Create Date: 2026-10-19 19:00:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8c4e1a7f3d25'
+down_revision = '70b5d2e4c9a1'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('post_keys',
+    sa.Column('slug', sa.String(length=255), nullable=False),
+    sa.Column('title', sa.String(length=255), nullable=False),
+    sa.Column('post_id', sa.Integer(), nullable=True),
+    sa.PrimaryKeyConstraint('slug'),
+    sa.UniqueConstraint('title')
+    )
+    op.execute("INSERT INTO post_keys (slug, title, post_id) "
+               "SELECT slug, title, id FROM posts")
+    op.create_table('posts_archive',
+    sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('title', sa.String(length=255), nullable=False),
+    sa.Column('slug', sa.String(length=255), nullable=False),
+    sa.Column('body', sa.Text(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.Column('auth_id', sa.Integer(), nullable=False),
+    sa.Column('views', sa.Integer(), nullable=False, server_default='0'),
+    sa.ForeignKeyConstraint(['auth_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('posts_archive')
+    op.drop_table('post_keys')
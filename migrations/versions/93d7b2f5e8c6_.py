@@ -0,0 +1,33 @@
+"""idempotency keys
+
+Revision ID: 93d7b2f5e8c6
+Revises: 8c4e1a7f3d25
+Create Date: 2026-10-19 21:00:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '93d7b2f5e8c6'
+down_revision = '8c4e1a7f3d25'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('idempotency_keys',
+        sa.Column('key', sa.String(length=255), nullable=False),
+        sa.Column('fingerprint', sa.String(length=40), nullable=False),
+        sa.Column('status', sa.Integer(), nullable=True),
+        sa.Column('headers', sa.Text(), nullable=True),
+        sa.Column('body', sa.LargeBinary(), nullable=True),
+        sa.Column('expires', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('key')
+    )
+    op.create_index(
+        'ix_idempotency_keys_expires', 'idempotency_keys', ['expires'])
+
+
+def downgrade():
+    op.drop_index('ix_idempotency_keys_expires', table_name='idempotency_keys')
+    op.drop_table('idempotency_keys')
@@ -0,0 +1,28 @@
+"""index posts by author, timestamp and id
+
+Revision ID: b5e9d3a7c2f0
+Revises: 93d7b2f5e8c6
+Create Date: 2026-10-20 10:00:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b5e9d3a7c2f0'
+down_revision = '93d7b2f5e8c6'
+
+from alembic import op
+import sqlalchemy as sa
+from online_migrations import create_index_concurrently, \
+    drop_index_concurrently
+
+
+def upgrade():
+    create_index_concurrently('ix_posts_auth_id_timestamp_id', 'posts',
+                              ['auth_id', 'timestamp', 'id'])
+    drop_index_concurrently('ix_posts_auth_id_timestamp')
+
+
+def downgrade():
+    create_index_concurrently(
+        'ix_posts_auth_id_timestamp', 'posts', ['auth_id', 'timestamp'])
+    drop_index_concurrently('ix_posts_auth_id_timestamp_id')
@@ -0,0 +1,234 @@
+"""Helpers for migrations that must not block writes to busy tables.
+
+Plain Alembic operations lock a table for as long as they take: creating
+an index blocks writes while the table is scanned, setting NOT NULL scans
+it under an exclusive lock, and updating every row in one statement holds
+all of their row locks in one huge transaction. On PostgreSQL, these do
+the same work online:
+
+- create_index_concurrently() builds an index with CREATE INDEX
+  CONCURRENTLY, replacing any invalid index an interrupted run left behind.
+- backfill() updates rows a primary key range at a time, each batch in its
+  own transaction, pausing between batches. Its progress is recorded, so
+  an interrupted run carries on where it stopped. Backfills must be safe
+  to repeat on a batch. Values that can't be computed in SQL can be
+  written by a function called for each batch.
+- set_not_null() adds a NOT VALID CHECK constraint and validates it, which
+  doesn't block writes, after which PostgreSQL (12 and later) sets NOT
+  NULL without scanning the table again.
+
+DDL runs with a short lock_timeout, so a migration that can't get its lock
+fails at once rather than queueing every other query behind it.
+
+None of this can run inside a transaction, so on PostgreSQL each helper
+commits the migration's transaction first, releasing its locks, and does
+its work on a connection of its own. Everything before the call is
+committed even if the migration later fails; statements after it run in a
+new transaction on the migration's connection. On other databases the
+helpers fall back to the plain, blocking operations.
+
+The helpers take the migration's connection by default, or any connection
+passed in, e.g. from a manager command.
+"""
+from contextlib import contextmanager
+from datetime import datetime
+import sqlalchemy as sa
+import time
+
+LOCK_TIMEOUT = '5s'
+
+metadata = sa.MetaData()
+
+progress = sa.Table('online_migrations', metadata,
+    sa.Column('name', sa.String(255), primary_key=True),
+    sa.Column('position', sa.BigInteger, nullable=False),
+    sa.Column('finished', sa.Boolean, nullable=False),
+    sa.Column('updated', sa.DateTime, nullable=False),
+)
+
+
+def _connection(connection):
+    if connection is None:
+        from alembic import op
+        connection = op.get_bind()
+    return connection
+
+
+def _is_postgresql(connection):
+    return connection.dialect.name == 'postgresql'
+
+
+def _quote(connection, name):
+    return connection.dialect.identifier_preparer.quote(name)
+
+
+@contextmanager
+def _own_connection(connection, isolation_level='AUTOCOMMIT'):
+    """Commit connection's transaction and yield a new connection to the
+    same database. Running COMMIT as a statement would leave psycopg2 and
+    SQLAlchemy believing the transaction is still open."""
+    if not _is_postgresql(connection):
+        yield connection
+        return
+    connection.connection.commit()
+    own = connection.engine.connect()
+    if isolation_level:
+        own = own.execution_options(isolation_level=isolation_level)
+    try:
+        yield own
+    finally:
+        own.close()
+
+
+@contextmanager
+def lock_timeout(connection, timeout=LOCK_TIMEOUT):
+    """Give up on any lock the block can't get within timeout."""
+    if not _is_postgresql(connection):
+        yield
+        return
+    connection.execute("SET lock_timeout = '%s'" % timeout)
+    try:
+        yield
+    finally:
+        connection.execute("RESET lock_timeout")
+
+
+def create_index_concurrently(name, table, columns, unique=False,
+                              connection=None):
+    """Create an index without blocking writes to table."""
+    with _own_connection(_connection(connection)) as connection:
+        concurrently = ''
+        if _is_postgresql(connection):
+            valid = connection.execute(sa.text(
+                "SELECT indisvalid FROM pg_index "
+                "JOIN pg_class ON pg_class.oid = pg_index.indexrelid "
+                "WHERE relname = :name"), name=name).scalar()
+            if valid:
+                return
+            if valid is not None:
+                connection.execute(
+                    "DROP INDEX CONCURRENTLY %s" % _quote(connection, name))
+            concurrently = 'CONCURRENTLY '
+        with lock_timeout(connection):
+            connection.execute("CREATE %sINDEX %s%s ON %s (%s)" % (
+                'UNIQUE ' if unique else '', concurrently,
+                _quote(connection, name), _quote(connection, table),
+                ', '.join(_quote(connection, column) for column in columns)))
+
+
+def drop_index_concurrently(name, connection=None):
+    """Drop an index without blocking writes to its table."""
+    with _own_connection(_connection(connection)) as connection:
+        concurrently = ''
+        if _is_postgresql(connection):
+            concurrently = 'CONCURRENTLY '
+        with lock_timeout(connection):
+            connection.execute("DROP INDEX %s%s" % (
+                concurrently, _quote(connection, name)))
+
+
+def backfill(name, table, set_clause, where=None, key='id', batch_size=1000,
+             pause=0.1, connection=None):
+    """Run UPDATE table SET set_clause [WHERE where] in batches of
+    batch_size primary key values, sleeping pause seconds between batches.
+    set_clause may instead be a function, called with the connection and
+    the batch's exclusive lower and inclusive upper key, that updates the
+    batch itself; where is then ignored. name identifies the backfill's
+    recorded progress. Rows added after the backfill starts are not
+    visited, so the app must already be writing them correctly."""
+    with _own_connection(_connection(connection), None) as connection:
+        _backfill(connection, name, table, set_clause, where, key,
+                  batch_size, pause)
+
+
+def _backfill(connection, name, table, set_clause, where, key, batch_size,
+              pause):
+    progress.create(connection, checkfirst=True)
+    row = connection.execute(
+        progress.select().where(progress.c.name == name)).first()
+    if row is not None and row.finished:
+        return
+    table_name, key_name = _quote(connection, table), _quote(connection, key)
+    end = connection.execute("SELECT max(%s) FROM %s" % (
+        key_name, table_name)).scalar()
+    if row is not None:
+        position = row.position
+    else:
+        position = connection.execute("SELECT min(%s) FROM %s" % (
+            key_name, table_name)).scalar()
+        position = position - 1 if position is not None else 0
+    if callable(set_clause):
+        update = set_clause
+    else:
+        statement = sa.text(
+            "UPDATE %s SET %s WHERE %s > :lower AND %s <= :upper%s" % (
+                table_name, set_clause, key_name, key_name,
+                " AND (%s)" % where if where else ''))
+
+        def update(connection, lower, upper):
+            connection.execute(statement, lower=lower, upper=upper)
+
+    while end is not None and position < end:
+        upper = position + batch_size
+        with connection.begin():
+            update(connection, position, upper)
+            _record_progress(connection, name, upper, False)
+        position = upper
+        if position < end:
+            time.sleep(pause)
+    with connection.begin():
+        _record_progress(connection, name, position, True)
+
+
+def _record_progress(connection, name, position, finished):
+    values = {
+        'position': position,
+        'finished': finished,
+        'updated': datetime.utcnow(),
+    }
+    updated = connection.execute(progress.update().where(
+        progress.c.name == name).values(**values)).rowcount
+    if not updated:
+        connection.execute(progress.insert().values(name=name, **values))
+
+
+def set_not_null(table, column, existing_type=None, connection=None):
+    """Make column NOT NULL without holding an exclusive lock on table
+    while every row is checked."""
+    connection = _connection(connection)
+    if not _is_postgresql(connection):
+        from alembic import op
+        op.alter_column(table, column, nullable=False,
+                        existing_type=existing_type)
+        return
+    with _own_connection(connection) as connection:
+        _set_not_null(connection, table, column)
+
+
+def _set_not_null(connection, table, column):
+    table_name = _quote(connection, table)
+    constraint = _quote(connection, '%s_%s_not_null' % (table, column))
+    with lock_timeout(connection):
+        connection.execute(
+            "ALTER TABLE %s DROP CONSTRAINT IF EXISTS %s" % (
+                table_name, constraint))
+        connection.execute(
+            "ALTER TABLE %s ADD CONSTRAINT %s CHECK (%s IS NOT NULL) "
+            "NOT VALID" % (table_name, constraint,
+                           _quote(connection, column)))
+    connection.execute("ALTER TABLE %s VALIDATE CONSTRAINT %s" % (
+        table_name, constraint))
+    with lock_timeout(connection):
+        connection.execute("ALTER TABLE %s ALTER COLUMN %s SET NOT NULL" % (
+            table_name, _quote(connection, column)))
+        connection.execute("ALTER TABLE %s DROP CONSTRAINT %s" % (
+            table_name, constraint))
+
+
+def read_progress(connection):
+    """Return the recorded progress of every backfill, as rows of name,
+    position, finished and updated."""
+    if not progress.exists(connection):
+        return []
+    return connection.execute(
+        progress.select().order_by(progress.c.updated)).fetchall()
@@ -0,0 +1,233 @@
+"""Time-based partitioning and archival of the posts table.
+
+On PostgreSQL 11 or later, partition_posts() converts posts into a table
+partitioned by month of timestamp. Listings of recent posts then only touch
+the newest partitions and their small indexes, and a month of old posts is
+archived by detaching its partition, a catalog change rather than a DELETE
+of every row. Partitions are created ahead of time by
+maintain_partitions(), which should run at least monthly; a post whose
+timestamp has no partition can't be written.
+
+Archived posts live in posts_archive, which is partitioned the same way
+once posts is. Without partitioning, archive_posts() moves rows in batches
+instead. Either way read_post() still finds archived posts by id.
+
+The functions here take a connection outside any transaction; they manage
+their own.
+"""
+from datetime import datetime
+from sqlalchemy import text
+from online_migrations import lock_timeout
+import re
+import time
+
+POSTS = 'posts'
+ARCHIVE = 'posts_archive'
+COLUMNS = 'id, title, slug, body, timestamp, auth_id, views'
+
+
+def month_start(moment):
+    return datetime(moment.year, moment.month, 1)
+
+
+def add_months(moment, months):
+    month = moment.month - 1 + months
+    return datetime(moment.year + month // 12, month % 12 + 1, 1)
+
+
+def partition_name(table, month):
+    return '%s_%04d_%02d' % (table, month.year, month.month)
+
+
+def partition_month(name):
+    """Return the month a partition named by partition_name holds."""
+    year, month = re.search(r'_(\d{4})_(\d{2})$', name).groups()
+    return datetime(int(year), int(month), 1)
+
+
+def is_partitioned(connection, table=POSTS):
+    if connection.dialect.name != 'postgresql':
+        return False
+    return connection.execute(text(
+        "SELECT relkind FROM pg_class WHERE oid = to_regclass(:table)"),
+        table=table).scalar() == 'p'
+
+
+def list_partitions(connection, table=POSTS):
+    """Return the names of table's partitions, oldest first."""
+    rows = connection.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = to_regclass(:table)"), table=table)
+    return sorted(row.relname for row in rows)
+
+
+def create_partitions(connection, table, first, last):
+    """Create the monthly partitions of table from the month of first to
+    the month of last that don't exist yet. Returns their names."""
+    existing = set(list_partitions(connection, table))
+    created = []
+    month = month_start(first)
+    while month <= last:
+        name = partition_name(table, month)
+        if name not in existing:
+            with lock_timeout(connection):
+                connection.execute(
+                    "CREATE TABLE %s PARTITION OF %s "
+                    "FOR VALUES FROM ('%s') TO ('%s')" % (
+                        name, table, month, add_months(month, 1)))
+            created.append(name)
+        month = add_months(month, 1)
+    return created
+
+
+def maintain_partitions(connection, months_ahead=3):
+    """Make sure posts has a partition for every month from now until
+    months_ahead months from now."""
+    now = datetime.utcnow()
+    return create_partitions(
+        connection, POSTS, now, add_months(now, months_ahead))
+
+
+def _create_partitioned_copy(connection, table, like):
+    connection.execute(
+        "CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS) "
+        "PARTITION BY RANGE (timestamp)" % (table, like))
+    #Unique constraints on a partitioned table must include its partition
+    #key; title and slug uniqueness is kept by post_keys instead.
+    connection.execute(
+        "ALTER TABLE %s ADD PRIMARY KEY (id, timestamp)" % table)
+    connection.execute(
+        "ALTER TABLE %s ADD FOREIGN KEY (auth_id) REFERENCES users (id)"
+        % table)
+
+
+def partition_posts(connection, months_ahead=3, batch_size=10000,
+                    pause=0.1):
+    """Convert posts into a table partitioned by month.
+
+    The rows are copied into a new partitioned table in batches while the
+    app keeps running. Writes are then blocked only for as long as it
+    takes to copy the rows added meanwhile and swap the tables. View counts
+    flushed to rows that were already copied are lost. The old table is
+    kept as posts_unpartitioned, to be dropped once the result has been
+    checked.
+    """
+    new = 'posts_partitioned'
+    now = datetime.utcnow()
+    first = connection.execute(
+        "SELECT min(timestamp) FROM posts").scalar() or now
+    _create_partitioned_copy(connection, new, POSTS)
+    create_partitions(connection, new, first, add_months(now, months_ahead))
+    connection.execute(
+        "CREATE INDEX ix_posts_partitioned_auth_id_timestamp_id "
+        "ON %s (auth_id, timestamp, id)" % new)
+    connection.execute(
+        "CREATE INDEX ix_posts_partitioned_timestamp ON %s (timestamp)" % new)
+
+    copy = text("INSERT INTO %s (%s) SELECT %s FROM posts "
+                "WHERE id > :lower AND id <= :upper" % (new, COLUMNS, COLUMNS))
+    copied = 0
+    end = connection.execute("SELECT max(id) FROM posts").scalar() or 0
+    while copied < end:
+        connection.execute(copy, lower=copied, upper=copied + batch_size)
+        copied += batch_size
+        time.sleep(pause)
+
+    with connection.begin():
+        with lock_timeout(connection):
+            connection.execute("LOCK TABLE posts IN EXCLUSIVE MODE")
+        #Rows committed after their batch was copied, whether added since
+        #or written by a transaction that was still open, all have ids in
+        #the last batch or after it, so that tail is copied again.
+        tail = max(copied - batch_size, 0)
+        connection.execute("DELETE FROM %s WHERE id > %d" % (new, tail))
+        connection.execute(copy, lower=tail, upper=2 ** 31 - 1)
+        #A foreign key must reference a unique constraint, and the
+        #partitioned table's is on (id, timestamp).
+        connection.execute("ALTER TABLE timelines "
+                           "DROP CONSTRAINT IF EXISTS timelines_post_id_fkey")
+        connection.execute("ALTER TABLE posts RENAME TO posts_unpartitioned")
+        connection.execute(
+            "ALTER INDEX ix_posts_auth_id_timestamp_id "
+            "RENAME TO ix_posts_unpartitioned_auth_id_timestamp_id")
+        connection.execute("ALTER TABLE %s RENAME TO posts" % new)
+        connection.execute(
+            "ALTER INDEX ix_posts_partitioned_auth_id_timestamp_id "
+            "RENAME TO ix_posts_auth_id_timestamp_id")
+        connection.execute(
+            "ALTER INDEX ix_posts_partitioned_timestamp "
+            "RENAME TO ix_posts_timestamp")
+        for name in list_partitions(connection, POSTS):
+            connection.execute("ALTER TABLE %s RENAME TO %s" % (
+                name, partition_name(POSTS, partition_month(name))))
+        connection.execute("ALTER SEQUENCE posts_id_seq OWNED BY posts.id")
+
+        archived = connection.execute(
+            "SELECT min(timestamp), max(timestamp) FROM %s" % ARCHIVE).first()
+        connection.execute("ALTER TABLE %s RENAME TO %s_unpartitioned" % (
+            ARCHIVE, ARCHIVE))
+        _create_partitioned_copy(connection, ARCHIVE, POSTS)
+        if archived[0] is not None:
+            create_partitions(connection, ARCHIVE, *archived)
+            connection.execute(
+                "INSERT INTO %s (%s) SELECT %s FROM %s_unpartitioned" % (
+                    ARCHIVE, COLUMNS, COLUMNS, ARCHIVE))
+        connection.execute("DROP TABLE %s_unpartitioned" % ARCHIVE)
+
+
+def archive_posts(connection, before, batch_size=1000, pause=0.1):
+    """Move the posts written before the given datetime to posts_archive.
+    Returns the number of posts archived, or of partitions when posts is
+    partitioned, in which case only whole months before it are archived.
+    """
+    if is_partitioned(connection):
+        return _archive_partitions(connection, before)
+
+    where = "timestamp < :before AND id <= :upper"
+    moved = 0
+    while True:
+        with connection.begin():
+            upper = connection.execute(text(
+                "SELECT max(id) FROM (SELECT id FROM posts "
+                "WHERE timestamp < :before ORDER BY id LIMIT :limit) batch"),
+                before=before, limit=batch_size).scalar()
+            if upper is None:
+                return moved
+            connection.execute(text(
+                "INSERT INTO %s (%s) SELECT %s FROM posts WHERE %s" % (
+                    ARCHIVE, COLUMNS, COLUMNS, where)),
+                before=before, upper=upper)
+            connection.execute(text(
+                "DELETE FROM timelines WHERE post_id IN "
+                "(SELECT id FROM posts WHERE %s)" % where),
+                before=before, upper=upper)
+            moved += connection.execute(text(
+                "DELETE FROM posts WHERE %s" % where),
+                before=before, upper=upper).rowcount
+        time.sleep(pause)
+
+
+def _archive_partitions(connection, before):
+    archived = 0
+    for name in list_partitions(connection, POSTS):
+        month = partition_month(name)
+        if add_months(month, 1) > before:
+            break
+        archive_name = partition_name(ARCHIVE, month)
+        with connection.begin():
+            connection.execute(
+                "DELETE FROM timelines WHERE post_id IN "
+                "(SELECT id FROM %s)" % name)
+            with lock_timeout(connection):
+                connection.execute(
+                    "ALTER TABLE posts DETACH PARTITION %s" % name)
+            connection.execute(
+                "ALTER TABLE %s RENAME TO %s" % (name, archive_name))
+            with lock_timeout(connection):
+                connection.execute(
+                    "ALTER TABLE %s ATTACH PARTITION %s "
+                    "FOR VALUES FROM ('%s') TO ('%s')" % (
+                        ARCHIVE, archive_name, month, add_months(month, 1)))
+        archived += 1
+    return archived
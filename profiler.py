@@ -0,0 +1,144 @@
+"""On-demand diagnostics for a live worker: a sampling CPU profiler and
+snapshots of the objects held in memory.
+
+The profiler uses a SIGPROF interval timer. Each time it fires, the stack
+of whatever was running at that moment is recorded. Under gevent that is
+the stack of the running greenlet, so samples are taken across all
+greenlets. The output is in the collapsed-stack format read by
+flamegraph.pl and speedscope. Nothing is installed until a profile is
+requested, so an idle worker pays nothing.
+
+Python 2 has no tracemalloc, so memory is inspected by counting the
+objects the garbage collector tracks, by type. Diffing two snapshots shows
+which types are growing.
+"""
+from flask import request, abort, Response
+from collections import Counter
+from threading import Lock
+import gc
+import hmac
+import math
+import os
+import signal
+import time
+
+
+class SamplingProfiler(object):
+    """Samples the running stack every interval seconds of CPU time.
+    Must be started and stopped from the main thread."""
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.stacks = Counter()
+        self.previous_handler = None
+
+    def start(self):
+        self.stacks.clear()
+        self.previous_handler = signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, self.previous_handler or signal.SIG_DFL)
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s (%s:%d)' % (
+                code.co_name, os.path.basename(code.co_filename),
+                code.co_firstlineno))
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(stack))] += 1
+
+    def collapsed(self):
+        """Return the samples as collapsed stacks, one per line."""
+        return ''.join('%s %d\n' % (stack, count)
+                       for stack, count in self.stacks.most_common())
+
+
+def object_counts():
+    """Count the objects tracked by the garbage collector, by type."""
+    counts = Counter()
+    for obj in gc.get_objects():
+        counts[type(obj).__name__] += 1
+    return counts
+
+
+def diff_counts(before, after):
+    """Return (type name, count, change) for each type whose count
+    changed between two snapshots, largest change first."""
+    names = set(before) | set(after)
+    changes = [(name, after.get(name, 0), after.get(name, 0) -
+                before.get(name, 0)) for name in names]
+    return sorted([change for change in changes if change[2]],
+                  key=lambda change: abs(change[2]), reverse=True)
+
+
+class Diagnostics(object):
+    """Serves /debug/profile and /debug/memory to requests that carry
+    DEBUG_TOKEN, in an X-Debug-Token header or a token query argument.
+    Without DEBUG_TOKEN set, both answer 404.
+
+    /debug/profile?seconds=N profiles the worker for N seconds (at most
+    PROFILER_MAX_SECONDS), one profile at a time. /debug/memory returns the
+    object counts by type; with ?diff=1 it returns the changes since the
+    last snapshot taken by this worker.
+    """
+    def __init__(self, app):
+        self.app = app
+        self.lock = Lock()
+        self.snapshot = None
+        app.add_url_rule('/debug/profile', 'profile_view', self.profile_view)
+        app.add_url_rule('/debug/memory', 'memory_view', self.memory_view)
+
+    def authorize(self):
+        token = self.app.config['DEBUG_TOKEN']
+        given = request.headers.get('X-Debug-Token') or \
+            request.args.get('token') or ''
+        if not token or not hmac.compare_digest(str(given), str(token)):
+            abort(404)
+
+    def profile_view(self):
+        self.authorize()
+        try:
+            seconds = float(request.args.get('seconds', 10))
+        except ValueError:
+            abort(400)
+        #nan compares false with everything, so isn't above 0 either.
+        if math.isinf(seconds) or not seconds > 0:
+            abort(400)
+        seconds = min(seconds, self.app.config['PROFILER_MAX_SECONDS'])
+        if not self.lock.acquire(False):
+            abort(409)
+        try:
+            profiler = SamplingProfiler(self.app.config['PROFILER_INTERVAL'])
+            try:
+                profiler.start()
+            except ValueError:
+                #Signals can only be handled in the main thread, which is
+                #where gevent runs every greenlet.
+                abort(503)
+            try:
+                #Under gevent this yields to the other greenlets, which
+                #are what gets sampled.
+                time.sleep(seconds)
+            finally:
+                profiler.stop()
+        finally:
+            self.lock.release()
+        response = Response(profiler.collapsed(), mimetype='text/plain')
+        response.headers['Content-Disposition'] = \
+            'attachment; filename=profile-%d.txt' % os.getpid()
+        return response
+
+    def memory_view(self):
+        self.authorize()
+        gc.collect()
+        counts = object_counts()
+        if request.args.get('diff') and self.snapshot is not None:
+            lines = ['%-40s %10d %+10d' % change
+                     for change in diff_counts(self.snapshot, counts)]
+        else:
+            lines = ['%-40s %10d' % item for item in counts.most_common()]
+        self.snapshot = counts
+        return Response('\n'.join(lines) + '\n', mimetype='text/plain')
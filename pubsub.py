@@ -0,0 +1,70 @@
+"""An in-process publish/subscribe hub, for pushing events to clients that
+hold a connection open, such as the /stream Server-Sent Events endpoint.
+
+Under gevent_wrapper.py the threading primitives used here are gevent's, so
+an idle subscriber is just a parked greenlet and a bounded queue. Only the
+subscribers in the publishing process are reached; with several workers,
+each one has to find out about the others' messages by itself (see
+microblog.poll_post_events).
+"""
+from collections import deque
+from threading import Event, Lock
+
+
+class Subscription(object):
+    """One subscriber's pending messages. The queue is bounded: a
+    subscriber that falls behind loses its oldest messages rather than
+    holding on to an ever growing backlog."""
+    def __init__(self, hub, maxlen):
+        self.hub = hub
+        self.messages = deque(maxlen=maxlen)
+        self.event = Event()
+
+    def put(self, message):
+        self.messages.append(message)
+        self.event.set()
+
+    def get(self, timeout=None):
+        """Return every pending message, first waiting up to timeout
+        seconds for one if there are none. Returns an empty list if the
+        wait times out."""
+        if not self.messages:
+            self.event.wait(timeout)
+        self.event.clear()
+        messages = []
+        while self.messages:
+            messages.append(self.messages.popleft())
+        return messages
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+
+class Hub(object):
+    """Hands every published message to every current subscriber."""
+    def __init__(self, maxlen=32, max_subscribers=None):
+        self.maxlen = maxlen
+        self.max_subscribers = max_subscribers
+        self.subscriptions = set()
+        self.lock = Lock()
+
+    def subscribe(self):
+        """Return a new Subscription, or None if the hub already has
+        max_subscribers."""
+        with self.lock:
+            if self.max_subscribers is not None and \
+                    len(self.subscriptions) >= self.max_subscribers:
+                return None
+            subscription = Subscription(self, self.maxlen)
+            self.subscriptions.add(subscription)
+            return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions.discard(subscription)
+
+    def publish(self, message):
+        with self.lock:
+            subscriptions = list(self.subscriptions)
+        for subscription in subscriptions:
+            subscription.put(message)
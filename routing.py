@@ -0,0 +1,78 @@
+"""Read replica routing for the microblog's database session.
+
+Queries run inside RoutingSQLAlchemy.replica() are sent to one of the
+bind keys listed in SQLALCHEMY_READ_REPLICAS. Everything else, including
+every flush and commit, goes to the primary.
+"""
+from flask.ext.sqlalchemy import SQLAlchemy, _SignallingSession
+from sqlalchemy import orm
+from contextlib import contextmanager
+from functools import partial
+from random import choice
+import flask
+import time
+
+
+class RoutingSession(_SignallingSession):
+    """A session that can route reads to a replica. After a commit, the
+    session (and, inside a request, the client's cookie session) is
+    pinned to the primary for READ_REPLICA_STICKY_SECONDS so that a
+    client always reads its own writes. Setting primary_only pins it for
+    the rest of its life.
+    """
+    def __init__(self, db, **options):
+        self.db = db
+        self.use_replica = False
+        self.primary_only = False
+        self.primary_until = 0
+        _SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        replicas = self.app.config.get('SQLALCHEMY_READ_REPLICAS')
+        if replicas and self.use_replica and not self._flushing \
+                and not self.pinned():
+            return self.db.get_engine(self.app, bind=choice(replicas))
+        return _SignallingSession.get_bind(self, mapper, clause)
+
+    def pinned(self):
+        """Return True if reads must currently go to the primary."""
+        if self.primary_only:
+            return True
+        now = time.time()
+        if now < self.primary_until:
+            return True
+        if flask.has_request_context():
+            return now < flask.session.get('_primary_until', 0)
+        return False
+
+    def commit(self):
+        _SignallingSession.commit(self)
+        if self.app.config.get('SQLALCHEMY_READ_REPLICAS'):
+            self.primary_until = \
+                time.time() + self.app.config['READ_REPLICA_STICKY_SECONDS']
+            if flask.has_request_context():
+                flask.session['_primary_until'] = self.primary_until
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with a replica() context for read-only queries."""
+    def create_scoped_session(self, options=None):
+        if options is None:
+            options = {}
+        scopefunc = options.pop('scopefunc', None)
+        return orm.scoped_session(
+            partial(RoutingSession, self, **options), scopefunc=scopefunc
+        )
+
+    @contextmanager
+    def replica(self):
+        """Route the queries made in this block to a read replica, unless
+        the session is pinned to the primary by a recent commit.
+        """
+        session = self.session()
+        previous = session.use_replica
+        session.use_replica = True
+        try:
+            yield
+        finally:
+            session.use_replica = previous
@@ -0,0 +1,218 @@
+"""Server-side sessions.
+
+The session cookie carries only an opaque, random session id; the session
+data lives in a backend. That keeps the cookie small and removes the
+per-request serializing and signing of Flask's cookie sessions. Expired
+sessions are swept in batches rather than checked one at a time.
+"""
+from flask.sessions import SessionInterface, SessionMixin, \
+    session_json_serializer
+from werkzeug.datastructures import CallbackDict
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from threading import Lock
+from copy import deepcopy
+import binascii
+import os
+import time
+
+
+#Values that can't have been changed in place, so that setting one equal
+#to the value already stored doesn't modify the session.
+IMMUTABLE_TYPES = (basestring, int, long, float, bool, type(None))
+
+
+def new_session_id():
+    """Return a random, unguessable session id."""
+    return binascii.hexlify(os.urandom(20))
+
+
+def regenerate_session(session):
+    """Give session a new sid, if it has one. Call this whenever the
+    session's privileges change, such as on login and logout."""
+    regenerate = getattr(session, 'regenerate', None)
+    if regenerate is not None:
+        regenerate()
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """A session whose data is kept in a backend under its sid."""
+    def __init__(self, initial=None, sid=None, new=False, expires=None):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.expires = expires
+        self.old_sid = None
+        self.modified = False
+
+    def __setitem__(self, key, value):
+        #SeaSurf sets its token on every request, almost always to the
+        #value it already has.
+        old = self.get(key, self)
+        if isinstance(value, IMMUTABLE_TYPES) and type(old) is type(value) \
+                and old == value:
+            return
+        CallbackDict.__setitem__(self, key, value)
+
+    def regenerate(self):
+        """Move the session to a new sid, so that a sid that was planted
+        or seen before is of no further use. The old sid's record is
+        deleted when the session is saved."""
+        if not self.new and self.old_sid is None:
+            self.old_sid = self.sid
+        self.sid = new_session_id()
+        self.new = True
+        self.modified = True
+
+
+class MemoryBackend(object):
+    """Keeps sessions in this process, least recently used first. Only
+    suitable for a single worker process.
+
+    Every access moves a session to the end of the LRU order and pushes
+    back its expiry, so expired sessions are always at the front and a
+    sweep stops at the first live one.
+    """
+    def __init__(self, ttl, maxsize=10000, sweep_interval=60):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.sweep_interval = sweep_interval
+        self.sessions = OrderedDict()
+        self.lock = Lock()
+        self.last_sweep = time.time()
+
+    def load(self, sid):
+        with self.lock:
+            entry = self.sessions.pop(sid, None)
+            if entry is None or entry[0] < time.time():
+                return None
+            self.sessions[sid] = (time.time() + self.ttl, entry[1])
+            return deepcopy(entry[1]), None
+
+    def save(self, sid, data):
+        with self.lock:
+            self.sessions.pop(sid, None)
+            self.sessions[sid] = (time.time() + self.ttl, dict(data))
+            while len(self.sessions) > self.maxsize:
+                self.sessions.popitem(last=False)
+            self.sweep()
+
+    def delete(self, sid):
+        with self.lock:
+            self.sessions.pop(sid, None)
+
+    def sweep(self, force=False):
+        """Drop expired sessions, at most once every sweep_interval
+        seconds. Must be called with the lock held.
+        """
+        now = time.time()
+        if not force and now - self.last_sweep < self.sweep_interval:
+            return
+        self.last_sweep = now
+        while self.sessions:
+            sid, (expires, data) = next(self.sessions.iteritems())
+            if expires >= now:
+                break
+            del self.sessions[sid]
+
+
+class DatabaseBackend(object):
+    """Keeps sessions in a database table shared by every worker. The
+    table needs sid, data and expires columns (see StoredSession in
+    microblog.py). get_engine is called for the engine each time, so that
+    it can be created lazily. Statements run on their own connection,
+    outside the ORM session, so a view's uncommitted or failed transaction
+    never affects them.
+    """
+    serializer = session_json_serializer
+
+    def __init__(self, get_engine, table, ttl, sweep_interval=60):
+        self.get_engine = get_engine
+        self.table = table
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.last_sweep = time.time()
+
+    def load(self, sid):
+        row = self.get_engine().execute(
+            self.table.select().where(self.table.c.sid == sid)).first()
+        if row is None or row.expires < datetime.utcnow():
+            return None
+        return self.serializer.loads(row.data), row.expires
+
+    def save(self, sid, data):
+        values = {
+            'data': self.serializer.dumps(dict(data)),
+            'expires': datetime.utcnow() + timedelta(seconds=self.ttl),
+        }
+        with self.get_engine().begin() as connection:
+            updated = connection.execute(
+                self.table.update().where(self.table.c.sid == sid),
+                **values).rowcount
+            if not updated:
+                connection.execute(self.table.insert(), sid=sid, **values)
+        self.sweep()
+
+    def delete(self, sid):
+        self.get_engine().execute(
+            self.table.delete().where(self.table.c.sid == sid))
+
+    def sweep(self, force=False):
+        """Delete expired sessions in one statement, at most once every
+        sweep_interval seconds."""
+        now = time.time()
+        if not force and now - self.last_sweep < self.sweep_interval:
+            return
+        self.last_sweep = now
+        self.get_engine().execute(self.table.delete().where(
+            self.table.c.expires < datetime.utcnow()))
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """A Flask session interface that stores sessions in a backend.
+
+    A session is written back only when it was modified, or when a
+    backend that doesn't refresh expiry on read (the database) reports
+    that it is more than half way to expiring. The cookie is only set
+    when a session is created or deleted.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+        if sid:
+            stored = self.backend.load(sid)
+            if stored is not None:
+                data, expires = stored
+                return ServerSideSession(data, sid=sid, expires=expires)
+        return ServerSideSession(sid=new_session_id(), new=True)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.old_sid is not None:
+            self.backend.delete(session.old_sid)
+        if not session:
+            if not session.new:
+                self.backend.delete(session.sid)
+            if not session.new or session.old_sid is not None:
+                response.delete_cookie(
+                    app.session_cookie_name, domain=domain, path=path)
+            return
+
+        refresh = session.expires is not None and \
+            session.expires - datetime.utcnow() < \
+            timedelta(seconds=self.backend.ttl / 2)
+        if session.modified or refresh:
+            self.backend.save(session.sid, session)
+        if session.new:
+            response.set_cookie(
+                app.session_cookie_name, session.sid,
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain, path=path,
+                secure=self.get_cookie_secure(app)
+            )
@@ -0,0 +1,63 @@
+"""Slugs for post permalinks, and an in-process index from slug to id."""
+from collections import OrderedDict
+from threading import Lock
+import hashlib
+import re
+import unicodedata
+
+MAX_SLUG_LENGTH = 200
+
+
+def slugify(title):
+    """Turn a title into a URL-safe slug: "Hello, World!" -> "hello-world".
+    A slug is never purely numeric, so it can't be mistaken for a post id.
+    """
+    if not isinstance(title, unicode):
+        title = title.decode('utf-8')
+    slug = unicodedata.normalize('NFKD', title).encode('ascii', 'ignore')
+    slug = re.sub(r'[^a-z0-9]+', '-', slug.lower()).strip('-')
+    slug = slug[:MAX_SLUG_LENGTH].rstrip('-')
+    if not slug or slug.isdigit():
+        slug = ('post-' + slug).rstrip('-')
+    return slug
+
+
+def disambiguate(slug, title):
+    """Return slug with a suffix derived from title, for a title whose slug
+    is already taken by a different title."""
+    if isinstance(title, unicode):
+        title = title.encode('utf-8')
+    return '%s-%s' % (slug, hashlib.md5(title).hexdigest()[:8])
+
+
+class SlugIndex(object):
+    """A bounded LRU map from slug to post id. Slugs never change once a
+    post is written, so entries never need invalidating.
+    """
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.ids = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, slug):
+        with self.lock:
+            id = self.ids.pop(slug, None)
+            if id is not None:
+                self.ids[slug] = id
+                self.hits += 1
+            else:
+                self.misses += 1
+            return id
+
+    def add(self, slug, id):
+        with self.lock:
+            self.ids.pop(slug, None)
+            self.ids[slug] = id
+            while len(self.ids) > self.maxsize:
+                self.ids.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.ids.clear()
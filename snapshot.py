@@ -0,0 +1,230 @@
+"""Export of the public pages of the blog as static HTML, for nginx to serve
+to anonymous visitors without reaching the app.
+
+The snapshot holds the home page split into pages of POSTS_PER_PAGE posts
+(index.html, then page/2, page/3, ...), a page for every post, archived or
+not (posts/<slug>), and the first page of every author (users/<username>).
+Pages are rendered with the app's own templates as an anonymous visitor
+sees them, so view counts and the like are as of the export.
+
+The posts and users are streamed in keyset order, so no query holds more
+than a batch in memory, and each batch of pages is rendered in a pool of
+worker processes. A file is only rewritten when its content has changed,
+and files for pages that no longer exist are removed, so repeated exports
+only touch what changed and a CDN or rsync can pick up just that.
+
+write_post() calls refresh() to put a new post on the first index page and
+its author's page at once. Everything else a post changes, such as the
+later index pages it pushes a post onto, and posts that are archived, only
+reaches the snapshot at the next full export, so export_snapshot should
+still run regularly, e.g. every few minutes from cron.
+"""
+from multiprocessing import Pool, cpu_count
+from itertools import islice
+import os
+
+SECTIONS = ('page', 'posts', 'users')
+
+
+def _safe_name(name):
+    #Names become file names; anything that can't be one is left to the
+    #app.
+    return name and '/' not in name and not name.startswith('.')
+
+
+def write_if_changed(root, path, content):
+    """Write content to root/path unless the file already holds exactly
+    that. Returns True if the file was written."""
+    full_path = os.path.join(root, path)
+    try:
+        with open(full_path, 'rb') as f:
+            if f.read() == content:
+                return False
+    except IOError:
+        directory = os.path.dirname(full_path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                #Another worker created it first.
+                pass
+    temp_path = '%s.%d.tmp' % (full_path, os.getpid())
+    with open(temp_path, 'wb') as f:
+        f.write(content)
+    os.rename(temp_path, full_path)
+    return True
+
+
+def _render_index(page, before, last):
+    import microblog
+    count = microblog.app.config['POSTS_PER_PAGE']
+    posts = microblog.read_posts_page(before=before, count=count)
+    html = microblog.render_template(
+        'list.html', posts=posts, post_total=microblog.read_stat('posts'),
+        next_page=None if last else '/page/%d' % (page + 1))
+    return [('index.html' if page == 1 else 'page/%d' % page, html)]
+
+
+def _render_posts(ids):
+    import microblog
+    posts = []
+    for model in (microblog.Post, microblog.ArchivedPost):
+        posts.extend(model.query.filter(model.id.in_(ids)))
+    return [('posts/%s' % post.slug, microblog.render_template(
+        'permalink.html', post=post, views=post.views))
+        for post in posts if _safe_name(post.slug)]
+
+
+def _render_authors(ids):
+    import microblog
+    count = microblog.app.config['POSTS_PER_PAGE']
+    pages = []
+    for author in microblog.User.query.filter(microblog.User.id.in_(ids)):
+        if not _safe_name(author.username):
+            continue
+        posts = microblog.read_posts_by_author(author.id, count=count + 1)
+        next_cursor = None
+        if len(posts) > count:
+            posts = posts[:count]
+            next_cursor = microblog.encode_cursor(posts[-1])
+        pages.append(('users/%s' % author.username, microblog.render_template(
+            'author.html', author=author, posts=posts,
+            next_cursor=next_cursor, following=False)))
+    return pages
+
+
+RENDERERS = {
+    'index': _render_index,
+    'posts': _render_posts,
+    'authors': _render_authors,
+}
+
+
+def render(task):
+    """Render one task's pages into the snapshot at root. Returns the
+    paths of its pages and how many of them were written."""
+    import microblog
+    root, kind, args = task
+    with microblog.app.test_request_context():
+        pages = RENDERERS[kind](*args)
+    written = sum(write_if_changed(root, path, html.encode('utf-8'))
+                  for path, html in pages)
+    return [path for path, html in pages], written
+
+
+def refresh(root, post_id, auth_id):
+    """Render the pages a new post appears on straight away: the first
+    index page, the post's own page and its author's page. Reads go to
+    the primary, since the post has only just been committed."""
+    import microblog
+    count = microblog.app.config['POSTS_PER_PAGE']
+    with microblog.app.test_request_context():
+        microblog.db.session().primary_only = True
+        last = len(microblog.read_posts_page(count=count + 1)) <= count
+        pages = _render_index(1, None, last) + _render_posts([post_id]) + \
+            _render_authors([auth_id])
+    for path, html in pages:
+        write_if_changed(root, path, html.encode('utf-8'))
+
+
+def _stream(query, timestamp_column, id_column, batch_size):
+    import microblog
+    before = None
+    while True:
+        rows = microblog._page(
+            query, timestamp_column, id_column, before, batch_size).all()
+        for row in rows:
+            yield row
+        if len(rows) < batch_size:
+            return
+        before = (rows[-1].timestamp, rows[-1].id)
+
+
+def tasks(root, batch_size):
+    """Generate the tasks that render the whole snapshot into root."""
+    import microblog
+    db, Post, ArchivedPost, User = microblog.db, microblog.Post, \
+        microblog.ArchivedPost, microblog.User
+    count = microblog.app.config['POSTS_PER_PAGE']
+
+    #Index pages are found while streaming: a page starts at every
+    #count-th post, and its cursor is the position of the post before it.
+    page, page_before, before, ids = 0, None, None, []
+    for i, row in enumerate(_stream(
+            db.session.query(Post.timestamp, Post.id),
+            Post.timestamp, Post.id, batch_size)):
+        if i % count == 0:
+            if page:
+                yield root, 'index', (page, page_before, False)
+            page, page_before = page + 1, before
+        before = (row.timestamp, row.id)
+        ids.append(row.id)
+        if len(ids) == batch_size:
+            yield root, 'posts', (ids,)
+            ids = []
+    yield root, 'index', (max(page, 1), page_before, True)
+
+    for row in _stream(
+            db.session.query(ArchivedPost.timestamp, ArchivedPost.id),
+            ArchivedPost.timestamp, ArchivedPost.id, batch_size):
+        ids.append(row.id)
+        if len(ids) == batch_size:
+            yield root, 'posts', (ids,)
+            ids = []
+    if ids:
+        yield root, 'posts', (ids,)
+
+    ids = []
+    for row in _stream(db.session.query(User.timestamp, User.id),
+                       User.timestamp, User.id, batch_size):
+        ids.append(row.id)
+        if len(ids) == batch_size:
+            yield root, 'authors', (ids,)
+            ids = []
+    if ids:
+        yield root, 'authors', (ids,)
+
+
+def export(root, processes=None, batch_size=500):
+    """Render the snapshot into root with a pool of processes, then remove
+    the pages that are no longer part of it. Returns the number of pages
+    rendered, written and removed."""
+    import microblog
+    #Connections must not be shared with the forked workers.
+    microblog.db.session.remove()
+    microblog.db.engine.dispose()
+    processes = processes or cpu_count()
+    pool = Pool(processes)
+    try:
+        paths, written = set(), 0
+        #Tasks are handed out a few per worker at a time, so that the
+        #streaming queries run in this thread and never get far ahead.
+        pending = tasks(root, batch_size)
+        while True:
+            chunk = list(islice(pending, processes * 4))
+            if not chunk:
+                break
+            for task_paths, task_written in pool.imap_unordered(
+                    render, chunk):
+                paths.update(task_paths)
+                written += task_written
+    finally:
+        pool.close()
+        pool.join()
+    return len(paths), written, remove_stale(root, paths)
+
+
+def remove_stale(root, paths):
+    """Remove the snapshot's files under root that aren't in paths."""
+    removed = 0
+    candidates = ['index.html']
+    for section in SECTIONS:
+        for directory, dirs, files in os.walk(os.path.join(root, section)):
+            candidates.extend(
+                os.path.relpath(os.path.join(directory, name), root)
+                for name in files)
+    for path in candidates:
+        if path not in paths and os.path.exists(os.path.join(root, path)):
+            os.remove(os.path.join(root, path))
+            removed += 1
+    return removed
@@ -1,8 +1,23 @@
 import unittest
 import microblog
+import assets
+import sessions
+import slugs
+from compression import GzipMiddleware
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
 from sqlalchemy.exc import IntegrityError
 import flask
 import re
+import os
+import tempfile
+import shutil
+import jinja2
+import zlib
+import json
+import time
+import datetime
+import distutils.spawn
 
 
 class TestWritePost(unittest.TestCase):
@@ -33,27 +48,47 @@ class TestWritePost(unittest.TestCase):
 
     def test_write_post_no_title(self):
         """Attempt to submit a post that does not have a title and assert
-        that the operation raises the proper IntegrityError and didn't
-        add any data to the database.
+        that the operation raises a ValueError saying so and didn't add
+        any data to the database.
         """
-        self.assertRaises(IntegrityError, microblog.write_post,
-            ('', self.body, self.auth_id))
+        with self.assertRaises(ValueError) as cm:
+            microblog.write_post('', self.body, self.auth_id)
+        self.assertEqual(cm.exception.message, ["Posts must have a title."])
+        self.assertEqual(len(microblog.read_posts()), 0)
 
     def test_write_post_no_body(self):
         """Attempt to submit a post that does not have a body and assert
-        that the operation raises the proper IntegrityError and didn't
-        add any data to the database.
+        that the operation raises a ValueError saying so and didn't add
+        any data to the database.
         """
-        self.assertRaises(IntegrityError, microblog.write_post,
-            (self.title, '', self.auth_id))
+        with self.assertRaises(ValueError) as cm:
+            microblog.write_post(self.title, '', self.auth_id)
+        self.assertEqual(cm.exception.message, ["Posts must have a body."])
+        self.assertEqual(len(microblog.read_posts()), 0)
 
     def test_write_post_no_author(self):
         """Attempt to submit a post that does not have an auth_id and
-        assert that the operation raises the proper IntegrityError and
-        didn't add any data to the database.
+        assert that the operation raises a ValueError and didn't add any
+        data to the database.
         """
-        self.assertRaises(IntegrityError, microblog.write_post,
-            (self.title, self.body, ''))
+        self.assertRaises(
+            ValueError, microblog.write_post, self.title, self.body, '')
+        self.assertEqual(len(microblog.read_posts()), 0)
+
+    def test_write_post_duplicate_title(self):
+        """Attempt to submit a second post with the same title and assert
+        that the operation raises a ValueError saying so, leaving the first
+        post and the post counters untouched.
+        """
+        microblog.write_post(self.title, self.body, self.auth_id)
+        with self.assertRaises(ValueError) as cm:
+            microblog.write_post(self.title, "Another Body", self.auth_id)
+        self.assertEqual(
+            cm.exception.message, ["A post with this title already exists."])
+        posts = microblog.read_posts()
+        self.assertEqual(len(posts), 1)
+        self.assertEqual(posts[0].body, self.body)
+        self.assertEqual(microblog.read_stat('posts'), 1)
 
     def test_write_post_nonexistant_author(self):
         """Attempt to submit a post that does not has an auth_id not
@@ -62,7 +97,7 @@ class TestWritePost(unittest.TestCase):
         database.
         """
         self.assertRaises(IntegrityError, microblog.write_post,
-            (self.title, self.body, '4'))
+            self.title, self.body, 4)
 
 
 class TestReadPosts(unittest.TestCase):
@@ -108,6 +143,18 @@ class TestReadPosts(unittest.TestCase):
         self.assertEqual(posts[0].body, self.body)
         self.assertEqual(posts[0].auth_id, self.auth_id)
 
+    def test_read_posts_yield_per(self):
+        """Verify that passing yield_per returns the same posts, in the
+        same order, through a generator.
+        """
+        microblog.write_post(self.title, self.body, self.auth_id)
+        posts = microblog.read_posts(yield_per=1)
+        self.assertFalse(isinstance(posts, list))
+        self.assertEqual(
+            [post.title for post in posts],
+            [post.title for post in microblog.read_posts()]
+        )
+
 
 class TestReadPost(unittest.TestCase):
     """Test the read_post function of the microblog."""
@@ -142,6 +189,1030 @@ class TestReadPost(unittest.TestCase):
         self.assertRaises(microblog.NotFoundError, microblog.read_post, 4)
 
 
+class TestSlugs(unittest.TestCase):
+    """Test slug generation in slugs.py and in write_post."""
+    def setUp(self):
+        microblog.slug_index.clear()
+        microblog.db.create_all()
+        microblog.add_user(
+            'admin', 'password', 'email@email.com', confirm=False)
+        self.auth_id = \
+            microblog.User.query.filter_by(username='admin').first().id
+
+    def tearDown(self):
+        microblog.db.session.remove()
+        microblog.db.drop_all()
+
+    def test_slugify(self):
+        self.assertEqual(slugs.slugify("Hello, World!"), 'hello-world')
+        self.assertEqual(slugs.slugify(u"Caf\xe9 Cr\xe8me"), 'cafe-creme')
+        self.assertEqual(slugs.slugify("1984"), 'post-1984')
+        self.assertEqual(slugs.slugify("!!!"), 'post')
+
+    def test_write_post_slug_collision(self):
+        """Two titles with the same slug should both be written, the second
+        with a disambiguated slug.
+        """
+        first = microblog.write_post("Hello!", "A Blog Body", self.auth_id)
+        second = microblog.write_post("Hello?", "A Blog Body", self.auth_id)
+        self.assertEqual(microblog.read_post(first).slug, 'hello')
+        self.assertTrue(
+            re.match(r'hello-[0-9a-f]{8}$', microblog.read_post(second).slug))
+        self.assertEqual(
+            microblog.read_post_by_slug(
+                microblog.read_post(second).slug).title, "Hello?")
+
+
+class TestReadPostsByAuthor(unittest.TestCase):
+    """Test the read_posts_by_author function of the microblog."""
+    def setUp(self):
+        microblog.db.create_all()
+        microblog.add_user(
+            'admin', 'password', 'email@email.com', confirm=False)
+        microblog.add_user(
+            'other', 'password', 'other@email.com', confirm=False)
+        self.auth_id = \
+            microblog.User.query.filter_by(username='admin').first().id
+        self.other_id = \
+            microblog.User.query.filter_by(username='other').first().id
+        for i in range(5):
+            microblog.write_post("Blog %d" % i, "A Blog Body", self.auth_id)
+        microblog.write_post("Other Blog", "A Blog Body", self.other_id)
+
+    def tearDown(self):
+        microblog.db.session.remove()
+        microblog.db.drop_all()
+
+    def test_read_posts_by_author(self):
+        """Verify that only the author's posts are returned, newest
+        first.
+        """
+        posts = microblog.read_posts_by_author(self.auth_id)
+        self.assertEqual(
+            [post.title for post in posts],
+            ["Blog %d" % i for i in reversed(range(5))]
+        )
+
+    def test_read_posts_by_author_pages(self):
+        """Walk the author's posts two at a time using cursors and verify
+        that every post is seen exactly once, in order.
+        """
+        titles = []
+        before = None
+        while True:
+            posts = microblog.read_posts_by_author(
+                self.auth_id, before=before, count=2)
+            if not posts:
+                break
+            titles.extend(post.title for post in posts)
+            before = microblog.decode_cursor(
+                microblog.encode_cursor(posts[-1]))
+        self.assertEqual(titles, ["Blog %d" % i for i in reversed(range(5))])
+
+    def test_user_posts_is_a_query(self):
+        """User.posts should be a query rather than a loaded list."""
+        user = microblog.User.query.get(self.auth_id)
+        self.assertEqual(user.posts.count(), 5)
+
+
+class TestPostCounters(unittest.TestCase):
+    """Test the per-user and sitewide post counters maintained by
+    write_post.
+    """
+    def setUp(self):
+        microblog.db.create_all()
+        microblog.add_user(
+            'admin', 'password', 'email@email.com', confirm=False)
+        microblog.add_user(
+            'other', 'password', 'other@email.com', confirm=False)
+        self.auth_id = \
+            microblog.User.query.filter_by(username='admin').first().id
+        self.other_id = \
+            microblog.User.query.filter_by(username='other').first().id
+        for i in range(3):
+            microblog.write_post("Blog %d" % i, "A Blog Body", self.auth_id)
+        microblog.write_post("Other Blog", "A Blog Body", self.other_id)
+
+    def tearDown(self):
+        microblog.db.session.remove()
+        microblog.db.drop_all()
+
+    def test_write_post_counts(self):
+        microblog.db.session.expire_all()
+        self.assertEqual(microblog.User.query.get(self.auth_id).post_count, 3)
+        self.assertEqual(microblog.User.query.get(self.other_id).post_count, 1)
+        self.assertEqual(microblog.read_stat('posts'), 4)
+
+    def test_rebuild_counters(self):
+        """Clobber the counters and verify that rebuild_counters restores
+        them from the posts table.
+        """
+        microblog.User.query.update({'post_count': 0})
+        microblog.db.session.delete(microblog.SiteStat.query.get('posts'))
+        microblog.db.session.commit()
+        microblog.rebuild_counters()
+        microblog.db.session.expire_all()
+        self.assertEqual(microblog.User.query.get(self.auth_id).post_count, 3)
+        self.assertEqual(microblog.User.query.get(self.other_id).post_count, 1)
+        self.assertEqual(microblog.read_stat('posts'), 4)
+
+    def test_list_view_post_total(self):
+        with microblog.app.test_client() as c:
+            request = c.get('/')
+            self.assertIn('4 posts', request.data)
+
+
+class TestOnlineMigrations(unittest.TestCase):
+    """Test the batched, resumable backfills and index helpers used by
+    migrations."""
+    def setUp(self):
+        import online_migrations
+        self.online = online_migrations
+        microblog.db.create_all()
+        microblog.add_user(
+            'admin', 'password', 'email@email.com', confirm=False)
+        self.ids = [microblog.write_post("Blog %d" % i, "A Blog Body", 1)
+                    for i in range(5)]
+        self.connection = microblog.db.engine.connect()
+
+    def tearDown(self):
+        self.online.progress.drop(self.connection, checkfirst=True)
+        self.connection.close()
+        microblog.db.session.remove()
+        microblog.db.drop_all()
+
+    def views(self):
+        microblog.db.session.expire_all()
+        return [microblog.Post.query.get(id).views for id in self.ids]
+
+    def test_backfill(self):
+        self.online.backfill(
+            'test_views', 'posts', "views = 7", where="id <> 3",
+            batch_size=2, pause=0, connection=self.connection)
+        self.assertEqual(self.views(), [7, 7, 0, 7, 7])
+        row, = self.online.read_progress(self.connection)
+        self.assertEqual(row.name, 'test_views')
+        self.assertTrue(row.finished)
+
+    def test_backfill_resumes(self):
+        """An interrupted backfill carries on after the last batch it
+        recorded, and a finished one isn't run again."""
+        self.online.progress.create(self.connection)
+        self.connection.execute(self.online.progress.insert().values(
+            name='test_views', position=2, finished=False,
+            updated=datetime.datetime.utcnow()))
+        self.online.backfill(
+            'test_views', 'posts', "views = views + 1",
+            batch_size=2, pause=0, connection=self.connection)
+        self.assertEqual(self.views(), [0, 0, 1, 1, 1])
+        self.online.backfill(
+            'test_views', 'posts', "views = views + 1",
+            batch_size=2, pause=0, connection=self.connection)
+        self.assertEqual(self.views(), [0, 0, 1, 1, 1])
+
+    def test_backfill_empty_table(self):
+        self.online.backfill(
+            'test_timelines', 'timelines', "post_id = post_id",
+            key='post_id', pause=0, connection=self.connection)
+        self.assertTrue(self.online.read_progress(self.connection)[0].finished)
+
+    def test_backfill_function(self):
+        """A backfill can be written by a function called for each
+        batch."""
+        batches = []
+
+        def update(connection, lower, upper):
+            batches.append((lower, upper))
+            connection.execute(
+                "UPDATE posts SET views = id WHERE id > %d AND id <= %d" % (
+                    lower, upper))
+
+        self.online.backfill('test_views', 'posts', update, batch_size=2,
+                             pause=0, connection=self.connection)
+        self.assertEqual(batches, [(0, 2), (2, 4), (4, 6)])
+        self.assertEqual(self.views(), self.ids)
+
+    @unittest.skipUnless(
+        microblog.app.config['SQLALCHEMY_DATABASE_URI'].startswith(
+            'postgresql'), "needs PostgreSQL")
+    def test_inside_migration_transaction(self):
+        """Migrations call the helpers inside their transaction, which
+        CREATE INDEX CONCURRENTLY can't run in. Work done before the call
+        is committed, and the helpers still run."""
+        import sqlalchemy
+        transaction = self.connection.begin()
+        self.connection.execute("UPDATE posts SET views = 1")
+        self.online.create_index_concurrently(
+            'ix_posts_views', 'posts', ['views'], connection=self.connection)
+        self.online.backfill(
+            'test_views', 'posts', "views = views + 1",
+            batch_size=2, pause=0, connection=self.connection)
+        self.online.set_not_null(
+            'posts', 'views', connection=self.connection)
+        self.online.drop_index_concurrently(
+            'ix_posts_views', connection=self.connection)
+        transaction.commit()
+        self.assertEqual(self.views(), [2] * 5)
+        indexes = sqlalchemy.inspect(self.connection).get_indexes('posts')
+        self.assertNotIn(
+            'ix_posts_views', [index['name'] for index in indexes])
+
+    def test_create_index(self):
+        import sqlalchemy
+        self.online.create_index_concurrently(
+            'ix_posts_views', 'posts', ['views'], connection=self.connection)
+        indexes = sqlalchemy.inspect(self.connection).get_indexes('posts')
+        self.assertIn('ix_posts_views', [index['name'] for index in indexes])
+        self.online.drop_index_concurrently(
+            'ix_posts_views', connection=self.connection)
+        indexes = sqlalchemy.inspect(self.connection).get_indexes('posts')
+        self.assertNotIn(
+            'ix_posts_views', [index['name'] for index in indexes])
+
+
+class TestReadReplicas(unittest.TestCase):
+    """Test the routing of read-only queries to a read replica. A SQLite
+    file stands in for the replica, so it never receives the primary's
+    writes.
+    """
+    def setUp(self):
+        self.replica_path = os.path.join(tempfile.mkdtemp(), 'replica.db')
+        microblog.app.config['SQLALCHEMY_BINDS'] = {
+            'replica': 'sqlite:///%s' % self.replica_path,
+        }
+        microblog.app.config['SQLALCHEMY_READ_REPLICAS'] = ['replica']
+        microblog.db.create_all()
+        microblog.db.Model.metadata.create_all(
+            bind=microblog.db.get_engine(microblog.app, 'replica'))
+        microblog.add_user(
+            'admin', 'password', 'email@email.com', confirm=False)
+        self.auth_id = \
+            microblog.User.query.filter_by(username='admin').first().id
+
+    def tearDown(self):
+        microblog.db.session.remove()
+        microblog.db.drop_all()
+        microblog.app.config['SQLALCHEMY_BINDS'] = {}
+        microblog.app.config['SQLALCHEMY_READ_REPLICAS'] = []
+        microblog.app.config['READ_REPLICA_STICKY_SECONDS'] = 5
+        os.remove(self.replica_path)
+
+    def test_reads_go_to_replica(self):
+        """With no sticky window, read_posts() should read from the
+        (empty) replica rather than the primary.
+        """
+        microblog.app.config['READ_REPLICA_STICKY_SECONDS'] = 0
+        microblog.write_post("A Blog Title", "A Blog Body", self.auth_id)
+        self.assertEqual(len(microblog.read_posts()), 0)
+        self.assertRaises(microblog.NotFoundError, microblog.read_post, 1)
+
+    def test_reads_stick_to_primary_after_commit(self):
+        """A read made right after a commit should see that commit."""
+        microblog.write_post("A Blog Title", "A Blog Body", self.auth_id)
+        posts = microblog.read_posts()
+        self.assertEqual(len(posts), 1)
+        self.assertEqual(posts[0].title, "A Blog Title")
+
+    def test_login_sticks_to_primary_for_pinned_client(self):
+        """A client whose cookie session was pinned by a recent commit
+        should have its login lookup read from the primary; any other
+        client reads from the replica.
+        """
+        microblog.db.session.remove()
+        data = {'username': 'admin', 'password': 'password'}
+        with microblog.app.test_client() as c:
+            request = c.post('/login', data=data, follow_redirects=True)
+            self.assertIn('This user does not exist.', request.data)
+
+        microblog.db.session.remove()
+        with microblog.app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess['_primary_until'] = time.time() + 5
+            request = c.post('/login', data=data, follow_redirects=True)
+            self.assertIn('Logged in as admin', request.data)
+
+    def test_cache_refresh_reads_primary(self):
+        """Pages fetched to refresh the HTTP cache are read from the
+        primary, but only when the request comes from the app's host."""
+        microblog.app.config['READ_REPLICA_STICKY_SECONDS'] = 0
+        microblog.write_post("A Blog Title", "A Blog Body", self.auth_id)
+        headers = {'X-Cache-Refresh': '1'}
+        for remote_addr, visible in (('10.0.0.1', False), ('127.0.0.1', True)):
+            microblog.db.session.remove()
+            with microblog.app.test_client() as c:
+                request = c.get('/', headers=headers,
+                                environ_base={'REMOTE_ADDR': remote_addr})
+            self.assertEqual('A Blog Title' in request.data, visible)
+
+
+class TestArchive(unittest.TestCase):
+    """Test moving old posts to posts_archive."""
+    def setUp(self):
+        import partitioning
+        self.partitioning = partitioning
+        microblog.db.create_all()
+        microblog.add_user(
+            'admin', 'password', 'email@email.com', confirm=False)
+        self.ids = [microblog.write_post("Blog %d" % i, "A Blog Body", 1)
+                    for i in range(5)]
+        microblog.Post.query.filter(microblog.Post.id <= self.ids[2]).update(
+            {microblog.Post.timestamp: datetime.datetime(2020, 1, 1)},
+            synchronize_session=False)
+        microblog.db.session.commit()
+        self.connection = microblog.db.engine.connect()
+
+    def tearDown(self):
+        self.connection.close()
+        microblog.slug_index.clear()
+        microblog.db.session.remove()
+        microblog.db.drop_all()
+
+    def archive(self):
+        return self.partitioning.archive_posts(
+            self.connection, datetime.datetime(2021, 1, 1), batch_size=2,
+            pause=0)
+
+    def test_archive_posts(self):
+        self.assertEqual(self.archive(), 3)
+        self.assertEqual(
+            sorted(post.id for post in microblog.ArchivedPost.query),
+            self.ids[:3])
+        self.assertEqual([post.title for post in microblog.read_posts()],
+                         ["Blog 4", "Blog 3"])
+        self.assertEqual(self.archive(), 0)
+
+    def test_read_archived_post(self):
+        """Archived posts are still found by id and by slug."""
+        self.archive()
+        self.assertEqual(microblog.read_post(self.ids[0]).title, "Blog 0")
+        self.assertEqual(
+            microblog.read_post_by_slug('blog-1').author.username, 'admin')
+
+    def test_newest_post_archived(self):
+        """Archived ids above every live one are still found, even by a
+        process that didn't write them."""
+        microblog.Post.query.filter_by(id=self.ids[4]).update(
+            {microblog.Post.timestamp: datetime.datetime(2020, 1, 1)})
+        microblog.db.session.commit()
+        self.archive()
+        microblog._max_post_id.update(id=None, checked=0)
+        with microblog.app.test_client() as c:
+            self.assertEqual(
+                c.get('/posts/%d' % self.ids[4]).status_code, 200)
+            self.assertEqual(c.get('/posts/blog-4').status_code, 200)
+
+    def test_archived_post_views_counted(self):
+        self.archive()
+        counter = microblog.view_counter
+        counter.pending.clear()
+        counter.add(self.ids[0], 2)
+        counter.add(self.ids[4])
+        counter.flush()
+        self.assertEqual(
+            microblog.ArchivedPost.query.get(self.ids[0]).views, 2)
+        self.assertEqual(microblog.Post.query.get(self.ids[4]).views, 1)
+
+    def test_archived_title_stays_taken(self):
+        self.archive()
+        with self.assertRaises(ValueError):
+            microblog.write_post("Blog 0", "Another Body", 1)
+
+    def test_archived_post_in_sitemap(self):
+        self.archive()
+        path = os.path.join(tempfile.mkdtemp(), 'sitemap-0.xml')
+        try:
+            with microblog.app.test_request_context():
+                microblog.write_sitemap_chunk(0, path)
+            with open(path) as f:
+                sitemap = f.read()
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+        for id in self.ids:
+            self.assertIn('/posts/blog-%d' % (id - 1), sitemap)
+
+    def test_partition_names(self):
+        month = self.partitioning.month_start(
+            datetime.datetime(2020, 12, 31, 23, 59))
+        self.assertEqual(month, datetime.datetime(2020, 12, 1))
+        self.assertEqual(self.partitioning.add_months(month, 1),
+                         datetime.datetime(2021, 1, 1))
+        name = self.partitioning.partition_name('posts', month)
+        self.assertEqual(name, 'posts_2020_12')
+        self.assertEqual(self.partitioning.partition_month(name), month)
+        self.assertFalse(self.partitioning.is_partitioned(self.connection))
+
+
+class TestTimelines(unittest.TestCase):
+    """Test following users and reading home timelines."""
+    def setUp(self):
+        microblog.db.create_all()
+        for name in ('reader', 'author', 'other'):
+            microblog.add_user(
+                name, 'password', '%s@email.com' % name, confirm=False)
+        self.reader, self.author, self.other = [
+            microblog.User.query.filter_by(username=name).first().id
+            for name in ('reader', 'author', 'other')]
+        microblog.write_post("Early", "A Blog Body", self.author)
+        microblog._popular['checked'] = 0
+
+    def tearDown(self):
+        microblog.app.config['TIMELINE_FAN_OUT_LIMIT'] = 10000
+        microblog.db.session.remove()
+        microblog.db.drop_all()
+
+    def titles(self, **kwargs):
+        return [post.title
+                for post in microblog.read_timeline(self.reader, **kwargs)]
+
+    def test_follow(self):
+        """Following backfills existing posts, later posts are fanned out,
+        and posts by users not followed never appear."""
+        microblog.follow(self.reader, self.author)
+        self.assertEqual(self.titles(), ["Early"])
+        microblog.write_post("Late", "A Blog Body", self.author)
+        microblog.write_post("Elsewhere", "A Blog Body", self.other)
+        self.assertEqual(self.titles(), ["Late", "Early"])
+        self.assertEqual(
+            microblog.User.query.get(self.author).follower_count, 1)
+
+    def test_follow_twice(self):
+        microblog.follow(self.reader, self.author)
+        microblog.follow(self.reader, self.author)
+        self.assertEqual(self.titles(), ["Early"])
+        self.assertEqual(
+            microblog.User.query.get(self.author).follower_count, 1)
+
+    def test_follow_self(self):
+        with self.assertRaises(ValueError):
+            microblog.follow(self.reader, self.reader)
+
+    def test_unfollow(self):
+        microblog.follow(self.reader, self.author)
+        microblog.follow(self.reader, self.other)
+        microblog.write_post("Elsewhere", "A Blog Body", self.other)
+        microblog.unfollow(self.reader, self.author)
+        self.assertEqual(self.titles(), ["Elsewhere"])
+        self.assertEqual(
+            microblog.User.query.get(self.author).follower_count, 0)
+
+    def test_popular_author(self):
+        """Posts by an author with too many followers to fan out to are
+        pulled into the timeline when it is read, merged in order and
+        paginated with the rest."""
+        microblog.follow(self.reader, self.other)
+        microblog.follow(self.reader, self.author)
+        microblog.follow(self.other, self.author)
+        microblog.write_post("Other 1", "A Blog Body", self.other)
+        microblog.app.config['TIMELINE_FAN_OUT_LIMIT'] = 1
+        microblog.write_post("Popular", "A Blog Body", self.author)
+        microblog.write_post("Other 2", "A Blog Body", self.other)
+        self.assertFalse(microblog.TimelineEntry.query.join(
+            microblog.Post).filter_by(title="Popular").count())
+        self.assertEqual(
+            self.titles(), ["Other 2", "Popular", "Other 1", "Early"])
+        first = microblog.read_timeline(self.reader, count=2)
+        self.assertEqual(
+            self.titles(before=(first[-1].timestamp, first[-1].id), count=2),
+            ["Other 1", "Early"])
+
+    def test_author_no_longer_popular(self):
+        """Posts written while their author was above the fan out limit
+        stay in the timeline once the author falls back under it."""
+        microblog.follow(self.reader, self.author)
+        microblog.follow(self.other, self.author)
+        microblog.app.config['TIMELINE_FAN_OUT_LIMIT'] = 1
+        microblog.write_post("Popular", "A Blog Body", self.author)
+        self.assertEqual(self.titles(), ["Popular", "Early"])
+        microblog.unfollow(self.other, self.author)
+        microblog._popular['checked'] = 0
+        self.assertEqual(self.titles(), ["Popular", "Early"])
+        microblog.write_post("Unpopular", "A Blog Body", self.author)
+        self.assertEqual(self.titles(), ["Unpopular", "Popular", "Early"])
+
+    def test_timeline_view(self):
+        with microblog.app.test_client() as c:
+            c.post('/login', data={
+                'username': 'reader', 'password': 'password'})
+            request = c.post('/users/author/follow', follow_redirects=True)
+            self.assertIn('Unfollow', request.data)
+            request = c.get('/timeline')
+            self.assertIn('Early', request.data)
+            c.post('/users/author/follow', data={'unfollow': '1'})
+            request = c.get('/timeline')
+            self.assertNotIn('Early', request.data)
+
+    def test_timeline_view_not_logged_in(self):
+        with microblog.app.test_client() as c:
+            request = c.get('/timeline')
+            self.assertEqual(request.status_code, 302)
+
+
+class TestEventStream(unittest.TestCase):
+    """Test the /stream Server-Sent Events endpoint."""
+    def setUp(self):
+        microblog.db.create_all()
+        microblog.add_user(
+            'admin', 'password', 'email@email.com', confirm=False)
+        self.first_id = microblog.write_post("Blog 1", "A Blog Body", 1)
+        #The tests poll themselves.
+        microblog.app.config['EVENT_STREAM_POLL_INTERVAL'] = 0
+
+    def tearDown(self):
+        microblog.app.config['EVENT_STREAM_HEARTBEAT'] = 15
+        microblog.app.config['EVENT_STREAM_POLL_INTERVAL'] = 1
+        microblog._published['last_id'] = None
+        microblog.post_events.max_subscribers = \
+            microblog.app.config['EVENT_STREAM_MAX_SUBSCRIBERS']
+        microblog.db.session.remove()
+        microblog.db.drop_all()
+
+    def open_stream(self, headers=None):
+        with microblog.app.test_request_context('/stream', headers=headers):
+            response = microblog.stream_view()
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        return response.response
+
+    def test_stream(self):
+        stream = self.open_stream()
+        self.assertTrue(next(stream).startswith('retry:'))
+        post_id = microblog.write_post("Blog 2", "A Blog Body", 1)
+        event = next(stream)
+        self.assertIn('id: %d\nevent: post\n' % post_id, event)
+        data = json.loads(re.search(r'data: (.*)', event).group(1))
+        self.assertEqual(data['title'], "Blog 2")
+        self.assertEqual(data['author'], 'admin')
+        stream.close()
+        self.assertFalse(microblog.post_events.subscriptions)
+
+    def test_heartbeat(self):
+        microblog.app.config['EVENT_STREAM_HEARTBEAT'] = 0.01
+        stream = self.open_stream()
+        next(stream)
+        self.assertEqual(next(stream), ': heartbeat\n\n')
+        stream.close()
+
+    def test_replay(self):
+        """A reconnecting client is sent the posts it missed, and no post
+        twice."""
+        microblog.write_post("Blog 2", "A Blog Body", 1)
+        stream = self.open_stream({'Last-Event-ID': str(self.first_id)})
+        next(stream)
+        self.assertIn('Blog 2', next(stream))
+        microblog.write_post("Blog 3", "A Blog Body", 1)
+        self.assertIn('Blog 3', next(stream))
+        stream.close()
+
+    def test_posts_from_other_workers(self):
+        """Posts another worker wrote are published by polling, and posts
+        this one published itself aren't published again."""
+        stream = self.open_stream()
+        next(stream)
+        with microblog.app.app_context():
+            microblog.poll_post_events()
+        microblog.write_post("Blog 2", "A Blog Body", 1)
+        self.assertIn('Blog 2', next(stream))
+        microblog.db.session.add(
+            microblog.Post("Elsewhere", "A Blog Body", 1))
+        microblog.db.session.commit()
+        with microblog.app.app_context():
+            microblog.poll_post_events()
+        subscription, = microblog.post_events.subscriptions
+        messages = subscription.get(0)
+        self.assertEqual(len(messages), 1)
+        self.assertIn('Elsewhere', messages[0][1])
+        stream.close()
+
+    def test_too_many_subscribers(self):
+        microblog.post_events.max_subscribers = 0
+        with microblog.app.test_client() as c:
+            self.assertEqual(c.get('/stream').status_code, 503)
+
+    def test_slow_subscriber(self):
+        """A subscriber that falls behind keeps only the newest messages.
+        """
+        subscription = microblog.post_events.subscribe()
+        for i in range(microblog.post_events.maxlen + 5):
+            microblog.post_events.publish(i)
+        messages = subscription.get(0)
+        subscription.close()
+        self.assertEqual(len(messages), microblog.post_events.maxlen)
+        self.assertEqual(messages[-1], microblog.post_events.maxlen + 4)
+
+
+class TestViewCounts(unittest.TestCase):
+    """Test the buffered view counts of posts."""
+    def setUp(self):
+        microblog.db.create_all()
+        microblog.add_user(
+            'admin', 'password', 'email@email.com', confirm=False)
+        self.ids = [microblog.write_post("Blog %d" % i, "A Blog Body", 1)
+                    for i in range(3)]
+        self.counter = microblog.view_counter
+        self.counter.pending.clear()
+        self.counter.pending_total = 0
+        self.counter.top.counts.clear()
+        self.counter.last_flush = time.time()
+        self.counter.retry_at = 0
+        self.counter.flush_size = 1000
+
+    def tearDown(self):
+        self.counter.flush_size = microblog.app.config['VIEW_COUNT_FLUSH_SIZE']
+        microblog.db.session.remove()
+        microblog.db.drop_all()
+
+    def views(self, id):
+        microblog.db.session.expire_all()
+        return microblog.Post.query.get(id).views
+
+    def test_views_buffered(self):
+        """Views are written to the posts table only when flushed, but are
+        shown including those still pending."""
+        with microblog.app.test_client() as c:
+            for i in range(3):
+                request = c.get('/posts/%d' % self.ids[0])
+        self.assertIn('3 views', request.data)
+        self.assertEqual(self.views(self.ids[0]), 0)
+        self.counter.flush()
+        self.assertEqual(self.views(self.ids[0]), 3)
+        self.assertEqual(self.counter.get_pending(self.ids[0]), 0)
+
+    def test_flush_size(self):
+        self.counter.flush_size = 4
+        for id in [self.ids[0], self.ids[1], self.ids[0], self.ids[2]]:
+            self.counter.add(id)
+        self.assertEqual(
+            [self.views(id) for id in self.ids], [2, 1, 1])
+        self.assertFalse(self.counter.pending)
+
+    def test_failed_flush(self):
+        """Views whose flush fails are kept for the next one."""
+        import sqlalchemy
+        self.counter.add(self.ids[0])
+        table = self.counter.table
+        self.counter.table = sqlalchemy.Table(
+            'missing', sqlalchemy.MetaData(),
+            sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+            sqlalchemy.Column('views', sqlalchemy.Integer))
+        try:
+            with self.assertRaises(sqlalchemy.exc.SQLAlchemyError):
+                self.counter.flush()
+        finally:
+            self.counter.table = table
+        self.assertEqual(self.counter.get_pending(self.ids[0]), 1)
+        self.counter.flush()
+        self.assertEqual(self.views(self.ids[0]), 1)
+
+    def test_failed_flush_backs_off(self):
+        """After a failed flush, views are only buffered until the retry is
+        due, rather than each one trying the database again."""
+        import sqlalchemy
+        attempts = []
+
+        def get_engine():
+            attempts.append(time.time())
+            raise sqlalchemy.exc.OperationalError('', {}, Exception())
+        self.counter.flush_size = 1
+        get_real_engine = self.counter.get_engine
+        self.counter.get_engine = get_engine
+        try:
+            for i in range(3):
+                self.counter.add(self.ids[0])
+        finally:
+            self.counter.get_engine = get_real_engine
+        self.assertEqual(len(attempts), 1)
+        self.assertGreaterEqual(
+            self.counter.retry_at, attempts[0] + self.counter.flush_interval)
+        self.assertEqual(self.counter.get_pending(self.ids[0]), 3)
+        self.counter.retry_at = time.time()
+        self.counter.add(self.ids[0])
+        self.assertEqual(self.views(self.ids[0]), 4)
+        self.assertEqual(self.counter.retry_at, 0)
+
+    def test_most_viewed(self):
+        for id in [self.ids[1]] * 3 + [self.ids[2]] * 2 + [self.ids[0]]:
+            self.counter.add(id)
+        self.assertEqual(self.counter.top.top(2), self.ids[1:])
+        with microblog.app.test_client() as c:
+            request = c.get('/')
+        most_viewed = request.data[request.data.index('Most Viewed'):]
+        self.assertTrue(
+            re.search(r'Blog 1.*Blog 2.*Blog 0', most_viewed, re.DOTALL))
+
+    def test_top_counter(self):
+        """A frequent id stays tracked among many rare ones."""
+        import counters
+        top = counters.TopCounter(size=10)
+        for i in range(1000):
+            top.add(i)
+            if i % 3 == 0:
+                top.add('frequent')
+        self.assertEqual(top.top(1), ['frequent'])
+        self.assertEqual(len(top.counts), 10)
+
+
+class TestHttpCache(unittest.TestCase):
+    """Test the caching headers of anonymous pages and the refreshing of
+    cached pages when a post is written."""
+    def setUp(self):
+        microblog.db.create_all()
+        microblog.add_user(
+            'admin', 'password', 'email@email.com', confirm=False)
+        self.id = microblog.write_post("Blog", "A Blog Body", 1)
+        microblog.view_counter.pending.clear()
+
+    def tearDown(self):
+        microblog.app.config['HTTP_CACHE_PURGE_URL'] = None
+        microblog.db.session.remove()
+        microblog.db.drop_all()
+
+    def test_anonymous_pages_cacheable(self):
+        with microblog.app.test_client() as c:
+            for path, key in [('/', 'home'), ('/posts/blog', 'post/1'),
+                              ('/users/admin', 'author/admin')]:
+                request = c.get(path)
+                self.assertEqual(
+                    request.headers['Cache-Control'],
+                    'public, max-age=0, s-maxage=%d' %
+                    microblog.app.config['HTTP_CACHE_MAX_AGE'])
+                self.assertEqual(request.headers['Surrogate-Key'], key)
+                self.assertNotIn('Set-Cookie', request.headers)
+
+    def test_session_pages_private(self):
+        with microblog.app.test_client() as c:
+            c.post('/login', data={'username': 'admin',
+                                   'password': 'password'})
+            request = c.get('/')
+        self.assertEqual(request.headers['Cache-Control'], 'private, no-cache')
+        self.assertNotIn('Surrogate-Key', request.headers)
+
+    def test_untagged_pages(self):
+        with microblog.app.test_client() as c:
+            request = c.get('/login')
+        self.assertNotIn('Cache-Control', request.headers)
+
+    def test_purge_paths(self):
+        self.assertEqual(
+            microblog.http_cache.purge(
+                microblog.surrogate_key('home'),
+                microblog.surrogate_key('author', 'admin'),
+                microblog.surrogate_key('post', self.id)),
+            ['/', '/users/admin', '/posts/1', '/posts/blog'])
+
+    def test_write_post_refreshes(self):
+        """Writing a post fetches the home and author pages through the
+        purge URL, gzipped and not."""
+        import BaseHTTPServer
+        import threading
+        requests = []
+        refreshes = []
+        done = threading.Event()
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests.append(
+                    (self.path, self.headers.get('Accept-Encoding')))
+                refreshes.append(self.headers.get('X-Cache-Refresh'))
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                if len(requests) == 4:
+                    done.set()
+
+            def log_message(self, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            microblog.app.config['HTTP_CACHE_PURGE_URL'] = \
+                'http://127.0.0.1:%d' % server.server_address[1]
+            microblog.write_post("Another Blog", "A Blog Body", 1)
+            done.wait(10)
+        finally:
+            server.shutdown()
+            thread.join()
+        self.assertEqual(requests, [
+            ('/', 'gzip'), ('/', 'identity'),
+            ('/users/admin', 'gzip'), ('/users/admin', 'identity')])
+        self.assertEqual(refreshes, ['1'] * 4)
+
+    def test_views_counted_once(self):
+        """Behind nginx, permalink_view leaves counting to viewed_view."""
+        with microblog.app.test_client() as c:
+            c.get('/posts/blog', headers={'X-View-Counted': '1'})
+            self.assertEqual(microblog.view_counter.get_pending(self.id), 0)
+            request = c.get('/viewed/posts/blog')
+            self.assertEqual(request.status_code, 204)
+            c.get('/viewed/posts/%d' % self.id)
+            self.assertEqual(microblog.view_counter.get_pending(self.id), 2)
+            request = c.get('/viewed/posts/1000')
+            self.assertEqual(request.status_code, 404)
+
+    def test_nginx_config(self):
+        path = tempfile.mktemp()
+        microblog.app.config['NGINX_PROXY_CACHE'] = True
+        try:
+            microblog.write_nginx_config(path)
+            with open(path) as f:
+                config = f.read()
+        finally:
+            microblog.app.config['NGINX_PROXY_CACHE'] = False
+            os.remove(path)
+        self.assertIn('proxy_cache microblog;', config)
+        self.assertIn('listen 127.0.0.1:%d;' %
+                      microblog.app.config['NGINX_PURGE_PORT'], config)
+        self.assertIn('map $cookie_session $skip_cache', config)
+        self.assertIn('proxy_set_header X-Cache-Refresh '
+                      '$http_x_cache_refresh;', config)
+        #One Cache-Control header for fingerprinted assets, not two.
+        self.assertIn('immutable', config)
+        self.assertNotIn('expires max;', config)
+
+    def test_nginx_config_protects_view_counting(self):
+        """However nginx is configured, clients can't count views or stop
+        them being counted."""
+        path = tempfile.mktemp()
+        try:
+            microblog.write_nginx_config(path)
+            with open(path) as f:
+                config = f.read()
+        finally:
+            os.remove(path)
+        self.assertIn('location /viewed {\n        deny all;', config)
+        self.assertIn('proxy_set_header X-View-Counted "";', config)
+        self.assertIn('proxy_set_header X-Cache-Refresh "";', config)
+
+
+@unittest.skipUnless(distutils.spawn.find_executable('nginx'),
+                     "nginx is not installed")
+class TestProxyCacheNginx(unittest.TestCase):
+    """Run the generated nginx config with its proxy cache in front of the
+    app, and check pages are cached, refreshed and counted."""
+    def setUp(self):
+        import socket
+        import subprocess
+        import threading
+        from werkzeug.serving import make_server
+        microblog.db.create_all()
+        microblog.add_user(
+            'admin', 'password', 'email@email.com', confirm=False)
+        microblog.view_counter.pending.clear()
+        self.dir = tempfile.mkdtemp()
+        ports = []
+        for i in range(3):
+            s = socket.socket()
+            s.bind(('127.0.0.1', 0))
+            ports.append(s.getsockname()[1])
+            s.close()
+        app_port, self.port, purge_port = ports
+
+        self.server = make_server(
+            '127.0.0.1', app_port, microblog.app, threaded=True)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+        config = microblog.app.config
+        self.config = dict(config)
+        config.update(
+            NGINX_LISTEN='127.0.0.1:%d' % self.port,
+            NGINX_UPSTREAM='127.0.0.1:%d' % app_port,
+            NGINX_ACCESS_LOG=os.path.join(self.dir, 'access.log'),
+            NGINX_STATIC_ROOT=microblog.app.static_folder,
+            NGINX_PROXY_CACHE=True,
+            NGINX_PROXY_CACHE_PATH=os.path.join(self.dir, 'cache'),
+            NGINX_PURGE_PORT=purge_port,
+            HTTP_CACHE_PURGE_URL='http://127.0.0.1:%d' % purge_port,
+        )
+        microblog.write_nginx_config(os.path.join(self.dir, 'server.conf'))
+        with open(os.path.join(self.dir, 'nginx.conf'), 'w') as f:
+            f.write("pid nginx.pid;\nerror_log error.log;\n"
+                    "events {}\nhttp { include server.conf; }\n")
+        self.nginx = subprocess.Popen(
+            ['nginx', '-p', self.dir, '-c', 'nginx.conf',
+             '-g', 'daemon off;'])
+        for i in range(50):
+            try:
+                socket.create_connection(('127.0.0.1', self.port)).close()
+                break
+            except socket.error:
+                time.sleep(0.1)
+
+    def tearDown(self):
+        self.nginx.terminate()
+        self.nginx.wait()
+        self.server.shutdown()
+        self.thread.join()
+        microblog.app.config.update(self.config)
+        shutil.rmtree(self.dir)
+        microblog.db.session.remove()
+        microblog.db.drop_all()
+
+    def get(self, path):
+        import urllib2
+        response = urllib2.urlopen('http://127.0.0.1:%d%s' % (self.port, path))
+        return response.info().get('X-Cache-Status'), response.read()
+
+    def test_home_cached_and_refreshed(self):
+        self.assertEqual(self.get('/')[0], 'MISS')
+        self.assertEqual(self.get('/')[0], 'HIT')
+        microblog.write_post("Fresh Blog", "A Blog Body", 1)
+        for i in range(50):
+            status, body = self.get('/')
+            if 'Fresh Blog' in body:
+                break
+            time.sleep(0.1)
+        self.assertEqual(status, 'HIT')
+        self.assertIn('Fresh Blog', body)
+
+    def test_cached_post_views_counted(self):
+        id = microblog.write_post("Blog", "A Blog Body", 1)
+        statuses = [self.get('/posts/blog')[0] for i in range(3)]
+        self.assertEqual(statuses, ['MISS', 'HIT', 'HIT'])
+        for i in range(50):
+            if microblog.view_counter.get_pending(id) == 3:
+                break
+            time.sleep(0.1)
+        self.assertEqual(microblog.view_counter.get_pending(id), 3)
+
+
+class TestSnapshot(unittest.TestCase):
+    """Test exporting the public pages as static HTML."""
+    def setUp(self):
+        import snapshot
+        self.snapshot = snapshot
+        microblog.db.create_all()
+        microblog.add_user(
+            'admin', 'password', 'email@email.com', confirm=False)
+        for i in range(5):
+            microblog.write_post("Blog %d" % i, "A Blog Body", 1)
+        microblog.app.config['POSTS_PER_PAGE'] = 2
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        microblog.app.config['POSTS_PER_PAGE'] = 20
+        shutil.rmtree(self.dir)
+        microblog.db.session.remove()
+        microblog.db.drop_all()
+
+    def export(self):
+        return self.snapshot.export(self.dir, processes=2, batch_size=2)
+
+    def read(self, path):
+        with open(os.path.join(self.dir, path)) as f:
+            return f.read()
+
+    def test_write_post_refreshes(self):
+        """A new post is on the first index page, its own page and its
+        author's page without another export."""
+        self.export()
+        microblog.app.config['SNAPSHOT_DIR'] = self.dir
+        try:
+            microblog.write_post("Fresh Blog", "A Blog Body", 1)
+            for i in range(50):
+                #The author's page is written last.
+                if 'Fresh Blog' in self.read('users/admin'):
+                    break
+                time.sleep(0.1)
+        finally:
+            microblog.app.config['SNAPSHOT_DIR'] = None
+        index = self.read('index.html')
+        self.assertIn('Fresh Blog', index)
+        self.assertIn('href="/page/2"', index)
+        self.assertIn('Fresh Blog', self.read('users/admin'))
+        self.assertIn('A Blog Body', self.read('posts/fresh-blog'))
+
+    def test_export(self):
+        self.assertEqual(self.export(), (9, 9, 0))
+        index = self.read('index.html')
+        self.assertIn('Blog 4', index)
+        self.assertIn('Blog 3', index)
+        self.assertNotIn('Blog 2', index)
+        self.assertIn('href="/page/2"', index)
+        self.assertIn('Blog 2', self.read('page/2'))
+        self.assertIn('href="/page/3"', self.read('page/2'))
+        last = self.read('page/3')
+        self.assertIn('Blog 0', last)
+        self.assertNotIn('Older Posts', last)
+        self.assertIn('A Blog Body', self.read('posts/blog-0'))
+        self.assertIn('Not logged in', self.read('posts/blog-0'))
+        self.assertIn('Posts by admin', self.read('users/admin'))
+
+    def test_export_only_changed(self):
+        """A second export rewrites only the pages that changed, and
+        removes those that no longer exist."""
+        self.export()
+        with open(os.path.join(self.dir, 'posts', 'gone'), 'w') as f:
+            f.write('A deleted post')
+        self.assertEqual(self.export(), (9, 0, 1))
+        self.assertFalse(
+            os.path.exists(os.path.join(self.dir, 'posts', 'gone')))
+        microblog.write_post("Blog 5", "A Blog Body", 1)
+        #Every index page and the author page shift by one post, and the
+        #new post gets its page; the other permalinks are unchanged.
+        self.assertEqual(self.export(), (10, 5, 0))
+
+
 class TestAddUser(unittest.TestCase):
     """Test the add_user function of the microblog."""
     def setUp(self):
@@ -385,6 +1456,112 @@ class TestLogoutView(unittest.TestCase):
                 flask.session.get('user_id', None), self.user_id)
 
 
+class TestServerSideSessions(unittest.TestCase):
+    """Test the server-side session interface in sessions.py with each of
+    its backends.
+    """
+    def setUp(self):
+        microblog.db.create_all()
+        microblog.add_user(
+            'admin', 'password', 'email@email.com', confirm=False)
+        self.cookie_interface = microblog.app.session_interface
+
+    def tearDown(self):
+        microblog.app.session_interface = self.cookie_interface
+        microblog.db.session.remove()
+        microblog.db.drop_all()
+
+    def login_logout(self, backend):
+        """Log in and out through the given backend and return the
+        session cookies the client was sent.
+        """
+        microblog.app.session_interface = \
+            sessions.ServerSideSessionInterface(backend)
+        data = {'username': 'admin', 'password': 'password'}
+        with microblog.app.test_client() as c:
+            request = c.post('/login', data=data, follow_redirects=True)
+            self.assertIn('Logged in as admin', request.data)
+            sid = flask.session.sid
+            self.assertEqual(backend.load(sid)[0]['username'], 'admin')
+
+            request = c.get('/logout', follow_redirects=True)
+            self.assertIn('Not logged in', request.data)
+            self.assertEqual(backend.load(sid), None)
+        return sid
+
+    def test_memory_backend(self):
+        sid = self.login_logout(sessions.MemoryBackend(60))
+        self.assertEqual(len(sid), 40)
+
+    def test_database_backend(self):
+        self.login_logout(sessions.DatabaseBackend(
+            lambda: microblog.db.engine,
+            microblog.StoredSession.__table__, 60))
+
+    def test_sid_regenerated(self):
+        """A sid given out before login, such as one planted by an
+        attacker, is not the logged in session's, and neither is the
+        logged in sid used after logout."""
+        backend = sessions.MemoryBackend(60)
+        microblog.app.session_interface = \
+            sessions.ServerSideSessionInterface(backend)
+        data = {'username': 'admin', 'password': 'password'}
+        with microblog.app.test_client() as c:
+            #SeaSurf stores its token in every visitor's session, but is
+            #disabled while testing.
+            with c.session_transaction() as s:
+                s['_csrf_token'] = 'token'
+            anonymous_sid, = backend.sessions.keys()
+            c.post('/login', data=data)
+            sid = flask.session.sid
+            self.assertNotEqual(sid, anonymous_sid)
+            self.assertEqual(backend.load(anonymous_sid), None)
+            self.assertEqual(backend.load(sid)[0]['_csrf_token'], 'token')
+            c.get('/logout')
+            self.assertEqual(backend.load(sid), None)
+
+    def test_modified(self):
+        """Setting a value the session already holds, as SeaSurf does on
+        every request, doesn't modify it, unless the value is one that
+        could have been changed in place."""
+        session = sessions.ServerSideSession(
+            {'_csrf_token': u'token', '_flashes': []}, sid='a')
+        session['_csrf_token'] = u'token'
+        self.assertFalse(session.modified)
+        flashes = session['_flashes']
+        flashes.append(('message', 'Hello'))
+        session['_flashes'] = flashes
+        self.assertTrue(session.modified)
+
+    def test_memory_backend_lru(self):
+        """The least recently used session is evicted when the backend is
+        full, and expired sessions are swept.
+        """
+        backend = sessions.MemoryBackend(60, maxsize=2)
+        backend.save('a', {'n': 1})
+        backend.save('b', {'n': 2})
+        backend.load('a')
+        backend.save('c', {'n': 3})
+        self.assertEqual(backend.load('b'), None)
+        self.assertEqual(backend.load('a')[0], {'n': 1})
+
+        backend = sessions.MemoryBackend(-1)
+        backend.save('a', {'n': 1})
+        backend.save('b', {'n': 2})
+        with backend.lock:
+            backend.sweep(force=True)
+        self.assertEqual(len(backend.sessions), 0)
+
+    def test_database_backend_sweep(self):
+        backend = sessions.DatabaseBackend(
+            lambda: microblog.db.engine,
+            microblog.StoredSession.__table__, -1)
+        backend.save('a', {'n': 1})
+        self.assertEqual(backend.load('a'), None)
+        backend.sweep(force=True)
+        self.assertEqual(microblog.StoredSession.query.count(), 0)
+
+
 class TestListView(unittest.TestCase):
     """Test the list view (list_view function) of the microblog."""
     def setUp(self):
@@ -435,6 +1612,26 @@ class TestListView(unittest.TestCase):
             match = re.search(search_string, request.data, re.DOTALL)
             self.assertTrue(match)
 
+    def test_list_view_streamed(self):
+        """Verify that the streamed list view is a streamed response with
+        the same posts, in the same order, and that a flashed message is
+        shown only once.
+        """
+        microblog.app.config['STREAM_LIST_VIEW'] = True
+        try:
+            with microblog.app.test_client() as c:
+                with c.session_transaction() as sess:
+                    sess['_flashes'] = [('message', 'A flashed message')]
+                request = c.get('/')
+                self.assertTrue(request.is_streamed)
+                self.assertTrue(re.search(
+                    r'Blog 3.*?Blog 2.*?Blog 1', request.data, re.DOTALL))
+                self.assertIn('A flashed message', request.data)
+                request = c.get('/')
+                self.assertNotIn('A flashed message', request.data)
+        finally:
+            microblog.app.config['STREAM_LIST_VIEW'] = False
+
     def test_list_view_logged_in(self):
         with microblog.app.test_client() as c:
             data = {
@@ -452,6 +1649,52 @@ class TestListView(unittest.TestCase):
             self.assertIn('Not logged in', request.data)
 
 
+class TestAuthorView(unittest.TestCase):
+    """Test the author view (author_view function) of the microblog."""
+    def setUp(self):
+        microblog.db.create_all()
+        microblog.add_user(
+            'admin', 'password', 'email@email.com', confirm=False)
+        self.user_id = \
+            microblog.User.query.filter_by(username='admin').first().id
+        for i in range(3):
+            microblog.write_post("Blog %d" % i, "A Blog Body", self.user_id)
+        microblog.app.config['POSTS_PER_PAGE'] = 2
+
+    def tearDown(self):
+        microblog.app.config['POSTS_PER_PAGE'] = 20
+        microblog.db.session.remove()
+        microblog.db.drop_all()
+
+    def test_author_view(self):
+        """Verify that the first page holds the newest posts and links to
+        a second page holding the rest.
+        """
+        with microblog.app.test_client() as c:
+            request = c.get('/users/admin')
+            self.assertIn('Posts by admin', request.data)
+            self.assertTrue(
+                re.search(r'Blog 2.*?Blog 1', request.data, re.DOTALL))
+            self.assertNotIn('Blog 0', request.data)
+            next_page = re.search(r'href="([^"]+)">Older Posts', request.data)
+            self.assertTrue(next_page)
+
+            request = c.get(next_page.group(1).replace('&amp;', '&'))
+            self.assertIn('Blog 0', request.data)
+            self.assertNotIn('Blog 1', request.data)
+            self.assertNotIn('Older Posts', request.data)
+
+    def test_author_view_unknown_user(self):
+        with microblog.app.test_client() as c:
+            request = c.get('/users/nobody')
+            self.assertEqual(request.status_code, 404)
+
+    def test_author_view_bad_cursor(self):
+        with microblog.app.test_client() as c:
+            request = c.get('/users/admin?before=garbage')
+            self.assertEqual(request.status_code, 404)
+
+
 class TestAddView(unittest.TestCase):
     """Test the add view (add_view function) of the microblog."""
     def setUp(self):
@@ -541,7 +1784,7 @@ class TestAddView(unittest.TestCase):
             self.post['body'] = ''
             request = c.post(
                 '/add', data=self.post, follow_redirects=True)
-            self.assertIn('Posts must have a title and a body.', request.data)
+            self.assertIn('Posts must have a body.', request.data)
             self.assertIn('_csrf_token', request.data)
             self.assertIn('title', request.data)
             self.assertIn('body', request.data)
@@ -561,12 +1804,54 @@ class TestAddView(unittest.TestCase):
             self.post['title'] = ''
             request = c.post(
                 '/add', data=self.post, follow_redirects=True)
-            self.assertIn('Posts must have a title and a body.', request.data)
+            self.assertIn('Posts must have a title.', request.data)
             self.assertIn('_csrf_token', request.data)
             self.assertIn('title', request.data)
             self.assertIn('body', request.data)
             self.assertIn('submit', request.data)
 
+    def test_add_view_duplicate_title(self):
+        """Verify that attempting to submit a post with a title that is
+        already taken returns us to the add view saying so.
+        """
+        microblog.write_post('Blog 1', 'An Earlier Body', self.user_id)
+        with microblog.app.test_client() as c:
+            data = {
+               # '_csrf_token': flask.session['_csrf_token'],
+                'username': 'admin',
+                'password': 'password',
+            }
+            c.post('/login', data=data)
+            request = c.post(
+                '/add', data=self.post, follow_redirects=True)
+            self.assertIn(
+                'A post with this title already exists.', request.data)
+            self.assertIn('submit', request.data)
+
+    def test_add_view_integrity_error(self):
+        """Verify that a post the database rejects, such as one by a user
+        deleted since logging in, is rolled back and returns us to the add
+        view with an error message.
+        """
+        def write_post(title, body, auth_id):
+            #SQLite doesn't check foreign keys, so fail on a primary key.
+            insert = "INSERT INTO site_stats (name, value) VALUES ('a', 1)"
+            microblog.db.session.execute(insert)
+            microblog.db.session.execute(insert)
+        self.addCleanup(setattr, microblog, 'write_post', microblog.write_post)
+        microblog.write_post = write_post
+        with microblog.app.test_client() as c:
+            c.post('/login', data={
+                'username': 'admin',
+                'password': 'password',
+            })
+            request = c.post(
+                '/add', data=self.post, follow_redirects=True)
+            self.assertEqual(request.status_code, 200)
+            self.assertIn(
+                'Posts must have an existing author.', request.data)
+        self.assertIsNone(microblog.SiteStat.query.get('a'))
+
 
 class TestPermalinkView(unittest.TestCase):
     """Test the permalink view (permalink_view function) of the microblog.
@@ -582,6 +1867,7 @@ class TestPermalinkView(unittest.TestCase):
             "Blog 2": "Another Blog Body",
             "Blog 3": "A Third Blog Body",
         }
+        microblog.slug_index.clear()
         for title, body in sorted(self.posts.items(), key=lambda x: x[0]):
             microblog.write_post(title, body, self.user_id)
 
@@ -612,6 +1898,227 @@ class TestPermalinkView(unittest.TestCase):
             request = c.get('/posts/1')
             self.assertIn('Not logged in', request.data)
 
+    def test_permalink_view_slug(self):
+        with microblog.app.test_client() as c:
+            request = c.get('/posts/blog-2')
+            self.assertIn('Blog 2', request.data)
+            self.assertIn(self.posts['Blog 2'], request.data)
+        self.assertEqual(microblog.slug_index.get('blog-2'), 2)
+
+    def test_permalink_view_not_found(self):
+        """Unknown ids and slugs should be 404s."""
+        with microblog.app.test_client() as c:
+            for url in ['/posts/0', '/posts/4', '/posts/999', '/posts/nope']:
+                request = c.get(url)
+                self.assertEqual(request.status_code, 404)
+
+    def test_list_view_links_slugs(self):
+        with microblog.app.test_client() as c:
+            request = c.get('/')
+            self.assertIn('href=/posts/blog-1>', request.data)
+
+
+class TestSitemapViews(unittest.TestCase):
+    """Test the sitemap index and sitemap chunk views."""
+    def setUp(self):
+        microblog.db.create_all()
+        microblog.add_user(
+            'admin', 'password', 'email@email.com', confirm=False)
+        self.user_id = \
+            microblog.User.query.filter_by(username='admin').first().id
+        self.cache_dir = tempfile.mkdtemp()
+        microblog.app.config['SITEMAP_CACHE_DIR'] = self.cache_dir
+        microblog.app.config['SITEMAP_CHUNK_SIZE'] = 2
+        for i in range(5):
+            microblog.write_post("Blog %d" % i, "A Blog Body", self.user_id)
+
+    def tearDown(self):
+        microblog.app.config['SITEMAP_CACHE_DIR'] = None
+        microblog.app.config['SITEMAP_CHUNK_SIZE'] = 50000
+        shutil.rmtree(self.cache_dir)
+        microblog.db.session.remove()
+        microblog.db.drop_all()
+
+    def cached(self):
+        return sorted(name for name in os.listdir(self.cache_dir)
+                      if name.endswith('.xml'))
+
+    def test_invalidated_while_written(self):
+        """A chunk invalidated while it is being written is served, but
+        not cached."""
+        path = microblog.sitemap_chunk_path(2)
+        with microblog.app.test_request_context():
+            rows = microblog.db.session.query(microblog.Post.id)
+            original = type(rows).yield_per
+
+            def yield_per(query, count):
+                microblog.invalidate_sitemap(5)
+                return original(query, count)
+
+            type(rows).yield_per = yield_per
+            try:
+                f = microblog.write_sitemap_chunk(2, path)
+            finally:
+                type(rows).yield_per = original
+            with f:
+                self.assertIn('/posts/blog-4</loc>', f.read())
+        self.assertNotIn('sitemap-2.xml', self.cached())
+
+    def test_sitemap_index(self):
+        with microblog.app.test_client() as c:
+            request = c.get('/sitemap.xml')
+            self.assertEqual(request.mimetype, 'application/xml')
+            self.assertEqual(
+                re.findall(r'<loc>([^<]+)</loc>', request.data),
+                ['http://localhost:5000/sitemap-%d.xml' % i for i in range(3)]
+            )
+
+    def test_sitemap_chunk(self):
+        with microblog.app.test_client() as c:
+            request = c.get('/sitemap-1.xml')
+            self.assertEqual(
+                re.findall(r'<loc>([^<]+)</loc>', request.data),
+                ['http://localhost:5000/posts/blog-2',
+                 'http://localhost:5000/posts/blog-3']
+            )
+            request = c.get('/sitemap-3.xml')
+            self.assertEqual(request.status_code, 404)
+
+    def test_write_post_invalidates_newest_chunk(self):
+        """Writing a post should only regenerate the chunk it lands in."""
+        with microblog.app.test_client() as c:
+            for i in range(3):
+                c.get('/sitemap-%d.xml' % i)
+            self.assertEqual(len(self.cached()), 3)
+
+            microblog.write_post("Blog 5", "A Blog Body", self.user_id)
+            self.assertEqual(self.cached(), ['sitemap-0.xml', 'sitemap-1.xml'])
+            request = c.get('/sitemap-2.xml')
+            self.assertIn('/posts/blog-5</loc>', request.data)
+
+
+class TestIdempotency(unittest.TestCase):
+    """Test that submissions carrying an idempotency key act only once."""
+    def setUp(self):
+        microblog.db.create_all()
+        microblog.add_user(
+            'admin', 'password', 'email@email.com', confirm=False)
+        self.store = microblog.idempotency_store
+        self.post = {'title': 'Blog 1', 'body': 'O Blarghag',
+                     'idempotency_key': 'abc123'}
+
+    def tearDown(self):
+        microblog.db.session.remove()
+        microblog.db.drop_all()
+
+    def login(self, c):
+        c.post('/login', data={'username': 'admin', 'password': 'password'})
+
+    def test_claim_contended(self):
+        """A key that is released again between every failed INSERT and
+        the SELECT that follows is not taken as claimed."""
+        import idempotency
+
+        class Result(object):
+            rowcount = 0
+
+            def first(self):
+                return None
+
+        class Engine(object):
+            def execute(self, *args, **kwargs):
+                return Result()
+
+        store = idempotency.IdempotencyStore(
+            Engine, microblog.IdempotencyKey.__table__, 60)
+        self.assertIs(store.claim('key', 'fingerprint'),
+                      idempotency.CONTENDED)
+
+    def test_form_has_key(self):
+        with microblog.app.test_client() as c:
+            self.login(c)
+            first = re.search(
+                r'name="idempotency_key" value="(\w+)"', c.get('/add').data)
+            second = re.search(
+                r'name="idempotency_key" value="(\w+)"', c.get('/add').data)
+        self.assertNotEqual(first.group(1), second.group(1))
+
+    def test_add_view_retried(self):
+        """A retried submission gets the first response, without writing
+        the post again or flashing that its title is taken."""
+        with microblog.app.test_client() as c:
+            self.login(c)
+            first = c.post('/add', data=self.post)
+            second = c.post('/add', data=self.post)
+            self.assertEqual(second.status_code, first.status_code)
+            self.assertEqual(second.headers['Location'],
+                             first.headers['Location'])
+            request = c.get(second.headers['Location'])
+        self.assertNotIn('A post with this title already exists.',
+                         request.data)
+        self.assertEqual(microblog.Post.query.count(), 1)
+
+    def test_add_view_without_key(self):
+        del self.post['idempotency_key']
+        with microblog.app.test_client() as c:
+            self.login(c)
+            c.post('/add', data=self.post)
+            request = c.post('/add', data=self.post, follow_redirects=True)
+        self.assertIn('A post with this title already exists.', request.data)
+
+    def test_key_reused_for_other_request(self):
+        with microblog.app.test_client() as c:
+            self.login(c)
+            c.post('/add', data=self.post)
+            self.post['title'] = 'Blog 2'
+            request = c.post('/add', data=self.post)
+        self.assertEqual(request.status_code, 422)
+        self.assertEqual(microblog.Post.query.count(), 1)
+
+    def test_header_key(self):
+        del self.post['idempotency_key']
+        headers = {'Idempotency-Key': 'abc123'}
+        with microblog.app.test_client() as c:
+            self.login(c)
+            c.post('/add', data=self.post, headers=headers)
+            request = c.post('/add', data=self.post, headers=headers)
+        self.assertEqual(request.status_code, 302)
+        self.assertEqual(microblog.Post.query.count(), 1)
+
+    def test_register_view_retried(self):
+        """A retried registration is neither hashed nor mailed again."""
+        data = {'username': 'new', 'password': 'password',
+                'email': 'new@email.com', 'idempotency_key': 'abc123'}
+        with microblog.mail.record_messages() as outbox:
+            with microblog.app.test_client() as c:
+                first = c.post('/register', data=data)
+                second = c.post('/register', data=data)
+        self.assertEqual(len(outbox), 1)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.data, first.data)
+        self.assertIn('Almost There...', second.data)
+
+    def test_request_in_progress(self):
+        self.store.claim('add_view:1:abc123', 'fingerprint')
+        with microblog.app.test_client() as c:
+            self.login(c)
+            request = c.post('/add', data=self.post)
+        self.assertEqual(request.status_code, 409)
+        self.assertEqual(microblog.Post.query.count(), 0)
+
+    def test_expired_claim_released(self):
+        """A key whose request never finished can be claimed again once
+        its lock times out."""
+        self.store.claim('add_view:1:abc123', 'fingerprint')
+        microblog.db.engine.execute(
+            microblog.IdempotencyKey.__table__.update().values(
+                expires=datetime.datetime(2000, 1, 1)))
+        with microblog.app.test_client() as c:
+            self.login(c)
+            request = c.post('/add', data=self.post)
+        self.assertEqual(request.status_code, 302)
+        self.assertEqual(microblog.Post.query.count(), 1)
+
 
 class TestRegisterView(unittest.TestCase):
     """Test the register view (register_view function) of the microblog."""
@@ -787,5 +2294,422 @@ class TestConfirmView(unittest.TestCase):
         self.assertEqual(temp_user.email, user.email)
 
 
+class TestPrecompileTemplates(unittest.TestCase):
+    """Test the precompile_templates manager command."""
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        microblog.app.config['JINJA_BYTECODE_CACHE_DIR'] = self.cache_dir
+        microblog.app.jinja_env.bytecode_cache = \
+            jinja2.FileSystemBytecodeCache(self.cache_dir)
+        microblog.app.jinja_env.cache.clear()
+
+    def tearDown(self):
+        microblog.app.config['JINJA_BYTECODE_CACHE_DIR'] = None
+        microblog.app.jinja_env.bytecode_cache = None
+        shutil.rmtree(self.cache_dir)
+
+    def test_precompile_templates(self):
+        """Verify that every template gets an entry in the bytecode
+        cache.
+        """
+        microblog.precompile_templates()
+        self.assertEqual(
+            len(os.listdir(self.cache_dir)),
+            len(microblog.app.jinja_env.list_templates())
+        )
+
+
+class TestBuildAssets(unittest.TestCase):
+    """Test the static asset pipeline in assets.py and the asset_url
+    template helper.
+    """
+    def setUp(self):
+        self.static_folder = tempfile.mkdtemp()
+        with open(os.path.join(self.static_folder, 'base.css'), 'w') as f:
+            f.write("/* A comment */\nbody {\n    color: #F0F0F0;\n}\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.static_folder)
+        microblog.asset_manifest.clear()
+
+    def test_minify_css(self):
+        self.assertEqual(
+            assets.minify_css("/* x */\na:hover {\n    color: #FFF;\n}\n"),
+            "a:hover{color:#FFF}"
+        )
+
+    def test_build_assets(self):
+        """Build the assets and verify that the manifest points at a
+        minified, fingerprinted, precompressed copy of the stylesheet.
+        """
+        manifest = assets.build_assets(self.static_folder)
+        self.assertTrue(
+            re.match(r'build/base\.[0-9a-f]{10}\.css$', manifest['base.css']))
+        built = os.path.join(self.static_folder, manifest['base.css'])
+        with open(built) as f:
+            self.assertEqual(f.read(), "body{color:#F0F0F0}")
+        self.assertTrue(os.path.exists(built + '.gz'))
+        self.assertEqual(assets.load_manifest(self.static_folder), manifest)
+
+    def test_asset_url(self):
+        """asset_url should fall back to the plain static URL until assets
+        have been built.
+        """
+        with microblog.app.test_request_context():
+            self.assertEqual(
+                microblog.asset_url('base.css'), '/static/base.css')
+            microblog.asset_manifest.update(
+                assets.build_assets(self.static_folder))
+            self.assertEqual(
+                microblog.asset_url('base.css'),
+                '/static/' + microblog.asset_manifest['base.css']
+            )
+
+
+class TestGzipMiddleware(unittest.TestCase):
+    """Test the GzipMiddleware in compression.py."""
+    def setUp(self):
+        self.body = 'x' * 2048
+
+        def app(environ, start_response):
+            size = int(environ['PATH_INFO'].strip('/'))
+            headers = [('Content-Type', 'text/html; charset=utf-8')]
+            if environ.get('QUERY_STRING') != 'stream':
+                headers.append(('Content-Length', str(size)))
+            start_response('200 OK', headers)
+            return [self.body[:size // 2], self.body[size // 2:size]]
+
+        self.client = Client(
+            GzipMiddleware(app, minimum_size=1024), BaseResponse)
+
+    def test_gzip_large_response(self):
+        response = self.client.get(
+            '/2048', headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(
+            int(response.headers['Content-Length']), len(response.data))
+        self.assertEqual(
+            zlib.decompress(response.data, 16 + zlib.MAX_WBITS), self.body)
+
+    def test_vary_merged(self):
+        """Accept-Encoding is added to the app's own Vary header, which
+        shared caches still need."""
+        def app(environ, start_response):
+            start_response('200 OK', [
+                ('Content-Type', 'text/html'), ('Vary', 'Cookie')])
+            return [self.body]
+
+        client = Client(GzipMiddleware(app), BaseResponse)
+        response = client.get('/', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Vary'], 'Cookie, Accept-Encoding')
+
+    def test_small_response_untouched(self):
+        response = self.client.get(
+            '/100', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.data, self.body[:100])
+
+    def test_gzip_not_accepted(self):
+        response = self.client.get('/2048')
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.data, self.body)
+
+    def test_gzip_streamed_response(self):
+        """Responses without a Content-Length are compressed however
+        small they are, and stay without one.
+        """
+        response = self.client.get(
+            '/100?stream', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', response.headers)
+        self.assertEqual(
+            zlib.decompress(response.data, 16 + zlib.MAX_WBITS),
+            self.body[:100])
+
+
+class TestFragmentCache(unittest.TestCase):
+    """Test the cached login header and flash block fragments."""
+    def setUp(self):
+        microblog.fragment_cache.clear()
+
+    def test_login_header_keyed_by_login_state(self):
+        hits = microblog.fragment_cache.hits
+        misses = microblog.fragment_cache.misses
+        with microblog.app.test_request_context('/'):
+            self.assertIn('Not logged in', microblog.login_header())
+            flask.session['logged_in'] = True
+            flask.session['username'] = 'admin'
+            self.assertIn('Logged in as admin', microblog.login_header())
+            flask.session['username'] = 'other'
+            self.assertIn('Logged in as other', microblog.login_header())
+            microblog.login_header()
+        self.assertEqual(microblog.fragment_cache.misses - misses, 3)
+        self.assertEqual(microblog.fragment_cache.hits - hits, 1)
+
+    def test_login_header_escapes_username(self):
+        with microblog.app.test_request_context('/'):
+            flask.session['logged_in'] = True
+            flask.session['username'] = '<b>admin</b>'
+            self.assertIn('&lt;b&gt;admin', microblog.login_header())
+
+    def test_flash_block(self):
+        with microblog.app.test_request_context('/'):
+            self.assertEqual(microblog.flash_block(), '')
+        with microblog.app.test_request_context('/'):
+            flask.flash('A flashed message')
+            self.assertIn(
+                '<li>A flashed message</li>', microblog.flash_block())
+
+    def test_cached_url_for(self):
+        with microblog.app.test_request_context('/'):
+            self.assertEqual(microblog.cached_url_for('login_view'), '/login')
+            self.assertEqual(microblog.cached_url_for('login_view'), '/login')
+
+
+class TestAccessLogger(unittest.TestCase):
+    """Test the structured access log written by accesslog.AccessLogger."""
+    def setUp(self):
+        microblog.db.create_all()
+        microblog.add_user(
+            'admin', 'password', 'email@email.com', confirm=False)
+        microblog.write_post("Blog 1", "A Blog Body", 1)
+        self.log_path = os.path.join(tempfile.mkdtemp(), 'access.log')
+        microblog.access_logger.start(self.log_path)
+
+    def tearDown(self):
+        microblog.access_logger.stop()
+        microblog.app.config['ACCESS_LOG_SAMPLE_RATE'] = 1.0
+        shutil.rmtree(os.path.dirname(self.log_path))
+        microblog.db.session.remove()
+        microblog.db.drop_all()
+
+    def read_log(self):
+        microblog.access_logger.writer.flush()
+        if not os.path.exists(self.log_path):
+            return []
+        with open(self.log_path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_access_log(self):
+        with microblog.app.test_client() as c:
+            c.post('/login', data={
+                'username': 'admin', 'password': 'password'})
+            c.get('/posts/1')
+        entries = self.read_log()
+        self.assertEqual(len(entries), 2)
+        entry = entries[1]
+        self.assertEqual(entry['route'], '/posts/<int:id>')
+        self.assertEqual(entry['endpoint'], 'permalink_view')
+        self.assertEqual(entry['status'], 200)
+        self.assertEqual(entry['user_id'], 1)
+        self.assertTrue(entry['db_ms'] > 0)
+        self.assertTrue(entry['duration_ms'] >= entry['db_ms'])
+
+    def test_access_log_sampling(self):
+        """With a zero sample rate, only errors and slow requests are
+        logged.
+        """
+        microblog.app.config['ACCESS_LOG_SAMPLE_RATE'] = 0.0
+        with microblog.app.test_client() as c:
+            c.get('/posts/1')
+        self.assertEqual(self.read_log(), [])
+
+
+class TestAccessLogReport(unittest.TestCase):
+    """Test tools/access_log_report.py's estimates from sampled logs."""
+    def setUp(self):
+        import imp
+        self.report = imp.load_source('access_log_report', os.path.join(
+            os.path.dirname(os.path.abspath(__file__)),
+            'tools', 'access_log_report.py'))
+
+    def test_sampled_lines_weighted(self):
+        """A line sampled at 10% stands for ten requests."""
+        lines = [json.dumps(entry) for entry in [
+            {'route': '/', 'status': 200, 'duration_ms': 10, 'db_ms': 6,
+             'sample_rate': 0.1},
+            {'route': '/', 'status': 200, 'duration_ms': 20, 'db_ms': 0,
+             'sample_rate': 1.0},
+            {'route': '/', 'status': 500, 'duration_ms': 30, 'db_ms': 0,
+             'sample_rate': 1.0},
+        ]] + ['not json']
+        groups, bad_lines = self.report.summarize(lines, 'route')
+        self.assertEqual(bad_lines, 1)
+        group = groups['/']
+        self.assertEqual(group['count'], 12)
+        self.assertEqual(group['errors'], 1)
+        self.assertEqual(group['db_total'] / group['count'], 5)
+        durations = group['durations']
+        self.assertEqual(self.report.percentile(durations, 0.5), 10)
+        self.assertEqual(self.report.percentile(durations, 0.9), 20)
+        self.assertEqual(self.report.percentile(durations, 0.99), 30)
+
+
+class TestMetrics(unittest.TestCase):
+    """Test the /metrics endpoint."""
+    def setUp(self):
+        microblog.db.create_all()
+        microblog.add_user(
+            'admin', 'password', 'email@email.com', confirm=False)
+        self.local = {'REMOTE_ADDR': '127.0.0.1'}
+
+    def tearDown(self):
+        microblog.app.config['METRICS_DIR'] = None
+        microblog.metrics.stop_dumper()
+        microblog.db.session.remove()
+        microblog.db.drop_all()
+
+    def sample(self, text, name):
+        match = re.search(
+            r'^%s (\S+)$' % re.escape(name), text, re.MULTILINE)
+        return float(match.group(1)) if match else 0.0
+
+    def test_metrics(self):
+        with microblog.app.test_client() as c:
+            name = 'microblog_requests_total' \
+                '{endpoint="list_view",method="GET",status="200"}'
+            before = self.sample(
+                c.get('/metrics', environ_base=self.local).data, name)
+            c.get('/')
+            c.post('/login', data={
+                'username': 'admin', 'password': 'password'})
+            text = c.get('/metrics', environ_base=self.local).data
+        self.assertEqual(self.sample(text, name), before + 1)
+        self.assertIn('# TYPE microblog_request_duration_seconds histogram',
+                      text)
+        self.assertIn('microblog_request_duration_seconds_bucket'
+                      '{endpoint="list_view",le="+Inf"}', text)
+        self.assertTrue(self.sample(
+            text, 'microblog_bcrypt_seconds_count{operation="verify"}') >= 1)
+        self.assertIn('microblog_cache_requests_total'
+                      '{cache="fragment",result="hit"}', text)
+
+    def test_metrics_not_public(self):
+        with microblog.app.test_client() as c:
+            response = c.get(
+                '/metrics', environ_base={'REMOTE_ADDR': '10.0.0.1'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_metrics_across_workers(self):
+        """Counters dumped by other workers, even exited ones, are added to
+        this worker's, and their gauges are dropped."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        microblog.app.config['METRICS_DIR'] = directory
+
+        def write_dump(pid, started, sent, gauge):
+            path = os.path.join(directory, '%d-%d.json' % (pid, started))
+            with open(path, 'w') as f:
+                json.dump({'pid': pid, 'started': started, 'metrics': [
+                    ['microblog_mail_sent_total', 'counter', 'Mail.',
+                     [['microblog_mail_sent_total', [['outcome', 'sent']],
+                       sent]]],
+                    [gauge, 'gauge', 'Gauge.', [[gauge, [], 3]]],
+                ]}, f)
+        write_dump(999999999, 1, 5, 'microblog_exited')
+        #An exited worker whose pid this one reused.
+        write_dump(os.getpid(), 0, 7, 'microblog_reused')
+        microblog.mail_sent.inc(('sent',))
+        own = microblog.mail_sent.values[('sent',)]
+        with microblog.app.test_client() as c:
+            text = c.get('/metrics', environ_base=self.local).data
+        self.assertEqual(self.sample(
+            text, 'microblog_mail_sent_total{outcome="sent"}'), own + 12)
+        self.assertNotIn('microblog_exited{', text)
+        self.assertNotIn('microblog_reused{', text)
+        microblog.metrics.dump()
+        self.assertIn('%d-%d.json' % (os.getpid(), microblog.metrics.started),
+                      os.listdir(directory))
+        self.assertIn('%d-0.json' % os.getpid(), os.listdir(directory))
+
+    def test_metrics_dumped_in_background(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        microblog.app.config['METRICS_DIR'] = directory
+        microblog.app.config['METRICS_DUMP_INTERVAL'] = 0.01
+        self.addCleanup(
+            microblog.app.config.__setitem__, 'METRICS_DUMP_INTERVAL', 5)
+        with microblog.app.test_client() as c:
+            c.get('/')
+        dumped = []
+        for _ in range(100):
+            dumped = [f for f in os.listdir(directory) if f.endswith('.json')]
+            if dumped:
+                break
+            time.sleep(0.01)
+        self.assertEqual(dumped, ['%d-%d.json' % (
+            os.getpid(), microblog.metrics.started)])
+
+
+class Leak(object):
+    """Something for TestDiagnostics to find growing in memory."""
+
+
+class TestDiagnostics(unittest.TestCase):
+    """Test the /debug profiling and memory endpoints."""
+    def setUp(self):
+        microblog.app.config['DEBUG_TOKEN'] = 'secret'
+        self.headers = {'X-Debug-Token': 'secret'}
+
+    def tearDown(self):
+        microblog.app.config['DEBUG_TOKEN'] = None
+
+    def test_token_required(self):
+        with microblog.app.test_client() as c:
+            self.assertEqual(c.get('/debug/memory').status_code, 404)
+            self.assertEqual(c.get('/debug/profile', headers={
+                'X-Debug-Token': 'wrong'}).status_code, 404)
+            microblog.app.config['DEBUG_TOKEN'] = None
+            self.assertEqual(c.get('/debug/memory', headers={
+                'X-Debug-Token': ''}).status_code, 404)
+
+    def test_profile_view(self):
+        with microblog.app.test_client() as c:
+            response = c.get(
+                '/debug/profile?seconds=0.05', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('attachment', response.headers['Content-Disposition'])
+
+    def test_profile_bad_seconds(self):
+        with microblog.app.test_client() as c:
+            for seconds in ('-1', '0', 'nan', 'inf', '-inf', 'soon'):
+                response = c.get('/debug/profile?seconds=%s' % seconds,
+                                 headers=self.headers)
+                self.assertEqual(response.status_code, 400, seconds)
+
+    def test_sampling_profiler(self):
+        import profiler
+
+        def busy_loop():
+            end = time.clock() + 0.2
+            while time.clock() < end:
+                pass
+
+        sampler = profiler.SamplingProfiler(interval=0.005)
+        sampler.start()
+        try:
+            busy_loop()
+        finally:
+            sampler.stop()
+        lines = sampler.collapsed().splitlines()
+        self.assertTrue(lines)
+        stack, count = lines[0].rsplit(' ', 1)
+        self.assertIn('test_sampling_profiler (tests.py', stack)
+        self.assertTrue(stack.endswith('busy_loop (tests.py:%d)' % (
+            busy_loop.func_code.co_firstlineno)))
+        self.assertTrue(int(count) > 1)
+
+    def test_memory_view(self):
+        with microblog.app.test_client() as c:
+            response = c.get('/debug/memory', headers=self.headers)
+            self.assertIn('dict', response.data)
+            leaks = [Leak() for i in range(1000)]
+            response = c.get('/debug/memory?diff=1', headers=self.headers)
+        self.assertTrue(re.search(
+            r'^Leak +1000 +\+1000$', response.data, re.MULTILINE))
+        del leaks
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,74 @@
+"""Summarize one or more access logs written by accesslog.AccessLogger.
+
+Each line is weighted by the inverse of its sample rate, so counts,
+percentiles and averages estimate those of every request, even though
+errors and slow requests are always logged and the rest only sampled.
+
+    python tools/access_log_report.py /var/log/microblog/access.log*
+"""
+import argparse
+import fileinput
+import json
+from collections import defaultdict
+
+
+def percentile(values, p):
+    """Return the weighted percentile p of values, a list of (value,
+    weight) pairs sorted by value."""
+    target = sum(weight for value, weight in values) * p
+    seen = 0.0
+    for value, weight in values:
+        seen += weight
+        if seen >= target:
+            return value
+    return values[-1][0]
+
+
+def summarize(lines, by):
+    """Return the weighted request count, error count, (duration_ms,
+    weight) pairs and total db_ms of the log lines, grouped by the by
+    field, and the number of lines that couldn't be parsed."""
+    groups = defaultdict(lambda: {
+        'count': 0.0, 'errors': 0.0, 'durations': [], 'db_total': 0.0})
+    bad_lines = 0
+    for line in lines:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            bad_lines += 1
+            continue
+        group = groups[entry.get(by)]
+        weight = 1.0 / (entry.get('sample_rate') or 1.0)
+        group['count'] += weight
+        if entry['status'] >= 500:
+            group['errors'] += weight
+        group['durations'].append((entry['duration_ms'], weight))
+        group['db_total'] += entry['db_ms'] * weight
+    for group in groups.values():
+        group['durations'].sort()
+    return groups, bad_lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('paths', nargs='+')
+    parser.add_argument('--by', default='route',
+                        choices=['route', 'endpoint', 'status', 'user_id'])
+    args = parser.parse_args()
+
+    groups, bad_lines = summarize(fileinput.input(args.paths), args.by)
+    print "%-28s %10s %7s %9s %9s %9s %9s" % (
+        args.by, 'requests', 'errors', 'p50 ms', 'p95 ms', 'p99 ms',
+        'db avg')
+    for key, group in sorted(groups.items(), key=lambda item: -item[1]['count']):
+        durations = group['durations']
+        print "%-28s %10.0f %7.0f %9.1f %9.1f %9.1f %9.1f" % (
+            str(key)[:28], group['count'], group['errors'],
+            percentile(durations, 0.5), percentile(durations, 0.95),
+            percentile(durations, 0.99),
+            group['db_total'] / group['count'])
+    if bad_lines:
+        print "(%d unparseable lines skipped)" % bad_lines
+
+if __name__ == '__main__':
+    main()